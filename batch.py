@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from blocks import block_runs
+from connection_pool import init_pool
+from explore import (MAX_CTID_MEMORY_MB, WindowScanUnavailableError, analyze_query, approximate_query,
+                     get_execution_plan, get_skipped_tables)
+from plan_analysis import analysis_report
+from plan_history import PlanHistory, table_summaries
+from plan_tree import get_plan_layout
+from sql_rewriter import split_statements
+from tracing import Trace, activate
+
+BUFFER_KEYS = (
+    "Shared Hit Blocks", "Shared Read Blocks", "Shared Dirtied Blocks", "Shared Written Blocks",
+    "Local Hit Blocks", "Local Read Blocks", "Temp Read Blocks", "Temp Written Blocks",
+)
+
+
+def analyze_workload_query(position, query, estimate_only=False, approximate_seconds=None, spill_dir=None,
+                           memory_limit_mb=MAX_CTID_MEMORY_MB):
+    # One report record, errors are reported instead of stopping the workload
+    report = {"index": position, "query": query}
+    start = time.perf_counter()
+    trace = Trace(query)
+    # Only the summaries outlive the query, so its spilled blocks are removed after it
+    query_spill_dir = tempfile.mkdtemp(prefix=f"query-{position}-", dir=spill_dir) if spill_dir else None
+    try:
+        with activate(trace):
+            if estimate_only:
+                plan, results = get_execution_plan(query, analyze=False), {}
+            elif approximate_seconds is not None:
+                try:
+                    plan, results = approximate_query(query, max_seconds=approximate_seconds)
+                except WindowScanUnavailableError as e:
+                    # Sampling would be slower than reading every ctid
+                    report["approximation_unavailable"] = str(e)
+                    plan, results = analyze_query(query, memory_limit_mb=memory_limit_mb, spill_dir=query_spill_dir)
+            else:
+                plan, results = analyze_query(query, memory_limit_mb=memory_limit_mb, spill_dir=query_spill_dir)
+        report["plan"] = plan
+        report["buffers"] = {key: plan[key] for key in BUFFER_KEYS if key in plan}
+        report["timings"] = {
+            "wall_time_ms": round((time.perf_counter() - start) * 1000, 3),
+            "execution_time_ms": plan.get("Actual Total Time"),
+            "total_cost": plan.get("Total Cost"),
+            "database_ms": round(trace.totals()["database_ms"], 3),
+        }
+        report["phases"] = trace.breakdown()
+        layout = get_plan_layout(plan)
+        report["analysis"] = analysis_report(layout.analysis, layout.nodes)
+        report["tables"] = table_summaries(results)
+        for table_name, index in results.items():
+            report["tables"][table_name]["block_runs"] = block_runs(index.runs())
+        if not estimate_only:
+            # Read by the query, but their blocks can't be traced
+            report["skipped_tables"] = get_skipped_tables(query)
+    except Exception as e:
+        report["error"] = str(e)
+        report["timings"] = {"wall_time_ms": round((time.perf_counter() - start) * 1000, 3)}
+    finally:
+        if query_spill_dir is not None:
+            shutil.rmtree(query_spill_dir, ignore_errors=True)
+    return report
+
+
+def _init_process(host, database, user, password):
+    # Each worker process has its own single connection
+    init_pool(host, database, user, password, max_size=1)
+
+
+def run_workload(queries, connection_details, workers=4, mode="thread", estimate_only=False,
+                 approximate_seconds=None, spill_dir=None, memory_limit_mb=MAX_CTID_MEMORY_MB):
+    # Yields reports in completion order
+    if mode == "process":
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_process,
+                                       initargs=connection_details)
+    else:
+        init_pool(*connection_details, max_size=workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        futures = [executor.submit(analyze_workload_query, position, query, estimate_only, approximate_seconds,
+                                   spill_dir, memory_limit_mb)
+                   for position, query in enumerate(queries)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def record_history(history, reports, database, analyzed):
+    # Passes the reports through, recording the plan of each one that succeeded
+    for report in reports:
+        if "plan" in report:
+            tables = {table_name: {key: value for key, value in summary.items() if key != "block_runs"}
+                      for table_name, summary in report["tables"].items()}
+            # A query that couldn't be sampled ran with EXPLAIN ANALYZE after all
+            history.record(report["query"], report["plan"], tables, database,
+                           analyzed or "approximation_unavailable" in report)
+        yield report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze a SQL workload without the GUI")
+    parser.add_argument("workload", help="file of SQL queries separated by semicolons, - for stdin")
+    parser.add_argument("--host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--dbname", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--mode", choices=("thread", "process"), default="thread",
+                        help="share a connection pool between threads or run one process per worker")
+    parser.add_argument("--format", choices=("ndjson", "json"), default="ndjson")
+    parser.add_argument("--estimate-only", action="store_true", help="plan only, don't execute the queries")
+    parser.add_argument("--approximate", type=float, metavar="SECONDS",
+                        help="sample the accessed blocks for up to SECONDS per query instead of reading them all")
+    parser.add_argument("--spill-dir", help="spill tables over the memory limit to this directory "
+                                            "instead of cutting them short")
+    parser.add_argument("--memory-limit-mb", type=int, default=MAX_CTID_MEMORY_MB, metavar="MB",
+                        help="client memory for one table's ctids before it spills or is cut short, 0 for no limit")
+    parser.add_argument("-o", "--output", default="-", help="report file, - for stdout")
+    parser.add_argument("--history", metavar="PATH", help="also record every plan in this plan history file")
+    args = parser.parse_args(argv)
+
+    if args.workload == "-":
+        queries = split_statements(sys.stdin.read())
+    else:
+        with open(args.workload) as workload:
+            queries = split_statements(workload.read())
+
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    connection_details = (args.host, args.dbname, args.user, args.password)
+    history = PlanHistory(args.history) if args.history else None
+    start = time.perf_counter()
+    failed = 0
+    try:
+        reports = run_workload(queries, connection_details, args.workers, args.mode, args.estimate_only,
+                               args.approximate, args.spill_dir, args.memory_limit_mb)
+        if history is not None:
+            analyzed = not args.estimate_only and args.approximate is None
+            reports = record_history(history, reports, f"{args.host}/{args.dbname}", analyzed)
+        if args.format == "json":
+            reports = sorted(reports, key=lambda report: report["index"])
+            failed = sum("error" in report for report in reports)
+            json.dump(reports, output, default=str, indent=2)
+            output.write("\n")
+        else:
+            for report in reports:
+                failed += "error" in report
+                output.write(json.dumps(report, default=str) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if history is not None:
+            history.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{len(queries)} queries, {failed} failed, {elapsed:.2f} s "
+          f"({len(queries) / elapsed if elapsed else 0:.1f} queries/s with {args.workers} {args.mode} workers)",
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import psycopg2.extensions
+
+from blocks import OFFSET_BITS, BlockIndex, BlockRuns, filter_blocks, parse_ctid_text
+from connection_pool import close_pool, init_pool
+from explore import (PIPE_CHUNK_BYTES, analyze_query, convert_query_to_ctid_query, get_execution_plan,
+                     get_table_names, invalidate_plan_cache, invalidate_schema_catalog)
+from plan_history import table_summaries
+from plan_tree import get_plan_layout, layout_cache
+from sql_rewriter import rewrite_query, split_statements
+
+# Committed with the code, stored by --save-baseline. Timings only compare on the
+# machine that stored them, so store new ones after a hardware or intended speed change
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+# A benchmark slower than its baseline by more than this fraction fails the run
+REGRESSION_THRESHOLD = 0.25
+# Slowdowns smaller than this are timer noise, never a regression
+NOISE_FLOOR_SECONDS = 0.0005
+# Runs of each benchmark: at least SAMPLES, more until fast ones have run for
+# MIN_SAMPLE_SECONDS, fewer once slow ones have taken longer than the budget
+SAMPLES = 5
+MAX_SAMPLES = 100
+MIN_SAMPLE_SECONDS = 0.5
+SAMPLE_BUDGET_SECONDS = 3.0
+
+# Input sizes of each suite, --quick drops the largest
+QUERY_LINES = (100, 1000, 10000)
+PLAN_NODES = (10, 100, 1000, 10000)
+CTID_COUNTS = (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+END_TO_END_CTIDS = (10 ** 4, 10 ** 5, 10 ** 6)
+# Text ctids are only generated up to this many, the bigger inputs start from keys
+CTID_TEXT_LIMIT = 10 ** 6
+# Keys per add_keys call, about the ctids of one COPY chunk
+CTID_BATCH = 90000
+# Cells of the block heatmap
+HEATMAP_CELLS = 128 * 24
+# Nodes of the plans the stand-in database returns
+STAND_IN_PLAN_NODES = 200
+
+END_TO_END_QUERY = """
+SELECT c.c_name, o.o_totalprice, l.l_quantity
+FROM customer c
+JOIN orders o ON o.o_custkey = c.c_custkey
+JOIN lineitem l ON l.l_orderkey = o.o_orderkey
+WHERE c.c_acctbal > 0
+"""
+
+
+def generate_query(lines):
+    # UNION ALL of joins with aliases, a CTE, subqueries and comments, about one clause per line
+    parts = ["WITH recent AS (", "  SELECT * FROM orders WHERE o_orderdate > DATE '1998-01-01'", ")"]
+    branch = 0
+    while len(parts) < lines:
+        if branch:
+            parts.append("UNION ALL")
+        parts.extend([
+            f"-- branch {branch}",
+            f"SELECT c{branch}.c_name, n{branch}.n_name, r{branch}.o_totalprice",
+            f"FROM customer c{branch}",
+            f"JOIN nation n{branch} ON c{branch}.c_nationkey = n{branch}.n_nationkey",
+            f"JOIN recent r{branch} ON r{branch}.o_custkey = c{branch}.c_custkey",
+            f"WHERE c{branch}.c_acctbal > {branch} /* from lineitem */",
+            f"  AND EXISTS (SELECT 1 FROM lineitem l WHERE l.l_orderkey = r{branch}.o_orderkey)",
+        ])
+        branch += 1
+    return "\n".join(parts)
+
+
+def generate_plan(node_count, analyzed=True):
+    # Binary tree in heap order, joins inside and scans at the leaves. Costs, times, rows
+    # and buffers add up from the leaves the way EXPLAIN ANALYZE reports them, and every
+    # ninth node is misestimated.
+    plans = []
+    for i in range(node_count):
+        children = [child for child in (2 * i + 1, 2 * i + 2) if child < node_count]
+        if children:
+            plan = {"Node Type": ("Hash Join", "Nested Loop", "Sort")[i % 3 if len(children) == 2 else 2]}
+        elif i % 3:
+            plan = {"Node Type": "Seq Scan", "Relation Name": f"table_{i % 50}", "Alias": f"t{i}"}
+        else:
+            plan = {"Node Type": "Index Scan", "Index Name": f"table_{i % 50}_pkey",
+                    "Relation Name": f"table_{i % 50}", "Alias": f"t{i}"}
+        plan["children"] = children
+        plans.append(plan)
+    for i in reversed(range(node_count)):  # children before parents
+        plan = plans[i]
+        children = [plans[child] for child in plan.pop("children")]
+        rows = 1000 + i % 13 * 100
+        plan.update({
+            "Startup Cost": 0.0,
+            "Total Cost": sum(child["Total Cost"] for child in children) + 50.0 + i % 7 * 5,
+            "Plan Rows": rows,
+            "Plan Width": 32,
+        })
+        if analyzed:
+            plan.update({
+                "Actual Startup Time": 0.01,
+                "Actual Total Time": sum(child["Actual Total Time"] for child in children) + 0.1 + i % 11 * 0.05,
+                "Actual Rows": rows * (20 if i % 9 == 0 else 1),
+                "Actual Loops": 1,
+                "Shared Hit Blocks": sum(child["Shared Hit Blocks"] for child in children) + i % 5 * 10,
+                "Shared Read Blocks": sum(child["Shared Read Blocks"] for child in children) + i % 3,
+            })
+        if children:
+            plan["Plans"] = children
+    return plans[0]
+
+
+def generate_ctid_keys(count, seed=0):
+    # About ten tuples of each accessed block, in the shuffled order a hash join returns them
+    rng = np.random.default_rng(seed)
+    relation_blocks = max(1, count // 5)
+    blocks = rng.integers(0, relation_blocks // 2 + 1, count, dtype=np.uint64)
+    offsets = rng.integers(1, 200, count, dtype=np.uint64)
+    return (blocks << OFFSET_BITS) | offsets, relation_blocks
+
+
+def ctid_text(keys):
+    # The keys as the '(block,offset)' lines of a COPY
+    mask = (1 << OFFSET_BITS) - 1
+    return "".join(f"({key >> OFFSET_BITS},{key & mask})\n" for key in keys.tolist())
+
+
+def measure(function, setup=None, samples=SAMPLES, number=1):
+    # Best of several runs, the one least disturbed by the rest of the machine, per call.
+    # setup runs before every run and isn't timed. Like timeit, the garbage collector is
+    # off while timing, so one run doesn't pay for collecting the garbage of the others.
+    best = None
+    spent = 0.0
+    for sample in range(1, MAX_SAMPLES + 1):
+        if setup is not None:
+            setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+        spent += elapsed
+        if spent > SAMPLE_BUDGET_SECONDS or (sample >= samples and spent >= MIN_SAMPLE_SECONDS):
+            break
+    return best / number
+
+
+class StandInCursor:
+    """Answers the statements of explore.py without a server: every relation exists,
+    EXPLAIN returns the synthetic plan and COPY sends the synthetic ctids."""
+
+    def __init__(self, conn):
+        self.connection = conn
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, parameters=None):
+        conn = self.connection
+        if "FROM unnest(" in sql:
+            # The schema catalog lookup
+            self._rows = [(name, 16384 + i, "public", name, f"public.{name}", "r", ["c_custkey", "c_name"],
+                           conn.relation_blocks) for i, name in enumerate(parameters[0])]
+        elif sql.startswith("EXPLAIN"):
+            self._rows = [([{"Plan": conn.plan, "Planning Time": 0.1, "Execution Time": 1.0}],)]
+        else:
+            self._rows = []
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def copy_expert(self, sql, file):
+        data = self.connection.ctid_data
+        for start in range(0, len(data), PIPE_CHUNK_BYTES):
+            file.write(data[start:start + PIPE_CHUNK_BYTES])
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    """The parts of a psycopg2 connection the pool and explore.py use."""
+
+    def __init__(self, plan, ctid_data, relation_blocks, **details):
+        self.plan = plan
+        self.ctid_data = ctid_data
+        self.relation_blocks = relation_blocks
+        self.closed = 0
+        self.autocommit = True
+        self.info = argparse.Namespace(host=details.get("host"), port=5432, dbname=details.get("database"),
+                                       user=details.get("user"),
+                                       transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def cancel(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def stand_in_pool(plan, ctid_count):
+    # A pool whose connections are stand-ins, every table returns the same ctids
+    keys, relation_blocks = generate_ctid_keys(ctid_count)
+    ctid_data = ctid_text(keys).encode()
+
+    def connect(**details):
+        return StandInConnection(plan, ctid_data, relation_blocks, **details)
+    init_pool("stand-in", "benchmark", "benchmark", "", connect=connect)
+
+
+def clear_caches():
+    # Every run starts cold, like a query seen for the first time
+    rewrite_query.cache_clear()
+    layout_cache.invalidate()
+    invalidate_plan_cache()
+    invalidate_schema_catalog()
+
+
+def analyze_and_lay_out(query):
+    # What the query worker does for one query, without the GUI
+    plan, results = analyze_query(query)
+    get_plan_layout(plan)
+    table_summaries(results)
+
+
+def bench_rewriter(sizes):
+    for lines in sizes:
+        query = generate_query(lines)
+        clear = rewrite_query.cache_clear
+        yield f"rewrite_query {lines} lines", measure(lambda: rewrite_query(query), clear)
+        yield f"get_table_names {lines} lines", measure(lambda: get_table_names(query), clear)
+        yield f"convert_query_to_ctid_query {lines} lines", measure(lambda: convert_query_to_ctid_query(query), clear)
+        yield f"rewrite_query {lines} lines memoized", measure(lambda: rewrite_query(query), number=1000)
+
+
+def bench_plans(sizes):
+    # The plan tree and graph of the real window, drawn offscreen unless a display is asked for,
+    # without a plan history so the user's own isn't written to
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from interface import SQLQueryApp
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    window = SQLQueryApp(history_path=None)
+    for nodes in sizes:
+        plan = generate_plan(nodes)
+        yield f"plan layout {nodes} nodes", measure(lambda: get_plan_layout(plan), layout_cache.invalidate)
+        layout = get_plan_layout(plan)
+        yield f"plan tree {nodes} nodes", measure(lambda: window.displayExecutionPlan(layout))
+        yield f"plan graph {nodes} nodes", measure(lambda: window.drawPlanGraph(layout))
+        app.processEvents()
+
+
+def bench_blocks(sizes):
+    for count in sizes:
+        keys, relation_blocks = generate_ctid_keys(count)
+        if count <= CTID_TEXT_LIMIT:
+            text = ctid_text(keys)
+            yield f"parse_ctid_text {count} ctids", measure(lambda: parse_ctid_text(text))
+
+        def build():
+            index = BlockIndex(relation_blocks=relation_blocks)
+            for start in range(0, count, CTID_BATCH):
+                index.add_keys(keys[start:start + CTID_BATCH])
+            index.finish()
+            return index
+        yield f"block index {count} ctids", measure(build)
+        blocks = build().blocks()
+        yield f"block runs and heatmap {count} ctids", measure(
+            lambda: BlockRuns.from_blocks(blocks).heatmap(relation_blocks, HEATMAP_CELLS))
+        yield f"block filter {count} ctids", measure(lambda: filter_blocks(blocks, "10-200, 512, 900-"))
+
+
+def bench_end_to_end(sizes):
+    plan = generate_plan(STAND_IN_PLAN_NODES)
+    try:
+        for count in sizes:
+            stand_in_pool(plan, count)
+            yield f"analyze_query {count} ctids per table", measure(
+                lambda: analyze_and_lay_out(END_TO_END_QUERY), clear_caches)
+        yield f"estimate plan {STAND_IN_PLAN_NODES} nodes", measure(
+            lambda: get_plan_layout(get_execution_plan(END_TO_END_QUERY, analyze=False)), clear_caches)
+    finally:
+        close_pool()
+
+
+def bench_postgres(queries, connection_details):
+    # Against a real database, only comparable with baselines of the same database and data
+    init_pool(*connection_details)
+    try:
+        for position, query in enumerate(queries):
+            try:
+                yield f"postgres query {position}", measure(lambda: analyze_and_lay_out(query), clear_caches)
+            except RuntimeError as e:
+                print(f"postgres query {position} skipped: {e}", file=sys.stderr)
+    finally:
+        close_pool()
+
+
+def load_baseline(path):
+    try:
+        with open(path) as baseline_file:
+            return json.load(baseline_file)
+    except FileNotFoundError:
+        return {"results": {}}
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def environment_differences(baseline):
+    # Baselines only compare with runs on the same machine and versions
+    return [f"{key} {baseline[key]!r}, this run has {value!r}" for key, value in environment().items()
+            if key in baseline and baseline[key] != value]
+
+
+def save_baseline(path, baseline, results):
+    # Only the benchmarks of this run are replaced, the other suites keep their baselines
+    baseline["results"].update(results)
+    baseline.update(environment(), saved_at=time.time())
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def is_regression(seconds, baseline_seconds, threshold):
+    return seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > NOISE_FLOOR_SECONDS
+
+
+def main(argv=None):
+    suites = {
+        "rewriter": (bench_rewriter, QUERY_LINES),
+        "plans": (bench_plans, PLAN_NODES),
+        "blocks": (bench_blocks, CTID_COUNTS),
+        "end-to-end": (bench_end_to_end, END_TO_END_CTIDS),
+    }
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on generated queries, plans and ctids, "
+                                                 "and compare them with stored baselines",
+                                     epilog="Timings depend on the machine, Python and numpy. The committed baselines "
+                                            "were recorded with requirements.txt on one machine. On any other machine, "
+                                            "first run --save-baseline on the unchanged code, then compare the "
+                                            "change against those local baselines.")
+    parser.add_argument("--suite", nargs="+", choices=list(suites), default=list(suites))
+    parser.add_argument("--quick", action="store_true", help="skip the largest input of every suite")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="baseline file, JSON")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run's timings as the baseline instead of comparing with it")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="fail when a benchmark is slower than its baseline by more than this fraction")
+    parser.add_argument("--workload", help="with --host, also time every query of this file against that database")
+    parser.add_argument("--host")
+    parser.add_argument("--dbname", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("PGPASSWORD", ""))
+    args = parser.parse_args(argv)
+    if bool(args.host) != bool(args.workload):
+        parser.error("--host and --workload go together")
+
+    runs = []
+    for name in args.suite:
+        function, sizes = suites[name]
+        runs.append(function(sizes[:-1] if args.quick else sizes))
+    if args.host:
+        with open(args.workload) as workload:
+            queries = split_statements(workload.read())
+        runs.append(bench_postgres(queries, (args.host, args.dbname, args.user, args.password)))
+
+    baseline = load_baseline(args.baseline)
+    if not args.save_baseline:
+        for difference in environment_differences(baseline):
+            print(f"Baselines recorded with {difference}, regenerate them here with --save-baseline "
+                  f"before trusting the comparison", file=sys.stderr)
+    results = {}
+    regressions = []
+    for run in runs:
+        for name, seconds in run:
+            results[name] = seconds
+            line = f"{name:<48} {seconds * 1000:14.4f} ms"
+            baseline_seconds = baseline["results"].get(name)
+            if baseline_seconds is not None and not args.save_baseline:
+                line += f"  {seconds / baseline_seconds:6.2f}x baseline"
+                if is_regression(seconds, baseline_seconds, args.threshold):
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line, flush=True)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, baseline, results)
+        print(f"Saved {len(results)} baselines to {args.baseline}", file=sys.stderr)
+        return 0
+    if not baseline["results"]:
+        # Without baselines nothing could regress, which must not pass as a clean run
+        print(f"No baselines in {args.baseline}, store them with --save-baseline", file=sys.stderr)
+        return 1
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}: "
+              f"{', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
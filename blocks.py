@@ -0,0 +1,517 @@
+import json
+import math
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Offsets are at most MaxHeapTuplesPerPage, so a ctid packs into one integer key
+OFFSET_BITS = 16
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+# Consecutive blocks sampled together in approximate mode
+SAMPLE_WINDOW_BLOCKS = 32
+# Normal quantile of the estimates' confidence intervals, 95%
+CONFIDENCE_Z = 1.96
+# Keys taken from each spilled run per merge step, and written per step when saving
+MERGE_PIECE_KEYS = 1 << 20
+
+BlockEstimate = namedtuple("BlockEstimate", "blocks blocks_low blocks_high tuples tuples_low tuples_high "
+                                            "sampled_blocks relation_blocks exact")
+
+_ctid_separators = str.maketrans("(),", "   ")
+
+
+def parse_ctid(ctid):
+    block, offset = ctid[1:-1].split(',')
+    return int(block), int(offset)
+
+
+def parse_ctids(ctids):
+    # Decode a whole batch of '(block,offset)' strings in one pass
+    if not ctids:
+        return np.empty(0, dtype=np.uint64)
+    return parse_ctid_text(" ".join(ctids))
+
+
+def parse_ctid_text(text):
+    # Same for ctids already joined into one string, e.g. the lines of a COPY
+    values = np.fromstring(text.translate(_ctid_separators), dtype=np.uint64, sep=" ")
+    return (values[0::2] << OFFSET_BITS) | values[1::2]
+
+
+def sorted_unique(values):
+    # Sort-based unique, np.unique can fall back to much slower hashing for uint64
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    keep = np.empty(len(values), dtype=bool)
+    keep[0] = True
+    np.not_equal(values[1:], values[:-1], out=keep[1:])
+    return values[keep]
+
+
+def filter_blocks(blocks, text):
+    # Keep the blocks matching a filter like "10-200, 512, 900-"
+    text = text.strip()
+    if not text:
+        return blocks
+    keep = np.zeros(len(blocks), dtype=bool)
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, dash, high = part.partition("-")
+        try:
+            low = int(low) if low.strip() else 0
+            high = int(high) if high.strip() else None
+        except ValueError:
+            raise ValueError(f"Invalid block filter: {part!r}")
+        if not dash:
+            keep |= blocks == low
+        elif high is None:
+            keep |= blocks >= low
+        else:
+            keep |= (blocks >= low) & (blocks <= high)
+    return blocks[keep]
+
+
+def block_runs(runs):
+    # BlockRuns as [start, end] runs of consecutive blocks, both ends included
+    return np.column_stack((runs.starts, runs.ends - 1)).tolist()
+
+
+class BlockRuns:
+    """Set of block numbers stored as sorted half-open [start, end) runs.
+
+    Size and set operations depend on the number of runs, not on the number of
+    blocks, so clustered access over relations with millions of blocks stays cheap."""
+
+    def __init__(self, starts=None, ends=None):
+        self.starts = np.empty(0, dtype=np.int64) if starts is None else starts
+        self.ends = np.empty(0, dtype=np.int64) if ends is None else ends
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        # blocks must be sorted and unique
+        blocks = np.asarray(blocks).astype(np.int64)
+        if len(blocks) == 0:
+            return cls()
+        breaks = np.flatnonzero(np.diff(blocks) != 1) + 1
+        starts = blocks[np.concatenate(([0], breaks))]
+        ends = blocks[np.concatenate((breaks - 1, [len(blocks) - 1]))] + 1
+        return cls(starts, ends)
+
+    def _combine(self, other, coverage):
+        # Sweep over run boundaries, keeping the stretches covered by at least `coverage` sets
+        positions = np.concatenate((self.starts, self.ends, other.starts, other.ends))
+        deltas = np.concatenate((np.ones(len(self.starts), dtype=np.int64), -np.ones(len(self.ends), dtype=np.int64),
+                                 np.ones(len(other.starts), dtype=np.int64), -np.ones(len(other.ends), dtype=np.int64)))
+        if len(positions) == 0:
+            return BlockRuns()
+        # Ends sort before starts at the same block, runs that only touch don't overlap
+        order = np.lexsort((deltas, positions))
+        positions = positions[order]
+        covered = np.cumsum(deltas[order])[:-1] >= coverage
+        starts, ends = positions[:-1][covered], positions[1:][covered]
+        keep = starts < ends
+        return BlockRuns(starts[keep], ends[keep])._merge_adjacent()
+
+    def _merge_adjacent(self):
+        if len(self.starts) < 2:
+            return self
+        new_run = np.concatenate(([True], self.starts[1:] != self.ends[:-1]))
+        last = np.concatenate((np.flatnonzero(new_run)[1:] - 1, [len(self.ends) - 1]))
+        return BlockRuns(self.starts[new_run], self.ends[last])
+
+    def union(self, other):
+        # Both sides are sorted, so a stable sort of their starts is a linear merge, and a
+        # run joins the one before while it starts no later than everything before it ends
+        if len(other.starts) == 0:
+            return self
+        if len(self.starts) == 0:
+            return other
+        order = np.argsort(np.concatenate((self.starts, other.starts)), kind='stable')
+        starts = np.concatenate((self.starts, other.starts))[order]
+        reach = np.maximum.accumulate(np.concatenate((self.ends, other.ends))[order])
+        new_run = np.concatenate(([True], starts[1:] > reach[:-1]))
+        last = np.concatenate((np.flatnonzero(new_run)[1:] - 1, [len(starts) - 1]))
+        return BlockRuns(starts[new_run], reach[last])
+
+    def intersection(self, other):
+        return self._combine(other, 2)
+
+    def count_below(self, blocks):
+        # Number of blocks in the set that are smaller than each of the given blocks
+        blocks = np.asarray(blocks, dtype=np.int64)
+        before = np.concatenate(([0], np.cumsum(self.ends - self.starts)))
+        started = np.searchsorted(self.starts, blocks)
+        # The last run starting before a block may still extend past it
+        overhang = np.clip(np.concatenate(([0], self.ends))[started] - blocks, 0, None)
+        return before[started] - overhang
+
+    def heatmap(self, relation_blocks, bins):
+        # Fraction of every bin of the relation that is in the set, bins cover equal block ranges
+        total = max(int(relation_blocks), int(self.ends[-1]) if len(self.ends) else 0, 1)
+        edges = np.linspace(0, total, bins + 1).round().astype(np.int64)
+        touched = np.diff(self.count_below(edges))
+        sizes = np.diff(edges)
+        return np.divide(touched, sizes, out=np.zeros(bins), where=sizes > 0)
+
+    def contains(self, blocks):
+        # Membership of every one of the given blocks, as a boolean array
+        blocks = np.asarray(blocks, dtype=np.int64)
+        i = np.searchsorted(self.ends, blocks, side='right')
+        inside = i < len(self.starts)
+        inside[inside] = self.starts[i[inside]] <= blocks[inside]
+        return inside
+
+    def blocks(self):
+        # Every block of the set as a sorted array, 8 bytes a block, so only for display
+        lengths = self.ends - self.starts
+        first_position = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return (np.repeat(self.starts - first_position, lengths) + np.arange(lengths.sum())).astype(np.uint64)
+
+    def run_count(self):
+        return len(self.starts)
+
+    def __contains__(self, block):
+        i = np.searchsorted(self.ends, block, side='right')
+        return bool(i < len(self.starts) and self.starts[i] <= block)
+
+    def __len__(self):
+        return int((self.ends - self.starts).sum())
+
+
+def wilson_interval(hits, trials, z=CONFIDENCE_Z):
+    # Interval of a proportion that stays sensible with few or no hits
+    if trials == 0:
+        return 0.0, 1.0
+    p = hits / trials
+    denominator = 1 + z * z / trials
+    centre = (p + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(centre - margin, 0.0), min(centre + margin, 1.0)
+
+
+class BlockSample:
+    """Random windows of a relation whose accessed blocks were read exactly.
+
+    Windows are drawn without replacement, so once all of them are in the
+    estimate is the exact count. Until then the totals are scaled up from the
+    windows, with a confidence interval from the spread between windows."""
+
+    def __init__(self, relation_blocks, window_blocks=SAMPLE_WINDOW_BLOCKS, seed=None):
+        self.relation_blocks = relation_blocks
+        self.window_blocks = window_blocks
+        self.window_count = max(1, math.ceil(relation_blocks / window_blocks))
+        self._order = np.random.default_rng(seed).permutation(self.window_count)
+        self._drawn = 0
+        self._lock = threading.Lock()
+        self._block_hits = []
+        self._tuple_hits = []
+        self._sampled = BlockRuns()
+
+    def next_windows(self, count):
+        # [first, end) block ranges not sampled yet, end is None for the last window
+        # so blocks added after the relation size was read are still counted
+        windows = []
+        for window in self._order[self._drawn:self._drawn + count].tolist():
+            first = window * self.window_blocks
+            windows.append((first, None if window == self.window_count - 1 else first + self.window_blocks))
+        self._drawn += len(windows)
+        return windows
+
+    def remaining(self):
+        return self.window_count - self._drawn
+
+    def add(self, window, blocks, tuples):
+        # Result of one window: how many of its blocks and tuples the query accessed
+        first, end = window
+        end = max(self.relation_blocks, first + 1) if end is None else end
+        with self._lock:
+            self._block_hits.append(blocks)
+            self._tuple_hits.append(tuples)
+            window_runs = BlockRuns(np.array([first], dtype=np.int64), np.array([end], dtype=np.int64))
+            self._sampled = self._sampled.union(window_runs)
+
+    def sampled_runs(self):
+        with self._lock:
+            return self._sampled
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "relation_blocks": self.relation_blocks,
+                "window_blocks": self.window_blocks,
+                "order": self._order.tolist(),
+                "drawn": self._drawn,
+                "block_hits": self._block_hits,
+                "tuple_hits": self._tuple_hits,
+                "sampled": [self._sampled.starts.tolist(), self._sampled.ends.tolist()],
+            }
+
+    @classmethod
+    def from_dict(cls, state):
+        sample = cls(state["relation_blocks"], state["window_blocks"])
+        sample._order = np.array(state["order"], dtype=np.int64)
+        sample._drawn = state["drawn"]
+        sample._block_hits = state["block_hits"]
+        sample._tuple_hits = state["tuple_hits"]
+        starts, ends = state["sampled"]
+        sample._sampled = BlockRuns(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+        return sample
+
+    def estimate(self, z=CONFIDENCE_Z):
+        with self._lock:
+            block_hits = np.array(self._block_hits, dtype=np.float64)
+            tuple_hits = np.array(self._tuple_hits, dtype=np.float64)
+            sampled_blocks = len(self._sampled)
+        sampled = len(block_hits)
+        exact = sampled == self.window_count
+        unsampled_blocks = max(self.relation_blocks - sampled_blocks, 0)
+        blocks = _scaled_total(block_hits, self.window_count, z)
+        tuples = _scaled_total(tuple_hits, self.window_count, z)
+        seen_blocks, seen_tuples = block_hits.sum(), tuple_hits.sum()
+        if exact:
+            blocks = (seen_blocks, seen_blocks, seen_blocks)
+            tuples = (seen_tuples, seen_tuples, seen_tuples)
+        else:
+            # Windows of a clustered access can all look alike, the interval is widened to
+            # at least the one of a block-by-block sample of the same size
+            low, high = wilson_interval(seen_blocks, sampled_blocks, z)
+            blocks = (blocks[0], min(blocks[1], seen_blocks + low * unsampled_blocks),
+                      max(blocks[2], seen_blocks + high * unsampled_blocks))
+            # Nothing sampled can be missing, nothing unsampled can be in the sample
+            blocks = tuple(min(max(value, seen_blocks), seen_blocks + unsampled_blocks) for value in blocks)
+            tuples = tuple(max(value, seen_tuples) for value in tuples)
+        # Tuples have no upper bound until two windows are in
+        tuples = tuple(round(value) if math.isfinite(value) else None for value in tuples)
+        return BlockEstimate(*(round(value) for value in blocks), *tuples, sampled_blocks, self.relation_blocks, exact)
+
+
+def _scaled_total(hits, window_count, z):
+    # Total over all windows from a simple random sample of them, with its interval
+    sampled = len(hits)
+    if sampled == 0:
+        return 0.0, 0.0, float("inf")
+    total = window_count * hits.mean()
+    if sampled < 2:
+        return total, 0.0, float("inf")
+    variance = window_count ** 2 * (1 - sampled / window_count) * hits.var(ddof=1) / sampled
+    # Student t quantile for the few windows of the first rounds, by its expansion around z
+    df = sampled - 1
+    t = z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+    margin = t * math.sqrt(max(variance, 0.0))
+    return total, max(total - margin, 0.0), total + margin
+
+
+class BlockIndex:
+    """Accessed blocks of one table, built incrementally from ctid batches.
+
+    Only the ctids are kept, packed as sorted block/offset keys, so a block's tuples
+    are a range of the key array found by binary search. The accessed blocks are
+    kept as BlockRuns, a sequential scan is one run however many blocks it read.
+    With a spill directory the keys go to disk as sorted runs once the memory
+    limit is reached, and finish() merges them into one memory-mapped file."""
+
+    def __init__(self, memory_limit_bytes=None, relation_blocks=None, spill_dir=None):
+        self.memory_limit_bytes = memory_limit_bytes
+        self.spill_dir = spill_dir
+        # Size of the whole relation in blocks, when the database reported it
+        self.relation_blocks = relation_blocks
+        self.truncated = False
+        # Why reading this table's ctids stopped early, None when it completed
+        self.error = None
+        # BlockSample in approximate mode, the index then only holds the sampled windows
+        self.sample = None
+        # ctids received, exact once finish() has merged batches that overlapped
+        self.count = 0
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._runs = BlockRuns()  # every block seen so far, spilled or not
+        self._spilled = []  # files of sorted keys not merged yet
+
+    def add_ctids(self, ctids):
+        # Returns the blocks seen for the first time in this batch
+        return self.add_keys(parse_ctids(ctids))
+
+    def add_keys(self, keys):
+        # Batches may repeat ctids when the database didn't deduplicate them
+        keys = sorted_unique(keys)
+        batch_blocks = sorted_unique(keys >> OFFSET_BITS)
+        with self._lock:
+            new_blocks = batch_blocks[~self._runs.contains(batch_blocks)]
+            if len(new_blocks):
+                self._runs = self._runs.union(BlockRuns.from_blocks(new_blocks))
+            self._chunks.append(keys)
+            self.count += len(keys)
+        if self.memory_limit_bytes is not None and self.memory_bytes() > self.memory_limit_bytes:
+            if self.spill_dir is None:
+                self.truncated = True
+            else:
+                with self._lock:
+                    self._spill()
+        return new_blocks
+
+    def _spill(self):
+        # Writes the keys held in memory as one more sorted run, under the lock
+        keys = sorted_unique(np.concatenate([self._keys] + self._chunks))
+        self._chunks = []
+        self._keys = np.empty(0, dtype=np.uint64)
+        if len(keys):
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = os.path.join(self.spill_dir, f"run-{len(self._spilled)}.u64")
+            keys.tofile(path)
+            self._spilled.append(path)
+
+    def _merge_spilled(self):
+        # k-way merge of the sorted runs in pieces that end on a block boundary, so memory
+        # stays at a piece per run and every key of a piece sorts before the next piece
+        runs = [np.memmap(path, dtype=np.uint64, mode="r") for path in self._spilled]
+        positions = [0] * len(runs)
+        written = 0
+        path = os.path.join(self.spill_dir, "keys.u64")
+        with open(path, "wb") as output:
+            while any(position < len(run) for run, position in zip(runs, positions)):
+                limits = [int(run[position + MERGE_PIECE_KEYS]) for run, position in zip(runs, positions)
+                          if position + MERGE_PIECE_KEYS < len(run)]
+                # Up to the first block that starts after the piece of the shortest run
+                upper = ((min(limits) >> OFFSET_BITS) + 1) << OFFSET_BITS if limits else None
+                pieces = []
+                for i, run in enumerate(runs):
+                    end = len(run) if upper is None else int(np.searchsorted(run, np.uint64(upper)))
+                    pieces.append(np.asarray(run[positions[i]:end]))
+                    positions[i] = max(end, positions[i])
+                keys = sorted_unique(np.concatenate(pieces))
+                keys.tofile(output)
+                written += len(keys)
+        del runs
+        for run_path in self._spilled:
+            os.remove(run_path)
+        self._spilled = []
+        self._keys = np.memmap(path, dtype=np.uint64, mode="r") if written else np.empty(0, dtype=np.uint64)
+
+    def _group(self):
+        # Sort whatever arrived since the last call into the keys, under the lock
+        if not self._chunks:
+            return
+        self._keys = sorted_unique(np.concatenate([self._keys] + self._chunks))
+        self._chunks = []
+
+    def finish(self):
+        # Called once every batch is in
+        with self._lock:
+            if self._spilled:
+                self._spill()
+            if self._spilled:
+                self._merge_spilled()
+            else:
+                self._group()
+            self.count = len(self._keys)
+
+    def save(self, directory):
+        # Fixed-width key and run arrays plus a small JSON header, opened again
+        # with BlockIndex.open() without reading the keys into memory
+        self.finish()
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            keys, runs = self._keys, self._runs
+        path = os.path.join(directory, "keys.u64")
+        # An index opened from this directory already has its keys there
+        if not (isinstance(keys, np.memmap) and os.path.exists(path) and os.path.samefile(keys.filename, path)):
+            with open(path, "wb") as output:
+                for start in range(0, len(keys), MERGE_PIECE_KEYS):
+                    np.asarray(keys[start:start + MERGE_PIECE_KEYS]).tofile(output)
+        runs.starts.tofile(os.path.join(directory, "run_starts.i64"))
+        runs.ends.tofile(os.path.join(directory, "run_ends.i64"))
+        header = {
+            "relation_blocks": self.relation_blocks,
+            "truncated": self.truncated,
+            "error": self.error,
+            "count": self.count,
+            "sample": self.sample.to_dict() if self.sample is not None else None,
+        }
+        with open(os.path.join(directory, "index.json"), "w") as header_file:
+            json.dump(header, header_file)
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, "index.json")) as header_file:
+            header = json.load(header_file)
+        index = cls(relation_blocks=header["relation_blocks"])
+        index.truncated = header["truncated"]
+        index.error = header["error"]
+        index.count = header["count"]
+        if header["sample"] is not None:
+            index.sample = BlockSample.from_dict(header["sample"])
+        if header["count"]:
+            index._keys = np.memmap(os.path.join(directory, "keys.u64"), dtype=np.uint64, mode="r")
+            if os.path.exists(os.path.join(directory, "run_starts.i64")):
+                index._runs = BlockRuns(np.fromfile(os.path.join(directory, "run_starts.i64"), dtype=np.int64),
+                                        np.fromfile(os.path.join(directory, "run_ends.i64"), dtype=np.int64))
+            else:
+                # Saved before the runs were, with one entry per block
+                index._runs = BlockRuns.from_blocks(np.fromfile(os.path.join(directory, "blocks.u64"),
+                                                                dtype=np.uint64))
+        return index
+
+    def memory_bytes(self):
+        with self._lock:
+            pending = sum(chunk.nbytes for chunk in self._chunks)
+            return pending + self._keys.nbytes + self._runs.starts.nbytes + self._runs.ends.nbytes
+
+    def blocks(self):
+        # Materialised from the runs, for the block list
+        with self._lock:
+            runs = self._runs
+        return runs.blocks()
+
+    def runs(self):
+        # Never changed in place, a batch with new blocks replaces it
+        with self._lock:
+            return self._runs
+
+    def fraction_touched(self):
+        if not self.relation_blocks:
+            return None
+        return min(len(self) / self.relation_blocks, 1.0)
+
+    def block_range(self, block):
+        # Positions of the block's ctids in keys()
+        with self._lock:
+            self._group()
+            first = np.uint64(int(block) << OFFSET_BITS)
+            end = np.uint64((int(block) + 1) << OFFSET_BITS)
+            return int(np.searchsorted(self._keys, first)), int(np.searchsorted(self._keys, end))
+
+    def keys(self):
+        with self._lock:
+            self._group()
+            return self._keys
+
+    def offsets(self, block):
+        # Runs spilled while the table still streams are searched too, until finish()
+        # has merged them into the keys
+        first = np.uint64(int(block) << OFFSET_BITS)
+        end = np.uint64((int(block) + 1) << OFFSET_BITS)
+        with self._lock:
+            self._group()
+            parts = [np.asarray(self._keys[np.searchsorted(self._keys, first):np.searchsorted(self._keys, end)])]
+            for path in self._spilled:
+                run = np.memmap(path, dtype=np.uint64, mode="r")
+                parts.append(np.asarray(run[np.searchsorted(run, first):np.searchsorted(run, end)]))
+        keys = sorted_unique(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+        return keys & OFFSET_MASK
+
+    def ctids(self, block):
+        return [f"({block},{offset})" for offset in self.offsets(block).tolist()]
+
+    def __contains__(self, block):
+        with self._lock:
+            return block in self._runs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._runs)
@@ -0,0 +1,87 @@
+import threading
+from collections import namedtuple
+
+from tracing import DATABASE, span
+
+# Relation kinds whose rows have no physical ctid: views and foreign tables
+NO_CTID_KINDS = ("v", "f")
+
+Relation = namedtuple("Relation", "name oid schema relname qualified_name kind columns blocks")
+
+# Resolves names the way the query itself would (search_path, quoting) through to_regclass,
+# and reads the columns straight from pg_attribute for all the names in one round trip
+_relations_query = """
+SELECT r.name, c.oid, n.nspname, c.relname, format('%%I.%%I', n.nspname, c.relname), c.relkind,
+       coalesce(array_agg(a.attname::text ORDER BY a.attnum) FILTER (WHERE a.attnum IS NOT NULL), '{}'),
+       pg_relation_size(c.oid) / current_setting('block_size')::bigint
+FROM unnest(%s::text[]) AS r(name)
+JOIN pg_class c ON c.oid = to_regclass(r.name)
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+GROUP BY r.name, c.oid, n.nspname, c.relname, c.relkind
+"""
+
+
+class SchemaCatalog:
+    """Relations the queries of this session refer to, keyed by the name used in the query."""
+
+    def __init__(self):
+        self._relations = {}
+        self._lock = threading.Lock()
+
+    def refresh(self, cursor, names):
+        # Reloads the given relations and returns the names whose definition changed
+        # since they were cached, which is how DDL between two queries is noticed
+        names = sorted(set(names))
+        if not names:
+            return set()
+        with span("schema catalog", DATABASE, rows=len(names)):
+            cursor.execute(_relations_query, (names,))
+            rows = cursor.fetchall()
+        loaded = {row[0]: Relation(*row) for row in rows}
+        changed = set()
+        with self._lock:
+            for name in names:
+                relation = loaded.get(name)
+                cached = self._relations.get(name)
+                if cached is not None and (relation is None or cached[:-1] != relation[:-1]):
+                    changed.add(name)
+                if relation is None:
+                    self._relations.pop(name, None)
+                else:
+                    self._relations[name] = relation
+        return changed
+
+    def get(self, name):
+        with self._lock:
+            return self._relations.get(name)
+
+    def lookup(self, cursor, name):
+        # Cached relation, loaded on the first use of the name
+        relation = self.get(name)
+        if relation is None:
+            self.refresh(cursor, [name])
+            relation = self.get(name)
+        return relation
+
+    def without_ctid(self, names):
+        # Known relations the rewriter must not ask a ctid of
+        with self._lock:
+            return frozenset(name for name in names
+                             if name in self._relations and self._relations[name].kind in NO_CTID_KINDS)
+
+    def invalidate(self, names=None):
+        with self._lock:
+            if names is None:
+                self._relations.clear()
+            else:
+                for name in names:
+                    self._relations.pop(name, None)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._relations
+
+    def __len__(self):
+        with self._lock:
+            return len(self._relations)
@@ -0,0 +1,48 @@
+from PyQt5.QtWidgets import QDialog, QFormLayout, QLineEdit, QPushButton, QSpinBox
+
+
+class ConfigDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Database Connection Details")
+        self.setGeometry(200, 200, 400, 200)
+
+        self.host_input = QLineEdit()
+        self.name_input = QLineEdit()
+        self.user_input = QLineEdit()
+        self.password_input = QLineEdit()
+        self.password_input.setEchoMode(QLineEdit.Password)
+        # Client memory for one table's ctids before it spills to disk, the caller sets the default
+        self.memory_limit_input = QSpinBox()
+        self.memory_limit_input.setRange(0, 1024 * 1024)
+        self.memory_limit_input.setSuffix(" MB")
+        self.memory_limit_input.setSpecialValueText("No limit")
+
+        # Confirm Button
+        confirm_button = QPushButton("Confirm")
+        confirm_button.clicked.connect(self.accept)
+
+        layout = QFormLayout(self)
+        layout.addRow("Database Host:", self.host_input)
+        layout.addRow("Database Name:", self.name_input)
+        layout.addRow("Database User:", self.user_input)
+        layout.addRow("Database Password:", self.password_input)
+        layout.addRow("Memory per Table:", self.memory_limit_input)
+        layout.addWidget(confirm_button)
+
+        # Placeholders
+        self.host_input.setPlaceholderText("Example: localhost")
+        self.name_input.setPlaceholderText("Example: TPC-H")
+        self.user_input.setPlaceholderText("Example: postgres")
+
+    def get_connection_details(self):
+        return (
+            self.host_input.text(),
+            self.name_input.text(),
+            self.user_input.text(),
+            self.password_input.text()
+        )
+
+    def get_memory_limit_mb(self):
+        # None when there is no limit
+        return self.memory_limit_input.value() or None
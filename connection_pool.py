@@ -0,0 +1,204 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from tracing import DATABASE, span
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections shared by every explore function."""
+
+    def __init__(self, host, database, user, password, max_size=5,
+                 health_check_interval=30.0, checkout_timeout=30.0, connect=None):
+        self.host = host
+        self.database = database
+        self.user = user
+        self.password = password
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        # Opens a new connection from the details above, psycopg2.connect unless given
+        self.connect = connect or psycopg2.connect
+
+        self._idle = []  # (connection, time it was returned)
+        self._size = 0  # open connections, idle or checked out
+        self._closed = False
+        self._cond = threading.Condition()
+        self._metrics = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "reused": 0,
+            "health_checks": 0,
+            "health_check_failures": 0,
+            "reconnects": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+        }
+
+    def _connect(self):
+        conn = self.connect(
+            host=self.host,
+            database=self.database,
+            user=self.user,
+            password=self.password
+        )
+        # Every explore query is a read, so avoid leaving sessions idle in transaction
+        conn.autocommit = True
+        with self._cond:
+            self._metrics["connections_created"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._metrics["connections_closed"] += 1
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        # Only ping connections that sat idle long enough for the server or network to drop them
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        with self._cond:
+            self._metrics["health_checks"] += 1
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._metrics["health_check_failures"] += 1
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            waited_since = None
+            while True:
+                if self._closed:
+                    raise RuntimeError("The connection pool has been closed")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot now and connect outside the lock
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(
+                        f"Timed out waiting for a database connection ({self.max_size} in use)")
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._metrics["waits"] += 1
+                self._cond.wait(remaining)
+            if waited_since is not None:
+                self._metrics["wait_time"] += time.monotonic() - waited_since
+            self._metrics["checkouts"] += 1
+
+        try:
+            if conn is not None:
+                if self._is_healthy(conn, idle_since):
+                    with self._cond:
+                        self._metrics["reused"] += 1
+                    return conn
+                # Stale connection, replace it in the same slot
+                self._close(conn)
+                with self._cond:
+                    self._metrics["reconnects"] += 1
+            return self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if not conn.autocommit:
+                    conn.autocommit = True
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._close(conn)
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        with span("connection checkout", DATABASE):
+            conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # The connection itself failed, don't hand it out again. A cancelled
+            # statement leaves the connection usable.
+            discard = bool(conn.closed) or not isinstance(e, psycopg2.extensions.QueryCanceledError)
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["max_size"] = self.max_size
+        return stats
+
+
+_pool = None
+
+
+def init_pool(host, database, user, password, **kwargs):
+    global _pool
+    pool = ConnectionPool(host, database, user, password, **kwargs)
+    # Open the first connection eagerly so bad connection details fail here
+    conn = pool.getconn()
+    pool.putconn(conn)
+    if _pool is not None:
+        _pool.close()
+    _pool = pool
+    return pool
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("Database connection has not been configured")
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
@@ -1,268 +1,628 @@
+import numpy as np
+import os
 import psycopg2
-import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt5.QtWidgets import  QTreeWidgetItem
-try:
-    from graphviz import Digraph
-    GRAPHVIZ_AVAILABLE = True
-except ImportError:
-    GRAPHVIZ_AVAILABLE = False
+from blocks import SAMPLE_WINDOW_BLOCKS, BlockIndex, BlockSample, parse_ctid_text, parse_ctids
+from cache import LRUCache
+from catalog import SchemaCatalog
+from connection_pool import get_pool
+from plan_history import plan_flipped
+from sql_rewriter import check_select, normalize_identifier, rewrite_query, tokenize
+from tracing import CLIENT, DATABASE, activate, current_trace, span
 
-def get_execution_plan(query):
-    from interface import db_host, db_name, db_user, db_password
+# Bytes of COPY output handed to an indexing thread at a time, about 90k ctids
+PIPE_CHUNK_BYTES = 1 << 20
+# Client memory allowed for one table's ctids before they spill to disk, or before
+# streaming stops when there is nowhere to spill
+MAX_CTID_MEMORY_MB = 256
+# Tables whose fetched ctids are indexed at the same time
+TABLE_WORKERS = 4
+# Tables whose staged ctids are at least this distinct are deduplicated by the client
+CLIENT_DISTINCT_RATIO = 0.5
+# A table's ctids that take longer than this are given up, the other tables still load
+TABLE_TIMEOUT_SECONDS = 120
+# Blocks whose tuples stay cached after being opened
+RECORD_CACHE_BLOCKS = 32
+# Windows each table samples in the first round of approximate mode, doubled every round after
+FIRST_ROUND_WINDOWS = 32
 
-    try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password
-        )
-        cursor = conn.cursor()
+# Distinct plans kept by the plan cache
+PLAN_CACHE_SIZE = 64
+# Settings that change which plan the optimizer picks, part of every plan cache key
+PLAN_SETTINGS = (
+    "search_path", "work_mem", "seq_page_cost", "random_page_cost", "cpu_tuple_cost",
+    "effective_cache_size", "default_statistics_target", "max_parallel_workers_per_gather",
+    "jit", "enable_seqscan", "enable_indexscan", "enable_bitmapscan", "enable_hashjoin",
+    "enable_mergejoin", "enable_nestloop", "enable_sort", "enable_hashagg",
+)
+
+class DatabaseSession:
+    """A connection pool and everything cached about its database.
+
+    Every explore function takes one as session=, by default the session of the
+    pool init_pool() opened. Sessions of other pools work side by side with it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.block_record_cache = LRUCache(RECORD_CACHE_BLOCKS)
+        self.plan_cache = LRUCache(PLAN_CACHE_SIZE)
+        self.schema_catalog = SchemaCatalog()
+
+    def close(self):
+        self.pool.close()
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+def get_session():
+    # A new pool from init_pool() starts a new default session with empty caches
+    global _default_session
+    pool = get_pool()
+    with _default_session_lock:
+        if _default_session is None or _default_session.pool is not pool:
+            _default_session = DatabaseSession(pool)
+        return _default_session
+
+class QueryCancelledError(RuntimeError):
+    pass
+
+class WindowScanUnavailableError(RuntimeError):
+    """A table's sampling windows can't be read by a TID range scan, so every window
+    would run the whole query again. Exact mode is the faster way then."""
+
+class CancelToken:
+    """Lets another thread stop the statement running on an attached connection."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def attach(self, conn):
+        with self._lock:
+            self._conn = conn
+        self.check()
+
+    def detach(self):
+        with self._lock:
+            self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None:
+                # Asks the server to abort whatever the connection is executing
+                self._conn.cancel()
 
-        # Use EXPLAIN to get the plan
-        execution_plan_query = f"EXPLAIN (analyze, buffers, costs on, FORMAT JSON) {query};"
-        cursor.execute(execution_plan_query)
+    def check(self):
+        if self.cancelled:
+            raise QueryCancelledError("The query was cancelled")
 
-        plan = cursor.fetchall()
+def normalize_query(query):
+    # Whitespace, comments and the case of keywords and unquoted names don't change the
+    # plan, every literal (quoted, dollar-quoted or E'') is kept exactly as written
+    tokens = tokenize(query)
+    while tokens and tokens[-1].text == ";":
+        tokens.pop()
+    return " ".join(normalize_identifier(token.text) if token.kind == "word" else token.text for token in tokens)
 
-        cursor.close()
-        conn.close()
+def plan_cache_key(cursor, query, analyze):
+    with span("plan settings", DATABASE):
+        cursor.execute("SELECT name, setting FROM pg_settings WHERE name = ANY(%s) ORDER BY name", (list(PLAN_SETTINGS),))
+        settings = tuple(cursor.fetchall())
+    info = cursor.connection.info
+    database = (info.host, info.port, info.dbname, info.user)
+    return (normalize_query(query), database, settings, analyze)
 
-        return plan[0][0][0]['Plan']  
+def invalidate_plan_cache(query=None, session=None):
+    session = session or get_session()
+    if query is None:
+        session.plan_cache.invalidate()
+    else:
+        normalized = normalize_query(query)
+        session.plan_cache.invalidate(lambda key: key[0] == normalized)
+
+def run_explain(cursor, explain_query, phase, cancel_token=None):
+    # EXPLAIN's own planning and execution times tell the server's share of the span.
+    # A cancel that came while the client was between statements had nothing to abort
+    # on the server, so it is honoured here before the next one starts.
+    if cancel_token is not None:
+        cancel_token.check()
+    with span(phase, DATABASE) as current:
+        cursor.execute(explain_query)
+        explain = cursor.fetchone()[0][0]
+        current.add(server_ms=explain.get('Planning Time', 0) + explain.get('Execution Time', 0))
+    return explain['Plan']
+
+def invalidate_schema_catalog(session=None):
+    (session or get_session()).schema_catalog.invalidate()
+
+def refresh_schema_catalog(session, cursor, table_names):
+    # Anything cached about a relation whose definition changed is stale
+    changed = session.schema_catalog.refresh(cursor, table_names)
+    if changed:
+        session.block_record_cache.invalidate(lambda key: key[0] in changed)
+        session.plan_cache.invalidate()
+
+def get_execution_plan(query, analyze=True, cancel_token=None, session=None):
+    # analyze=False is the estimate only mode: the query is planned but never run
+    if cancel_token is None:
+        cancel_token = CancelToken()
+    session = session or get_session()
+    # The text goes into EXPLAIN as it is, so nothing but one SELECT may get through
+    check_select(query)
+    try:
+        with session.pool.connection() as conn:
+            conn.autocommit = False
+            cancel_token.attach(conn)
+            try:
+                with conn.cursor() as cursor:
+                    # Explaining never writes anything, and whatever it did is rolled back
+                    cursor.execute("SET TRANSACTION READ ONLY")
+                    key = plan_cache_key(cursor, query, analyze)
+                    plan = session.plan_cache.get(key)
+                    if plan is not None:
+                        return plan
+
+                    # Use EXPLAIN to get the plan
+                    if analyze:
+                        execution_plan_query = f"EXPLAIN (analyze, buffers, costs on, FORMAT JSON) {strip_semicolon(query)};"
+                        plan = run_explain(cursor, execution_plan_query, "explain analyze", cancel_token)
+                    else:
+                        execution_plan_query = f"EXPLAIN (costs on, FORMAT JSON) {strip_semicolon(query)};"
+                        plan = run_explain(cursor, execution_plan_query, "explain", cancel_token)
+                    session.plan_cache.put(key, plan)
+            finally:
+                cancel_token.detach()
+                with span("rollback", DATABASE):
+                    conn.rollback()
+
+        return plan
+    except QueryCancelledError:
+        raise
+    except psycopg2.extensions.QueryCanceledError as e:
+        if cancel_token.cancelled:
+            raise QueryCancelledError("The query was cancelled")
+        raise RuntimeError(f"Error getting the execution plan: {e}")
     except Exception as e:
         raise RuntimeError(f"Error getting the execution plan: {e}")
 
-def build_tree_widget_item(plan):
-
-        item = QTreeWidgetItem([plan['Node Type']])
-        for key, value in plan.items():
-            if key == 'Plans':
-                for child in value:
-                    child_item = build_tree_widget_item(child)
-                    item.addChild(child_item)
-            elif key != 'Node Type':
-                # Add other details as child items
-                child_item = QTreeWidgetItem(["{}: {}".format(key, value)])
-                item.addChild(child_item)
-                if(key=='Shared Hit Blocks' or key=='Shared Read Blocks'):
-                    child_item = QTreeWidgetItem(["{} Size: {}kB".format(key, value*8)])
-                    item.addChild(child_item)
-        return item
-
-def display_tree_image(plan, filename='plan-svg'):
-
-    if not GRAPHVIZ_AVAILABLE:
-        print("Graphviz is not available. Skipping visualization.")
-        return
+def execute_query_in_database(query, session=None):
+    plan, results = analyze_query(query, session=session)
+    return results
 
+def analyze_query(query, on_progress=None, memory_limit_mb=MAX_CTID_MEMORY_MB, cancel_token=None,
+                  on_table_done=None, table_timeout_s=TABLE_TIMEOUT_SECONDS, spill_dir=None, session=None):
+    # Plan, buffers and the ctids of every table come from one snapshot transaction.
+    # The user's query is staged into a temp table by EXPLAIN ANALYZE itself, so it
+    # runs once; each table's ctids are then streamed back in batches through a
+    # server-side cursor. on_progress(table_name, index, new_blocks) sees every batch,
+    # on_table_done(table_name, index) each table as soon as it is complete or failed,
+    # cancel_token can abort the statement in flight from another thread. With a
+    # spill_dir, tables over the memory limit go to disk there instead of stopping.
+    if cancel_token is None:
+        cancel_token = CancelToken()
+    session = session or get_session()
+    # Tuples cached for the previous query may have changed since
+    session.block_record_cache.invalidate()
+    memory_limit_bytes = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+    with span("parse query", CLIENT):
+        table_names = get_table_names(query)
     try:
-        counter = 0
-        def add_nodes_edges(plan, parent=None):
-            nonlocal counter
-            counter+=1
-            if parent is None:  # Create the root node
-                parent = str(plan['Node Type'])+"_"+str(counter)
-                dot.node(parent, label=str(plan['Node Type']), shape='box')
-            counter+=1
-            for child in plan.get('Plans', []):
-                child_node = str(child['Node Type'])+"_"+str(counter)
-                dot.node(child_node, label=str(child['Node Type']), shape='box')
-                dot.edge(parent, child_node)
-                add_nodes_edges(child, parent=child_node)
-    
-        dot = Digraph(comment='Query Execution Plan', format='svg')
-
-        # Start adding nodes and edges
-        add_nodes_edges(plan)
-
-        # Save the output
-        dot.render(filename, view=False)
+        results = {}
+        with session.pool.connection() as conn:
+            conn.autocommit = False
+            cancel_token.attach(conn)
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    key = plan_cache_key(cursor, query, True)
+                    # Also tells the rewriter which names are views, and gives every relation's size
+                    refresh_schema_catalog(session, cursor, table_names)
+                    with span("rewrite query", CLIENT):
+                        staging_query, table_columns, plan_preserving = convert_query_to_staging_query(
+                            query, session.schema_catalog.without_ctid(table_names))
+                    if plan_preserving:
+                        # The ctid columns can still change the plan, a system column rules out
+                        # an Index Only Scan for one. Planning both is cheap, and the instrumented
+                        # query only stands in for the user's when their nodes are the same.
+                        original = run_explain(
+                            cursor, f"EXPLAIN (costs on, FORMAT JSON) {strip_semicolon(query)}", "explain", cancel_token)
+                        instrumented = unwrap_staging_plan(run_explain(
+                            cursor, f"EXPLAIN (costs on, FORMAT JSON) {staging_query}", "explain staging", cancel_token))
+                        plan_preserving = not plan_flipped(original, instrumented)
+                    if plan_preserving:
+                        plan = unwrap_staging_plan(run_explain(
+                            cursor, f"EXPLAIN (analyze, buffers, costs on, FORMAT JSON) {staging_query}",
+                            "explain analyze and stage ctids", cancel_token))
+                    else:
+                        # Grouping by ctid would change the plan the user asked about,
+                        # so explain the original query in the same snapshot instead
+                        plan = run_explain(
+                            cursor, f"EXPLAIN (analyze, buffers, costs on, FORMAT JSON) {strip_semicolon(query)}",
+                            "explain analyze", cancel_token)
+                        cancel_token.check()
+                        with span("stage ctids", DATABASE):
+                            cursor.execute(staging_query)
+                    # A later EXPLAIN ANALYZE of the same text can reuse this plan
+                    session.plan_cache.put(key, plan)
+                    cancel_token.check()
+                    with span("prepare ctid reads", DATABASE):
+                        # Mostly distinct columns are cheaper to deduplicate here than with a
+                        # server-side DISTINCT, the statistics tell which ones those are
+                        cursor.execute(f"ANALYZE {STAGING_TABLE}")
+                        distinct_ratios = staged_distinct_ratios(cursor)
+
+                    # The staging table only exists in this session, so the tables are read one
+                    # after the other here while a pool indexes the ones already fetched
+                    trace = current_trace()
+                    with ThreadPoolExecutor(max_workers=max(1, min(TABLE_WORKERS, len(table_columns))),
+                                            thread_name_prefix="qp_table") as table_pool:
+                        indexing = []
+                        for i, (table_name, columns) in enumerate(table_columns):
+                            relation = session.schema_catalog.get(table_name)
+                            index = BlockIndex(memory_limit_bytes, relation.blocks if relation else None,
+                                               os.path.join(spill_dir, f"table-{i}") if spill_dir else None)
+                            results[table_name] = index
+                            pipe = CtidPipe(conn)
+                            indexing.append(table_pool.submit(
+                                index_table_ctids, table_name, index, pipe, on_progress, on_table_done, trace))
+                            distinct = any(distinct_ratios.get(column, 0) < CLIENT_DISTINCT_RATIO
+                                           for column in columns)
+                            complete = False
+                            try:
+                                stream_table_ctids(conn, cursor, i, table_name, columns, distinct, index,
+                                                   pipe, cancel_token, table_timeout_s)
+                                complete = True
+                            finally:
+                                pipe.close(complete)
+                        for future in indexing:
+                            future.result()
+            finally:
+                cancel_token.detach()
+                # Also drops the staging table
+                with span("rollback", DATABASE):
+                    conn.rollback()
+        return plan, results
+    except QueryCancelledError:
+        raise
+    except psycopg2.extensions.QueryCanceledError as e:
+        if cancel_token.cancelled:
+            raise QueryCancelledError("The query was cancelled")
+        raise RuntimeError(f"Error executing the query: {e}")
     except Exception as e:
-        print(f"An error occurred while creating the visualization: {e}")
+        raise RuntimeError(f"Error executing the query: {e}")
 
-    
-def execute_query_in_database(query):
-    from interface import db_host,db_name,db_user,db_password
-    print(db_host)
+def approximate_query(query, on_progress=None, cancel_token=None, max_seconds=None, session=None):
+    # For tables too big to read every ctid of: each table's accessed blocks are read
+    # exactly inside random windows of its blocks, one statement per window, and scaled
+    # up to the whole relation. The window is a ctid range on the query's output, which
+    # the planner pushes down to a TID range scan when it can. Rounds of windows repeat
+    # until every window is in (the result is then exact), max_seconds pass, or the
+    # token is cancelled; stopping keeps the estimate reached so far.
+    # on_progress(table_name, index, new_blocks) sees every finished round of a table,
+    # index.sample.estimate() is the current estimate.
+    if cancel_token is None:
+        cancel_token = CancelToken()
+    session = session or get_session()
+    session.block_record_cache.invalidate()
+    deadline = None if max_seconds is None else time.monotonic() + max_seconds
+    with span("parse query", CLIENT):
+        table_names = get_table_names(query)
     try:
         results = {}
+        with session.pool.connection() as conn:
+            conn.autocommit = False
+            cancel_token.attach(conn)
+            try:
+                with conn.cursor() as cursor:
+                    # Every window sees the same snapshot
+                    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    refresh_schema_catalog(session, cursor, table_names)
+                    with span("rewrite query", CLIENT):
+                        rewrite = rewrite_query(query, session.schema_catalog.without_ctid(table_names))
+                    if not rewrite.table_columns:
+                        raise RuntimeError("The query doesn't read any table whose blocks can be traced")
+                    # The query isn't run as a whole, so only the planner's estimates are shown
+                    plan = run_explain(cursor, f"EXPLAIN (costs on, FORMAT JSON) {strip_semicolon(query)}", "explain",
+                                       cancel_token)
+                    for table_name, columns in rewrite.table_columns:
+                        check_window_scan(cursor, rewrite.instrumented_query, table_name, columns, cancel_token)
+                    for table_name, _ in rewrite.table_columns:
+                        relation = session.schema_catalog.get(table_name)
+                        relation_blocks = relation.blocks if relation else 0
+                        index = BlockIndex(relation_blocks=relation_blocks)
+                        index.sample = BlockSample(relation_blocks)
+                        results[table_name] = index
 
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password
-        )
+                    windows = FIRST_ROUND_WINDOWS
+                    try:
+                        while any(index.sample.remaining() for index in results.values()):
+                            for table_name, columns in rewrite.table_columns:
+                                index = results[table_name]
+                                new_blocks = sample_table_windows(cursor, rewrite.instrumented_query, table_name,
+                                                                  columns, index, windows, cancel_token, deadline)
+                                if on_progress is not None:
+                                    on_progress(table_name, index, new_blocks)
+                            if deadline is not None and time.monotonic() >= deadline:
+                                break
+                            windows *= 2
+                    except (QueryCancelledError, psycopg2.extensions.QueryCanceledError):
+                        # Stopping keeps the windows sampled so far
+                        if not cancel_token.cancelled:
+                            raise
+            finally:
+                cancel_token.detach()
+                with span("rollback", DATABASE):
+                    conn.rollback()
+        for index in results.values():
+            index.finish()
+        return plan, results
+    except (QueryCancelledError, WindowScanUnavailableError):
+        raise
+    except psycopg2.extensions.QueryCanceledError as e:
+        # A cancel that lands before the sampling loop, e.g. during the EXPLAIN
+        if cancel_token.cancelled:
+            raise QueryCancelledError("The query was cancelled")
+        raise RuntimeError(f"Error sampling the query: {e}")
+    except Exception as e:
+        raise RuntimeError(f"Error sampling the query: {e}")
 
-        cursor = conn.cursor()
+def check_window_scan(cursor, instrumented_query, table_name, columns, cancel_token=None):
+    # Under LIMIT, DISTINCT ON, window functions or aggregates in subqueries the window's
+    # ctid range can't reach the table scan, the plan of the first window tells
+    plan = run_explain(cursor, "EXPLAIN (costs off, FORMAT JSON) "
+                       + windowed_ctids_query(instrumented_query, columns, 0, SAMPLE_WINDOW_BLOCKS), "explain window",
+                       cancel_token)
+    relation_name = table_name.split(".")[-1].strip('"')
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if node.get("Node Type") == "Tid Range Scan" and node.get("Relation Name") == relation_name:
+            return
+        nodes.extend(node.get("Plans", []))
+    raise WindowScanUnavailableError(f"The sampling windows of {table_name} can't use a TID range scan, "
+                                     f"each one would run the whole query")
 
-        # Execute the SQL query
-        ctid_queries = convert_query_to_ctid_query(query)
-        isErrorFirstPass = False
-        for table_name in ctid_queries:
-            ctid_query  = ctid_queries[table_name]
-            try:
-                cursor.execute(ctid_query)
-            except psycopg2.Error as e:
-                isErrorFirstPass = True
-                continue
-            # Fetch and format the results for each query
-            result = cursor.fetchall()
-            results[table_name] = result
-        cursor.close()
-        conn.close()
-        
-        # If first pass error, we check 2nd pass for aggregate function
-        if isErrorFirstPass:
-            conn = psycopg2.connect(
-                host=db_host,
-                database=db_name,
-                user=db_user,
-                password=db_password
-            )
-            # Create a cursor object
-            cursor = conn.cursor()
-            ctid_queries = convert_query_to_ctid_query(query, checkAggregate = isErrorFirstPass)
-            for table_name in ctid_queries:
-                ctid_query  = ctid_queries[table_name]
-                try:
-                    cursor.execute(ctid_query)
-                except psycopg2.Error as e:
-                    raise RuntimeError(f"Error executing the query: {e}")
-                # Fetch and format the results for each query
-                result = cursor.fetchall()
-                results[table_name] = result
-   
-            cursor.close()
-            conn.close()
-            
-
-        conn.close()
-            
-        return results
-    except Exception as e:
-        raise RuntimeError(f"Error executing the query: {e}")
+def sample_table_windows(cursor, instrumented_query, table_name, columns, index, count, cancel_token,
+                         deadline=None):
+    # One round of a table: up to `count` more windows, each read exactly. Windows
+    # don't overlap, so the blocks new to the index are the blocks of the window.
+    new_blocks = []
+    with span("sample windows", DATABASE, table=table_name) as current:
+        for _ in range(count):
+            if not index.sample.remaining() or (deadline is not None and time.monotonic() >= deadline):
+                break
+            cancel_token.check()
+            window, = index.sample.next_windows(1)
+            cursor.execute(windowed_ctids_query(instrumented_query, columns, *window))
+            keys = parse_ctids([row[0] for row in cursor.fetchall()])
+            window_blocks = index.add_keys(keys)
+            index.sample.add(window, len(window_blocks), len(keys))
+            new_blocks.append(window_blocks)
+            current.add(rows=len(keys), windows=1)
+    return np.concatenate(new_blocks) if new_blocks else np.empty(0, dtype=np.uint64)
 
-def get_columns_for_table(table_name):
-    from interface import db_host,db_name,db_user,db_password
-    # Initialize the list of columns, starting with the ctid
-    columns = ["ctid"]
+class CtidPipe:
+    """Carries one table's COPY output to its indexing thread through an OS pipe.
+
+    psycopg2 writes every row to the buffered end with no Python code per row, the
+    indexing thread reads it back in large chunks."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        read_fd, write_fd = os.pipe()
+        self.reader = os.fdopen(read_fd, "rb")
+        self.writer = os.fdopen(write_fd, "wb", buffering=PIPE_CHUNK_BYTES)
+        self.complete = False
+        self._lock = threading.Lock()
+        self._open = True
+
+    def stop_copy(self):
+        # Asks the server to stop sending, unless the COPY already ended and a
+        # cancel would hit the next statement instead
+        with self._lock:
+            if self._open:
+                self.conn.cancel()
+
+    def close(self, complete):
+        with self._lock:
+            self._open = False
+            self.complete = complete
+        self.writer.close()
+
+def stream_table_ctids(conn, cursor, position, table_name, columns, distinct, index, pipe, cancel_token,
+                       timeout_s):
+    # Each table is read by one COPY under its own savepoint and timeout, a table that
+    # fails or times out gets index.error and the transaction carries on with the next
+    # one. COPY sends plain ctid lines that are parsed in bulk, no Python row per tuple.
+    cancel_token.check()
+    savepoint = f"qp_table_{position}"
+    cursor.execute(f"SAVEPOINT {savepoint}")
+    if timeout_s:
+        cursor.execute("SET LOCAL statement_timeout = %s", (max(1, int(timeout_s * 1000)),))
     try:
-        conn = psycopg2.connect(
-            host=db_host,
-            database=db_name,
-            user=db_user,
-            password=db_password
-        )
-  
-        cursor = conn.cursor()
-        # Query to get all column names for the table
-        column_query = f"SELECT column_name FROM information_schema.columns WHERE table_name='{table_name}' ORDER BY ordinal_position"
-        # Execute and fetch the query
-        cursor.execute(column_query)
-        columns_result = cursor.fetchall()
-        # Extract column names from the result
-        for col in columns_result:
-            columns.append(col[0])
-            cursor.close()
-            conn.close()
-    except Exception as e:
-        raise RuntimeError(f"Error retrieveing table headers")
-    return columns
+        with span("fetch ctids", DATABASE, table=table_name, distinct_on_server=int(distinct)):
+            cursor.copy_expert(f"COPY ({staged_ctids_query(STAGING_TABLE, columns, distinct)}) TO STDOUT",
+                               pipe.writer)
+            pipe.writer.flush()
+        cursor.execute(f"RELEASE SAVEPOINT {savepoint}")
+    except psycopg2.Error as e:
+        if cancel_token.cancelled or conn.closed:
+            raise
+        cursor.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+        if not isinstance(e, psycopg2.extensions.QueryCanceledError):
+            index.error = str(e).strip()
+        elif not index.truncated and not index.error:
+            # Unless the indexing side stopped the COPY, the table ran out of time
+            index.error = f"Reading the blocks of {table_name} took over {timeout_s} s"
 
-def get_table_names(query):
-    # Regular expression to match table names mentioned after "FROM" or "JOIN"
-    table_pattern = r'\b(FROM|JOIN)\s+([a-zA-Z_][a-zAZ0-9_\.]+(?:\s*,\s*[a-zA-Z_][a-zA-Z0-9_\.]+)*)'
+def index_table_ctids(table_name, index, pipe, on_progress, on_table_done, trace):
+    # Runs on the table pool and indexes one table's ctid lines while the connection
+    # is still sending them. Reads to the end even after a failure so COPY never
+    # blocks on a full pipe. A failure only fails this table, through index.error.
+    pending = b""
+    with activate(trace), pipe.reader:
+        while True:
+            chunk = pipe.reader.read(PIPE_CHUNK_BYTES)
+            if not chunk:
+                break
+            if index.error or index.truncated:
+                continue
+            # Only whole lines are parsed, the tail waits for the next chunk
+            data = pending + chunk
+            cut = data.rfind(b"\n") + 1
+            pending = data[cut:]
+            try:
+                with span("index ctids", CLIENT, table=table_name) as current:
+                    lines = data[:cut].decode()
+                    new_blocks = index.add_keys(parse_ctid_text(lines))
+                    current.add(rows=lines.count("\n"), bytes=cut)
+                if index.truncated:
+                    pipe.stop_copy()
+                if on_progress is not None:
+                    on_progress(table_name, index, new_blocks)
+            except Exception as e:
+                # Set before stopping the COPY, so the reading side keeps this error
+                index.error = f"Indexing the blocks of {table_name} failed: {e}"
+                pipe.stop_copy()
+    if not pipe.complete:
+        # The analysis stopped, this table is not done
+        return
+    if not index.error:
+        try:
+            index.finish()
+        except Exception as e:
+            index.error = f"Indexing the blocks of {table_name} failed: {e}"
+    if on_table_done is not None:
+        on_table_done(table_name, index)
+
+def unwrap_staging_plan(plan):
+    # LIMIT/ORDER BY queries keep the staging wrapper as a Subquery Scan, hide it
+    if plan['Node Type'] == 'Subquery Scan' and plan.get('Alias') == 'qp_staged':
+        plan = dict(plan['Plans'][0])
+        plan.pop('Parent Relationship', None)
+    return plan
+
+def fetch_block_records(table_name, block, offsets=None, session=None):
+    # Tuples are only read when a block is opened, the index keeps nothing but ctids.
+    # A TID range scan reads just that heap page, recently opened blocks are cached.
+    session = session or get_session()
+    key = (table_name, block)
+    records = session.block_record_cache.get(key)
+    if records is None:
+        relation = session.schema_catalog.get(table_name)
+        # The catalog's schema-qualified name, in case search_path changed since
+        relation_name = relation.qualified_name if relation else table_name
+        try:
+            with session.pool.connection() as conn:
+                with conn.cursor() as cursor, span("fetch block records", DATABASE, table=table_name) as current:
+                    cursor.execute(
+                        f"SELECT ctid, * FROM {relation_name} WHERE ctid >= %s::tid AND ctid < %s::tid ORDER BY ctid",
+                        (f"({block},0)", f"({block + 1},0)")
+                    )
+                    records = cursor.fetchall()
+                    current.add(rows=len(records))
+        except Exception as e:
+            raise RuntimeError(f"Error fetching the records: {e}")
+        session.block_record_cache.put(key, records)
+    if offsets is None:
+        return records
+    # Keep only the tuples the query accessed
+    offsets = set(offsets)
+    return [record for record in records if int(record[0][1:-1].split(',')[1]) in offsets]
+
+def get_columns_for_table(table_name, session=None):
+    # The ctid first, then the columns from the schema catalog. Relations the last
+    # query read are already loaded, so this normally doesn't touch the database.
+    session = session or get_session()
+    relation = session.schema_catalog.get(table_name)
+    if relation is None:
+        try:
+            with session.pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    relation = session.schema_catalog.lookup(cursor, table_name)
+        except Exception as e:
+            raise RuntimeError(f"Error retrieving the columns of {table_name}: {e}")
+    if relation is None:
+        raise RuntimeError(f"Table {table_name} does not exist")
+    return ["ctid"] + list(relation.columns)
 
-    # Find all matches of the table pattern in the SQL query
-    matches = re.findall(table_pattern, query, flags=re.IGNORECASE)
+STAGING_TABLE = "qp_ctids"
 
-    # Extract only the table names
-    table_names = [table.replace(' ', '').split(',') for _, table in matches]
-    table_names = [item for sublist in table_names for item in sublist]
-    table_names = [name.strip() for name in table_names]
-    table_names = list(set(table_names))
+def get_table_names(query):
+    return list(rewrite_query(query).table_names)
 
-    return table_names    
+def get_skipped_tables(query, session=None):
+    # Tables the query reads whose blocks can't be traced: read only inside an EXISTS
+    # or IN subquery, or views and foreign tables. Same rewrite as the analysis, so memoized.
+    session = session or get_session()
+    exclude = session.schema_catalog.without_ctid(get_table_names(query))
+    return list(rewrite_query(query, exclude).skipped_tables)
 
 def convert_query_to_ctid_query(query, checkAggregate = False):
-    if "ctid" in query.lower():
-        raise RuntimeError(f"\"ctid\" is a reserved word, please remove it from the query")
-    
-    table_names = get_table_names(query)
+    # Aggregates are detected while parsing, checkAggregate is kept for older callers
+    rewrite = rewrite_query(query)
     ctid_queries = {}
-    query = query.strip()
-    select_index = query.upper().find("SELECT")
-    
-    for table_name in table_names:
-        #erase ";" if any
-        if query[-1]==";":
-            new_query = query[:-1]
-        else:
-            new_query = query
-            
-        # Regular expression to identify UNION, UNION ALL, INTERSECT, or EXCEPT
-        set_operation_regex = r'\b(UNION\s+ALL|UNION|INTERSECT|EXCEPT)\b'
-        
-        # Save the Set Operation
-        operators = re.findall(set_operation_regex, query, flags=re.IGNORECASE)
-        
-        # Split the query based on the pattern
-        sub_queries = re.split(set_operation_regex, new_query, flags=re.IGNORECASE)
-        sub_queries = [sub_query.strip() for sub_query in sub_queries]
-        
-        modified_sub_queries = []
-        
-        # Add ctid to every sub query
-        for sub_query in sub_queries:
-            select_index = sub_query.upper().find("SELECT")
-            insert_position = select_index + len("SELECT")
-                
-            #add (table_name).ctid to the query
-            sub_query = sub_query[:insert_position] + " " + table_name + ".ctid AS ctid" + ", " + sub_query[insert_position:]
-            
-            #add ctid to the group by clause
-            group_by_index = sub_query.upper().find("GROUP BY")
-            if group_by_index != -1:
-                insert_position = group_by_index + len("GROUP BY")
-                sub_query = sub_query[:insert_position] + " " + "ctid" + ", " + sub_query[insert_position:]
-            else:
-                # If first pass error, we check 2nd pass for aggregate function by adding group by ctid
-                if checkAggregate:
-                    aggregate_pattern = re.compile(r'\b(COUNT|SUM|AVG|MAX|MIN)\(', re.IGNORECASE)
-                    match = aggregate_pattern.search(query)
-                    # Insert group by clause before having, order by, or limit
-                    if match:
-                        if sub_query.upper().find("HAVING") != -1:
-                            insert_position = sub_query.upper().rfind("HAVING")-1
-                        elif  sub_query.upper().find("ORDER BY") != -1:
-                            insert_position = sub_query.upper().rfind("ORDER BY")-1
-                        elif sub_query.upper().find("LIMIT") != -1: 
-                            insert_position = sub_query.upper().rfind("LIMIT")-1
-                        else:
-                            insert_position = len(sub_query)
-                        sub_query = sub_query[:insert_position] + " " + "GROUP BY" + " " + table_name + ".ctid" + sub_query[insert_position:]
-                        
-            modified_sub_queries.append(sub_query)
-        
-        # Merge all the sub queries
-        merge_query = ""
-        for i in range (len(operators)):
-            merge_query = merge_query + modified_sub_queries[i] + " " + operators[i] + " "
-        merge_query = merge_query + modified_sub_queries[-1]
-        
-        #project the ctid column
-        merge_query = "SELECT ctid FROM (" + merge_query + ")" 
-
+    for table_name, columns in rewrite.table_columns:
         #retrieve all the tuples in a given table based on ctid
-        merge_query = "SELECT ctid, * FROM " + table_name + " WHERE ctid IN (" + merge_query + ")" 
-        
-        ctid_queries[table_name] = merge_query
-
+        ctid_queries[table_name] = (
+            f"SELECT ctid, * FROM {table_name} WHERE ctid IN ("
+            f"{staged_ctids_query(f'({rewrite.instrumented_query}) AS qp_staged', columns)})"
+        )
     return ctid_queries
 
+def staged_ctids_query(source, columns, distinct=True):
+    # A table read more than once (self joins, set operations) has a ctid column per occurrence
+    select = "SELECT DISTINCT" if distinct else "SELECT"
+    if len(columns) == 1:
+        return f"{select} {columns[0]} FROM {source} WHERE {columns[0]} IS NOT NULL"
+    values = ", ".join(f"({column})" for column in columns)
+    return (f"{select} qp_ctid FROM {source} CROSS JOIN LATERAL (VALUES {values}) AS qp_values(qp_ctid) "
+            f"WHERE qp_ctid IS NOT NULL")
+
+def windowed_ctids_query(instrumented_query, columns, first_block, end_block=None):
+    # Distinct ctids of one table that fall in blocks [first_block, end_block)
+    def in_window(column):
+        condition = f"{column} >= '({first_block},0)'::tid"
+        if end_block is not None:
+            condition += f" AND {column} < '({end_block},0)'::tid"
+        return condition
+    source = f"({instrumented_query}) AS qp_staged"
+    if len(columns) == 1:
+        return f"SELECT DISTINCT {columns[0]} FROM {source} WHERE {in_window(columns[0])}"
+    values = ", ".join(f"({column})" for column in columns)
+    return (f"SELECT DISTINCT qp_ctid FROM {source} CROSS JOIN LATERAL (VALUES {values}) AS qp_values(qp_ctid) "
+            f"WHERE ({' OR '.join(f'({in_window(column)})' for column in columns)}) AND {in_window('qp_ctid')}")
 
-    
+def staged_distinct_ratios(cursor):
+    # Share of distinct values in each staging column, from the statistics ANALYZE gathered
+    cursor.execute(
+        "SELECT s.attname, CASE WHEN s.n_distinct < 0 THEN -s.n_distinct "
+        "ELSE s.n_distinct / greatest(c.reltuples, 1) END "
+        "FROM pg_stats s JOIN pg_class c ON c.oid = %s::regclass "
+        "WHERE s.tablename = %s AND s.schemaname = (SELECT nspname FROM pg_namespace WHERE oid = pg_my_temp_schema())",
+        (STAGING_TABLE, STAGING_TABLE)
+    )
+    return dict(cursor.fetchall())
 
+def strip_semicolon(query):
+    query = query.strip()
+    if query.endswith(";"):
+        query = query[:-1]
+    return query
 
+def convert_query_to_staging_query(query, exclude=frozenset()):
+    rewrite = rewrite_query(query, exclude)
+    columns = [column for _, table_columns in rewrite.table_columns for column in table_columns]
+    if not columns:
+        raise RuntimeError("The query doesn't read any table whose blocks can be traced")
+    # Only the ctid columns are kept, so duplicate output names in the user's query don't matter
+    staging_query = (
+        f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+        f"SELECT {', '.join(columns)} FROM ({rewrite.instrumented_query}) AS qp_staged"
+    )
+    return staging_query, rewrite.table_columns, rewrite.plan_preserving
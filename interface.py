@@ -1,52 +1,84 @@
+import shutil
 import sys
-from PyQt5.QtCore import Qt
+import time
+from functools import partial
+
+import numpy as np
+from PyQt5.QtCore import Qt, QThreadPool, QTimer
 from PyQt5.QtWidgets import *
-from PyQt5.QtGui import QPalette, QColor, QFont
-from PyQt5.QtSvg import QGraphicsSvgItem
+from PyQt5.QtGui import QColor, QFont, QPainterPath, QPen, QBrush, QImage, QPixmap
 
-import psycopg2
-from explore import *
+from cache import LRUCache
 
-class ConfigDialog(QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("Database Connection Details")
-        self.setGeometry(200, 200, 400, 200)
-
-        self.host_input = QLineEdit()
-        self.name_input = QLineEdit()
-        self.user_input = QLineEdit()
-        self.password_input = QLineEdit()
-        self.password_input.setEchoMode(QLineEdit.Password)
-
-        # Confirm Button
-        confirm_button = QPushButton("Confirm")
-        confirm_button.clicked.connect(self.accept)
-
-        layout = QFormLayout(self)
-        layout.addRow("Database Host:", self.host_input)
-        layout.addRow("Database Name:", self.name_input)
-        layout.addRow("Database User:", self.user_input)
-        layout.addRow("Database Password:", self.password_input)
-        layout.addWidget(confirm_button)
-
-        # Placeholders
-        self.host_input.setPlaceholderText("Example: localhost")
-        self.name_input.setPlaceholderText("Example: TPC-H")
-        self.user_input.setPlaceholderText("Example: postgres")
-
-    def get_connection_details(self):
-        return (
-            self.host_input.text(),
-            self.name_input.text(),
-            self.user_input.text(),
-            self.password_input.text()
-        )
+from connection_pool import get_pool
+from explore import *
+from models import HOT_SPOT_COLORS, MISESTIMATE_COLOR, BlockListModel, BlockRecordsModel, PlanTreeModel
+from plan_analysis import is_misestimated
+from plan_history import DEFAULT_HISTORY_PATH, PlanHistory, diff_plans, plan_flipped
+from plan_tree import get_plan_layout
+from session import load_session, save_session
+from tracing import activate, span
+from worker import BlockRecordsWorker, PlanHistoryWorker, QueryWorker
+
+# Plan graph geometry, in scene pixels
+PLAN_NODE_WIDTH = 200
+PLAN_NODE_HEIGHT = 68
+PLAN_NODE_SPACING_X = 20
+PLAN_NODE_SPACING_Y = 40
+# Heatmap grid, each cell covers an equal share of the relation's blocks
+HEATMAP_COLUMNS = 128
+HEATMAP_ROWS = 24
+HEATMAP_CELL_SIZE = 3
+HEATMAP_EMPTY_COLOR = np.array([224, 224, 224])
+HEATMAP_FULL_COLOR = np.array([176, 0, 0])
+HEATMAP_PADDING_COLOR = np.array([240, 240, 240])
+# Columns of the timing breakdown and the span attribute each one shows
+TIMING_COLUMNS = (
+    ("Phase", "phase"), ("Side", "category"), ("Calls", "calls"), ("Wall ms", "wall_ms"),
+    ("Server ms", "server_ms"), ("Rows", "rows"), ("Bytes", "bytes"),
+)
+# Plan tree levels opened when a plan is shown
+PLAN_TREE_EXPAND_DEPTH = 3
+# Searches with more matches than this don't expand every path to them
+PLAN_SEARCH_EXPAND_LIMIT = 200
+# Drawn plan graphs kept so going back to a plan doesn't rebuild its scene
+PLAN_SCENE_CACHE_SIZE = 8
+# Pause in typing after which the edited query is planned for the preview
+PREVIEW_DELAY_MS = 400
+# Past runs of a query listed in the plan history
+PLAN_HISTORY_RUNS = 200
+# Why a table the query reads has no blocks
+SKIPPED_TABLE_REASON = "Only read inside a subquery (EXISTS, IN), or a view or foreign table"
+# Row colors of the plan diff
+PLAN_DIFF_COLORS = {"changed": "#fff2cc", "added": "#d9ead3", "removed": "#f4cccc", "replaced": "#f4cccc"}
 
 class SQLQueryApp(QWidget):
-    def __init__(self):
+    def __init__(self, history_path=DEFAULT_HISTORY_PATH):
         super().__init__()
-        self.record_dict = {}  # Dictionary to store records for each block
+        self.results = {}  # Dictionary to store the accessed blocks of each table
+        self.headers = {}  # Column names of each table, fetched by the worker
+        self.previous_runs = {}  # Accessed blocks of the previous query, for comparison
+        self.skipped_tables = []  # Tables the query reads whose blocks can't be traced
+        self.approximation_note = None  # Why an approximate query ran exactly instead
+        self.trace = None  # Phases of the last finished query
+        self.plan = None  # Plan of the results shown
+        self.memory_limit_mb = MAX_CTID_MEMORY_MB  # Per table, before its ctids spill to disk
+        self.spill_dir = None  # Where the blocks of the results shown spilled to disk
+        self.spilling_workers = set()  # Workers that may still write to their spill directory
+        self.shown_layout = None  # Layout of the plan in the tree and graph
+        self.preview_worker = None  # Estimate-only plan of the text being edited
+        self.previewed_query = None
+        self.worker = None  # Worker of the query currently running
+        self.current_table = None  # Table whose blocks are listed
+        self.header = None
+        self.thread_pool = QThreadPool()
+        self.plan_history = None  # Earlier runs of each query, none without a history_path
+        if history_path is not None:
+            try:
+                self.plan_history = PlanHistory(history_path)
+            except Exception as e:
+                # The tool works without history, e.g. when the home directory isn't writable
+                print(f"Plan history disabled: {e}", file=sys.stderr)
         self.initUI()
 
     def initUI(self):
@@ -67,11 +99,62 @@ class SQLQueryApp(QWidget):
         self.sql_input = QTextEdit()
         self.layout_left.addWidget(self.sql_input)
 
+        # Edits are planned once typing pauses, a newer edit cancels the plan in flight
+        self.preview_checkbox = QCheckBox("Live plan preview")
+        self.preview_checkbox.setToolTip("Show the estimated plan while typing, the query is never run")
+        self.preview_checkbox.setChecked(True)
+        self.layout_left.addWidget(self.preview_checkbox)
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self.preview_timer.timeout.connect(self.previewPlan)
+        self.sql_input.textChanged.connect(self.queryEdited)
+
         # Execute Button
         self.execute_button = QPushButton("Execute Query")
         self.layout_left.addWidget(self.execute_button)
+
+        # Sessions are reopened from disk without running the query again
+        session_buttons = QHBoxLayout()
+        self.save_session_button = QPushButton("Save Session")
+        self.save_session_button.setEnabled(False)
+        self.save_session_button.clicked.connect(self.saveSession)
+        session_buttons.addWidget(self.save_session_button)
+        self.open_session_button = QPushButton("Open Session")
+        self.open_session_button.clicked.connect(self.openSession)
+        session_buttons.addWidget(self.open_session_button)
+        self.layout_left.addLayout(session_buttons)
         self.execute_button.clicked.connect(self.executeQuery)
 
+        # Plan options
+        plan_options = QHBoxLayout()
+        self.estimate_only_checkbox = QCheckBox("Estimate only (no ANALYZE)")
+        self.estimate_only_checkbox.setToolTip("Show the planner's estimates without running the query")
+        plan_options.addWidget(self.estimate_only_checkbox)
+        self.approximate_checkbox = QCheckBox("Approximate blocks")
+        self.approximate_checkbox.setToolTip("Estimate the accessed blocks from random samples of each table, "
+                                             "refined until Cancel is pressed or the result is exact")
+        plan_options.addWidget(self.approximate_checkbox)
+        self.clear_plan_cache_button = QPushButton("Clear Caches")
+        self.clear_plan_cache_button.setToolTip("Forget cached plans and table definitions, e.g. after changing the schema")
+        self.clear_plan_cache_button.clicked.connect(self.clearPlanCache)
+        plan_options.addWidget(self.clear_plan_cache_button)
+        self.plan_history_button = QPushButton("Plan History")
+        self.plan_history_button.setToolTip("Compare the plan of this query with its earlier runs")
+        self.plan_history_button.setEnabled(self.plan_history is not None)
+        self.plan_history_button.clicked.connect(self.showPlanHistory)
+        plan_options.addWidget(self.plan_history_button)
+        self.layout_left.addLayout(plan_options)
+
+        # Cancel Button
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.layout_left.addWidget(self.cancel_button)
+        self.cancel_button.clicked.connect(self.cancelQuery)
+
+        self.status_label = QLabel("")
+        self.layout_left.addWidget(self.status_label)
+
         self.layout_left.addSpacing(30)
 
         label_blocks = QLabel("Blocks Accessed (Grouped by Tables)")
@@ -81,16 +164,45 @@ class SQLQueryApp(QWidget):
         self.tab_widget = QTabWidget()
         self.layout_left.addWidget(self.tab_widget)
         self.tab_widget.currentChanged.connect(self.tabChanged)
-        
-        scroll_area = QScrollArea()
-        scroll_area.setWidgetResizable(True)
 
-        blocks_layout_widget = QWidget()
-        self.layout_blocks = QVBoxLayout(blocks_layout_widget)
-
-        # Set the layout widget as the widget for the scroll area
-        scroll_area.setWidget(blocks_layout_widget)
-        self.layout_left.addWidget(scroll_area, 1)  # Use stretch factor to control size
+        # Where in the relation the accessed blocks are, one cell per range of blocks
+        self.heatmap_label = QLabel()
+        self.heatmap_label.setAlignment(Qt.AlignCenter)
+        self.layout_left.addWidget(self.heatmap_label)
+        self.block_summary_label = QLabel("")
+        self.block_summary_label.setWordWrap(True)
+        self.layout_left.addWidget(self.block_summary_label)
+
+        # Filter and jump controls for the block list
+        block_tools = QHBoxLayout()
+        self.block_filter_input = QLineEdit()
+        self.block_filter_input.setPlaceholderText("Filter, e.g. 10-200, 512")
+        self.block_filter_input.returnPressed.connect(self.filterBlocks)
+        block_tools.addWidget(self.block_filter_input)
+        self.block_jump_input = QLineEdit()
+        self.block_jump_input.setPlaceholderText("Jump to block")
+        self.block_jump_input.returnPressed.connect(self.jumpToBlock)
+        block_tools.addWidget(self.block_jump_input)
+        self.layout_left.addLayout(block_tools)
+
+        # Only the visible rows of the block list are ever rendered
+        self.block_list_model = BlockListModel(self)
+        self.block_list_view = QListView()
+        self.block_list_view.setModel(self.block_list_model)
+        self.block_list_view.setUniformItemSizes(True)
+        self.block_list_view.setEditTriggers(QListView.NoEditTriggers)
+        # Double-click or Enter, or a single click where the style activates on one
+        self.block_list_view.activated.connect(self.blockActivated)
+        self.layout_left.addWidget(self.block_list_view, 1)  # Use stretch factor to control size
+
+        self.block_count_label = QLabel("")
+        self.layout_left.addWidget(self.block_count_label)
+
+        # Redraws of the block list are batched while blocks stream in
+        self.block_refresh_timer = QTimer(self)
+        self.block_refresh_timer.setSingleShot(True)
+        self.block_refresh_timer.setInterval(200)
+        self.block_refresh_timer.timeout.connect(self.refreshBlockList)
 
         # -------------MIDDLE-----------------------
         self.layout_middle = QVBoxLayout()
@@ -98,10 +210,41 @@ class SQLQueryApp(QWidget):
 
         label_execution = QLabel("Execution Plan")
         self.layout_middle.addWidget(label_execution)
-
-        self.plan_tree_widget = QTreeWidget()
-        self.plan_tree_widget.setHeaderLabel("Results:")
-        self.layout_middle.addWidget(self.plan_tree_widget)
+        self.preview_label = QLabel("")
+        self.preview_label.setWordWrap(True)
+        self.layout_middle.addWidget(self.preview_label)
+
+        # Search runs over text precomputed with the layout, not over the view's rows
+        self.plan_search_input = QLineEdit()
+        self.plan_search_input.setPlaceholderText("Search plan nodes, e.g. Seq Scan or orders")
+        self.plan_search_input.returnPressed.connect(self.searchPlan)
+        self.layout_middle.addWidget(self.plan_search_input)
+        self.plan_search_label = QLabel("")
+        self.layout_middle.addWidget(self.plan_search_label)
+
+        self.plan_tree_model = PlanTreeModel(self)
+        self.plan_tree_view = QTreeView()
+        self.plan_tree_view.setModel(self.plan_tree_model)
+        self.plan_tree_view.setUniformRowHeights(True)
+        self.layout_middle.addWidget(self.plan_tree_view, 1)
+
+        # Where the time of the last query went, database waits vs the tool itself
+        label_timings = QLabel("Timing Breakdown")
+        self.layout_middle.addWidget(label_timings)
+        self.timings_table = QTableWidget(0, len(TIMING_COLUMNS))
+        self.timings_table.setHorizontalHeaderLabels([title for title, _ in TIMING_COLUMNS])
+        self.timings_table.verticalHeader().setVisible(False)
+        self.timings_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.timings_table.setMaximumHeight(220)
+        self.layout_middle.addWidget(self.timings_table)
+        self.timings_label = QLabel("")
+        self.timings_label.setWordWrap(True)
+        self.layout_middle.addWidget(self.timings_label)
+        self.export_trace_button = QPushButton("Export Trace")
+        self.export_trace_button.setToolTip("Save the phases as Chrome trace events, for chrome://tracing or Perfetto")
+        self.export_trace_button.setEnabled(False)
+        self.export_trace_button.clicked.connect(self.exportTrace)
+        self.layout_middle.addWidget(self.export_trace_button)
 
         # -------------RIGHT SIDE----------------------
         self.layout_right = QVBoxLayout()
@@ -111,8 +254,10 @@ class SQLQueryApp(QWidget):
         self.layout_right.addWidget(label_blocks)
 
         self.graphics_view = QGraphicsView(self)
+        self.graphics_view.setDragMode(QGraphicsView.ScrollHandDrag)
         self.scene = QGraphicsScene(self)
         self.graphics_view.setScene(self.scene)
+        self.plan_scenes = LRUCache(PLAN_SCENE_CACHE_SIZE)
         self.layout_right.addWidget(self.graphics_view, 1)
 
         # Zoom Buttons
@@ -148,24 +293,130 @@ class SQLQueryApp(QWidget):
         self.setLayout(main_layout)
 
         
-    def displayExecutionPlan(self, plan):
-        self.plan_tree_widget.clear()
-        root_item = build_tree_widget_item(plan)
-        self.plan_tree_widget.addTopLevelItem(root_item)
-        self.plan_tree_widget.expandAll()  
-    
-    def visualizeQueryPlan(self):
-        query = self.sql_input.toPlainText()
+    def displayExecutionPlan(self, layout):
+        self.plan_search_input.clear()
+        self.plan_search_label.setText("")
+        with span("plan tree"):
+            self.plan_tree_model.setPlanLayout(layout)
+            # Only the top of the plan is opened, the rest is built when the user expands it
+            self.plan_tree_view.expandToDepth(PLAN_TREE_EXPAND_DEPTH - 1)
+            self.plan_tree_view.resizeColumnToContents(0)
+
+    def searchPlan(self):
+        self.plan_tree_model.setFilter(self.plan_search_input.text())
+        matches = self.plan_tree_model.matches
+        if not self.plan_tree_model.filter_text:
+            self.plan_search_label.setText("")
+            self.plan_tree_view.expandToDepth(PLAN_TREE_EXPAND_DEPTH - 1)
+            return
+        self.plan_search_label.setText(f"{len(matches)} matching nodes")
+        if not matches:
+            return
+        if len(matches) <= PLAN_SEARCH_EXPAND_LIMIT:
+            self.plan_tree_view.expandAll()
+        else:
+            self.plan_tree_view.expandToDepth(PLAN_TREE_EXPAND_DEPTH - 1)
+        first = self.plan_tree_model.indexForNode(matches[0])
+        self.plan_tree_view.setCurrentIndex(first)
+        self.plan_tree_view.scrollTo(first)
+
+    def visualizeQueryPlan(self, plan, layout=None):
         try:
-            plan = get_execution_plan(query)
-            display_tree_image(plan)
-            self.displayExecutionPlan(plan)
-            svg_item = QGraphicsSvgItem("plan-svg.svg")
-            self.scene.clear()
-            self.scene.addItem(svg_item)
-            self.graphics_view.fitInView(svg_item, Qt.KeepAspectRatio)
+            # The worker normally lays the plan out already, this is only a cache lookup then
+            if layout is None:
+                layout = get_plan_layout(plan)
+            previous, self.shown_layout = self.shown_layout, layout
+            if previous is not None and previous.shape == layout.shape:
+                self.updateExecutionPlan(previous, layout)
+                return
+            self.displayExecutionPlan(layout)
+            scene = self.plan_scenes.get(layout.key)
+            if scene is None:
+                with span("plan graph", rows=len(layout.nodes)):
+                    scene = self.drawPlanGraph(layout)
+                self.plan_scenes.put(layout.key, scene)
+            self.graphics_view.setScene(scene)
+            self.graphics_view.resetTransform()
+            root = scene.itemsBoundingRect()
+            if root.width() > self.graphics_view.viewport().width():
+                # Big plans open at full size on the root instead of being shrunk to nothing
+                x, y = self.planNodePosition(layout, 0)
+                self.graphics_view.centerOn(x + PLAN_NODE_WIDTH / 2, y + PLAN_NODE_HEIGHT)
+            else:
+                self.graphics_view.fitInView(root, Qt.KeepAspectRatio)
         except Exception as e:
             self.showErrorMessage("Error Visualizing Query Plan", str(e))
+
+    def updateExecutionPlan(self, previous, layout):
+        # Same tree as the plan shown: values are updated in place, expanded rows, zoom
+        # and scroll position stay where the user left them
+        with span("plan tree"):
+            self.plan_tree_model.updatePlanLayout(layout)
+        scene = self.plan_scenes.get(layout.key)
+        if scene is None:
+            scene = self.graphics_view.scene()
+            if scene is not self.plan_scenes.get(previous.key):
+                scene = self.drawPlanGraph(layout)
+            else:
+                with span("plan graph update", rows=len(layout.nodes)):
+                    self.updatePlanGraph(scene, layout)
+                # The scene now shows the new plan only
+                self.plan_scenes.invalidate(lambda key: key == previous.key)
+            self.plan_scenes.put(layout.key, scene)
+        if scene is not self.graphics_view.scene():
+            self.graphics_view.setScene(scene)
+
+    def planNodePosition(self, layout, node_id):
+        column, row = layout.positions[node_id]
+        return (column * (PLAN_NODE_WIDTH + PLAN_NODE_SPACING_X),
+                row * (PLAN_NODE_HEIGHT + PLAN_NODE_SPACING_Y))
+
+    def drawPlanGraph(self, layout):
+        # No parent, the scene cache decides how long a drawn plan lives
+        scene = QGraphicsScene()
+        edges = QPainterPath()
+        pen = QPen(QColor("#555555"))
+        misestimate_pen = QPen(QColor(MISESTIMATE_COLOR), 2)
+        brush = QBrush(QColor("#ffffff"))
+        hot_spot_brushes = [QBrush(QColor(color)) for color in HOT_SPOT_COLORS]
+        analysis = layout.analysis
+        font = QFont("Arial", 8)
+        node_items = []
+        for node in layout.nodes:
+            x, y = self.planNodePosition(layout, node.id)
+            if node.parent is not None:
+                parent_x, parent_y = self.planNodePosition(layout, node.parent)
+                edges.moveTo(parent_x + PLAN_NODE_WIDTH / 2, parent_y + PLAN_NODE_HEIGHT)
+                edges.lineTo(x + PLAN_NODE_WIDTH / 2, y)
+            # Hot spots are filled by rank, misestimated nodes get a red border
+            box = scene.addRect(x, y, PLAN_NODE_WIDTH, PLAN_NODE_HEIGHT,
+                                misestimate_pen if is_misestimated(analysis.nodes[node.id]) else pen,
+                                hot_spot_brushes[analysis.hot_spots.index(node.id)]
+                                if node.id in analysis.hot_spots else brush)
+            box.setToolTip(layout.labels[node.id])
+            text = QGraphicsSimpleTextItem(layout.labels[node.id], box)
+            text.setFont(font)
+            text.setPos(x + 4, y + 4)
+            node_items.append((box, text))
+        # All edges in one item, thousands of line items make the scene slow to build
+        scene.addPath(edges, pen).setZValue(-1)
+        # Kept so a plan of the same shape can be shown by updating the items
+        scene.node_items = node_items
+        return scene
+
+    def updatePlanGraph(self, scene, layout):
+        pen = QPen(QColor("#555555"))
+        misestimate_pen = QPen(QColor(MISESTIMATE_COLOR), 2)
+        brush = QBrush(QColor("#ffffff"))
+        hot_spot_brushes = [QBrush(QColor(color)) for color in HOT_SPOT_COLORS]
+        analysis = layout.analysis
+        for node, (box, text) in zip(layout.nodes, scene.node_items):
+            box.setPen(misestimate_pen if is_misestimated(analysis.nodes[node.id]) else pen)
+            box.setBrush(hot_spot_brushes[analysis.hot_spots.index(node.id)]
+                         if node.id in analysis.hot_spots else brush)
+            box.setToolTip(layout.labels[node.id])
+            text.setText(layout.labels[node.id])
+
     def zoomIn(self):
         self.graphics_view.scale(1.2, 1.2)
 
@@ -173,26 +424,401 @@ class SQLQueryApp(QWidget):
         self.graphics_view.scale(0.8, 0.8)
     def executeQuery(self):
         query = self.sql_input.toPlainText()
+        self.stopPreview()
+        # A newer query replaces the one in flight instead of queueing behind it
+        if self.worker is not None:
+            self.worker.cancel()
+        self.clearResults()
+
+        estimate_only = self.estimate_only_checkbox.isChecked()
+        worker = QueryWorker(query, estimate_only=estimate_only, history=self.plan_history,
+                             approximate=self.approximate_checkbox.isChecked(), spill=not estimate_only,
+                             memory_limit_mb=self.memory_limit_mb)
+        self.spilling_workers.add(worker)
+        worker.signals.tableStarted.connect(partial(self.tableStarted, worker))
+        worker.signals.blocksReceived.connect(partial(self.blocksReceived, worker))
+        worker.signals.tableFinished.connect(partial(self.tableFinished, worker))
+        worker.signals.tablesSkipped.connect(partial(self.tablesSkipped, worker))
+        worker.signals.approximationUnavailable.connect(partial(self.approximationUnavailable, worker))
+        worker.signals.finished.connect(partial(self.queryFinished, worker))
+        worker.signals.cancelled.connect(partial(self.queryCancelled, worker))
+        worker.signals.error.connect(partial(self.queryFailed, worker))
+        self.worker = worker
+        self.cancel_button.setEnabled(True)
+        self.status_label.setText("Running query...")
+        self.thread_pool.start(worker)
+
+    def stopPreview(self):
+        # The text in the editor is taken as previewed, e.g. a query that runs or a session's
+        # own query, and a preview still on its way never replaces that plan
+        self.preview_timer.stop()
+        self.previewed_query = normalize_query(self.sql_input.toPlainText())
+        if self.preview_worker is not None:
+            self.preview_worker.cancel()
+            self.preview_worker = None
+
+    def queryEdited(self):
+        if self.preview_checkbox.isChecked():
+            self.preview_timer.start()
+
+    def previewPlan(self):
+        query = self.sql_input.toPlainText()
+        if not query.strip() or normalize_query(query) == self.previewed_query:
+            return
+        self.previewed_query = normalize_query(query)
+        # Only the newest edit matters, the plan still being made for an older one is dropped
+        if self.preview_worker is not None:
+            self.preview_worker.cancel()
+        worker = QueryWorker(query, estimate_only=True)
+        worker.signals.finished.connect(partial(self.previewFinished, worker))
+        worker.signals.error.connect(partial(self.previewFailed, worker))
+        self.preview_worker = worker
+        self.preview_label.setText("Planning...")
+        self.thread_pool.start(worker)
+
+    def previewFinished(self, worker, plan, results, layout):
+        if worker is not self.preview_worker:
+            return
+        self.preview_worker = None
+        # A running query's own plan replaces the preview when it finishes
+        self.preview_label.setText("Preview: estimated plan of the query being edited, not run yet")
+        self.visualizeQueryPlan(plan, layout)
+
+    def previewFailed(self, worker, message):
+        if worker is not self.preview_worker:
+            return
+        self.preview_worker = None
+        self.preview_label.setText(f"Preview: {message.splitlines()[0]}")
+
+    def clearResults(self):
+        # Kept as runs so the next query's blocks can be compared against them
+        self.previous_runs = {table_name: index.runs() for table_name, index in self.results.items()}
+        self.results = {}
+        self.headers = {}
+        self.skipped_tables = []
+        self.approximation_note = None
+        self.plan = None
+        self.save_session_button.setEnabled(False)
+        self.tab_widget.clear()
+        self.showBlocksForTable(None, None)
+        self.removeSpillDirectory()
+
+    def removeSpillDirectory(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    def releaseSpillDirectory(self, worker):
+        # The worker has stopped writing. The results shown may still read the spilled
+        # keys of the current query, a replaced query's directory goes right away.
+        self.spilling_workers.discard(worker)
+        if worker is self.worker:
+            self.spill_dir = worker.spill_dir
+        elif worker.spill_dir is not None:
+            shutil.rmtree(worker.spill_dir, ignore_errors=True)
+
+    def saveSession(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Session", "query-session", "Session directory (*)")
+        if not path:
+            return
         try:
-            # results contains a dictionary of table names and their records
-            self.results = execute_query_in_database(query)
-            self.tab_widget.clear()
-            for table_name in self.results:
-                # Create a new tab for each table
-                tab = QWidget()
-                self.tab_widget.addTab(tab, table_name)
-                self.tab_widget.setCurrentWidget(tab)
-            self.visualizeQueryPlan()
-
+            save_session(path, self.sql_input.toPlainText(), self.plan, self.results, self.headers)
+        except Exception as e:
+            self.showErrorMessage("Error Saving Session", str(e))
+            return
+        self.status_label.setText(f"Session saved to {path}")
+
+    def openSession(self):
+        path = QFileDialog.getExistingDirectory(self, "Open Session")
+        if not path:
+            return
+        try:
+            session = load_session(path)
         except Exception as e:
-            self.showErrorMessage("Error Executing Query", str(e))
+            self.showErrorMessage("Error Opening Session", str(e))
+            return
+        if self.worker is not None:
+            self.worker.cancel()
+            self.finishQuery("")
+        self.clearResults()
+        # Opening a session doesn't touch the database, not even for a preview
+        self.sql_input.setPlainText(session.query)
+        self.stopPreview()
+        self.results = session.results
+        self.headers = session.headers
+        self.plan = session.plan
+        for table_name, index in self.results.items():
+            self.tab_widget.addTab(QWidget(), table_name)
+            self.tab_widget.setTabToolTip(self.tabForTable(table_name), f"{index.count} tuples in {len(index)} blocks")
+        self.visualizeQueryPlan(session.plan)
+        self.preview_label.setText("")
+        self.save_session_button.setEnabled(True)
+        saved_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(session.saved_at))
+        self.status_label.setText(f"Opened the session saved at {saved_at}")
+
+    def showTimings(self, trace):
+        self.trace = trace
+        phases = trace.breakdown()
+        self.timings_table.setRowCount(len(phases))
+        for row, phase in enumerate(phases):
+            for column, (_, key) in enumerate(TIMING_COLUMNS):
+                value = phase.get(key, "")
+                if isinstance(value, float):
+                    value = f"{value:.1f}"
+                self.timings_table.setItem(row, column, QTableWidgetItem(str(value)))
+        self.timings_table.resizeColumnsToContents()
+        totals = trace.totals()
+        pool = get_pool().stats()
+        self.timings_label.setText(
+            f"Total {totals['total_ms']:.1f} ms: database {totals['database_ms']:.1f} ms, "
+            f"client {totals['client_ms']:.1f} ms. Pool: {pool['size']} of {pool['max_size']} connections, "
+            f"{pool['reused']} reused, {pool['waits']} waits")
+        self.export_trace_button.setEnabled(True)
+
+    def exportTrace(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Export Trace", "query-trace.json", "Trace (*.json)")
+        if not path:
+            return
+        try:
+            self.trace.save(path)
+        except OSError as e:
+            self.showErrorMessage("Error Exporting Trace", str(e))
+
+    def clearPlanCache(self):
+        invalidate_plan_cache()
+        invalidate_schema_catalog()
+        self.status_label.setText("Plan and schema caches cleared")
+
+    def closeEvent(self, event):
+        # Don't leave a statement running on the server after the window is gone
+        self.cancelQuery()
+        self.thread_pool.waitForDone()
+        if self.plan_history is not None:
+            self.plan_history.close()
+        self.removeSpillDirectory()
+        # Their signals are never delivered once the window is gone
+        for worker in self.spilling_workers:
+            if worker.spill_dir is not None:
+                shutil.rmtree(worker.spill_dir, ignore_errors=True)
+        self.spilling_workers.clear()
+        super().closeEvent(event)
+
+    def showPlanHistory(self):
+        # Waiting for the history writer can take a write interval, so never on the GUI thread
+        worker = PlanHistoryWorker(self.plan_history, self.sql_input.toPlainText(), PLAN_HISTORY_RUNS)
+        worker.signals.finished.connect(self.planHistoryLoaded)
+        worker.signals.error.connect(self.planHistoryFailed)
+        self.plan_history_button.setEnabled(False)
+        self.thread_pool.start(worker)
+
+    def planHistoryFailed(self, message):
+        self.plan_history_button.setEnabled(True)
+        self.showErrorMessage("Error Reading Plan History", message)
+
+    def planHistoryLoaded(self, runs):
+        self.plan_history_button.setEnabled(True)
+        if not runs:
+            self.showErrorMessage("Plan History", "This query hasn't been run yet")
+            return
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Plan History")
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel(f"{len(runs)} runs of this query, newest first. "
+                                "Select an earlier run to compare it with the newest."))
+
+        runs_table = QTableWidget(len(runs), 6)
+        runs_table.setHorizontalHeaderLabels(["Recorded", "Database", "Plan", "Cost", "Execution ms", "Mode"])
+        runs_table.verticalHeader().setVisible(False)
+        runs_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        runs_table.setSelectionBehavior(QTableWidget.SelectRows)
+        runs_table.setSelectionMode(QTableWidget.SingleSelection)
+        for row, run in enumerate(runs):
+            values = [
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run.recorded_at)),
+                run.database or "",
+                run.plan_hash[:10],
+                "" if run.total_cost is None else f"{run.total_cost:.2f}",
+                "" if run.execution_ms is None else f"{run.execution_ms:.3f}",
+                "analyzed" if run.analyzed else "estimated",
+            ]
+            for column, value in enumerate(values):
+                runs_table.setItem(row, column, QTableWidgetItem(value))
+        runs_table.resizeColumnsToContents()
+        layout.addWidget(runs_table)
+
+        diff_label = QLabel("")
+        layout.addWidget(diff_label)
+        diff_tree = QTreeWidget()
+        diff_tree.setHeaderLabels(["Node", "Change", "Metric", "Before", "After"])
+        layout.addWidget(diff_tree, 1)
+
+        def showDiff():
+            selected = runs_table.selectionModel().selectedRows()
+            if not selected:
+                return
+            old, new = runs[selected[0].row()], runs[0]
+            self.showPlanDiff(diff_tree, old.plan, new.plan)
+            if old.plan_hash == new.plan_hash:
+                diff_label.setText("Identical plan")
+            elif plan_flipped(old.plan, new.plan):
+                diff_label.setText("Plan changed shape: the planner chose a different plan")
+                diff_label.setStyleSheet("color: #b00000; font-weight: bold;")
+                return
+            else:
+                diff_label.setText("Same plan shape, different costs or timings")
+            diff_label.setStyleSheet("")
+
+        runs_table.itemSelectionChanged.connect(showDiff)
+        if len(runs) > 1:
+            runs_table.selectRow(1)
+
+        dialog.setMinimumWidth(800)
+        dialog.setMinimumHeight(600)
+        dialog.exec_()
+
+    def showPlanDiff(self, diff_tree, old_plan, new_plan):
+        diff_tree.clear()
+        items = {}
+        for diff in diff_plans(old_plan, new_plan):  # parents come before their children
+            parent = items.get(diff.path.rpartition(".")[0], diff_tree)
+            item = QTreeWidgetItem(parent, [diff.node, diff.change])
+            items[diff.path] = item
+            color = PLAN_DIFF_COLORS.get(diff.change)
+            for key, (before, after) in diff.metrics.items():
+                if before != after:
+                    QTreeWidgetItem(item, ["", "", key, str(before), str(after)])
+            if color:
+                for column in range(diff_tree.columnCount()):
+                    item.setBackground(column, QColor(color))
+        diff_tree.expandAll()
+        for column in range(diff_tree.columnCount()):
+            diff_tree.resizeColumnToContents(column)
+
+    def cancelQuery(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.status_label.setText("Stopping the sampling..." if self.worker.approximate else "Cancelling...")
+
+    def tableStarted(self, worker, table_name, index, header):
+        if worker is not self.worker:
+            return
+        # Create a new tab for each table as soon as its first batch arrives
+        self.results[table_name] = index
+        self.headers[table_name] = header
+        tab = QWidget()
+        self.tab_widget.addTab(tab, table_name)
+        self.tab_widget.setCurrentWidget(tab)
+        self.showProgress(table_name, index)
+
+    def blocksReceived(self, worker, table_name, index, new_blocks):
+        if worker is not self.worker:
+            return
+        if self.tab_widget.tabText(self.tab_widget.currentIndex()) == table_name:
+            if not self.block_refresh_timer.isActive():
+                self.block_refresh_timer.start()
+        self.showProgress(table_name, index)
+
+    def tableFinished(self, worker, table_name, index):
+        if worker is not self.worker:
+            return
+        tab = self.tabForTable(table_name)
+        if index.error:
+            self.tab_widget.tabBar().setTabTextColor(tab, QColor("#b00000"))
+            self.tab_widget.setTabToolTip(tab, index.error)
+        else:
+            self.tab_widget.setTabToolTip(tab, f"{index.count} tuples in {len(index)} blocks")
+        if table_name == self.current_table:
+            self.refreshBlockList()
+
+    def tablesSkipped(self, worker, table_names):
+        if worker is not self.worker:
+            return
+        # Listed with the other tables but greyed out, there are no blocks to show
+        self.skipped_tables = table_names
+        for table_name in table_names:
+            tab = self.tab_widget.addTab(QWidget(), table_name)
+            self.tab_widget.setTabEnabled(tab, False)
+            self.tab_widget.setTabToolTip(tab, SKIPPED_TABLE_REASON)
+
+    def approximationUnavailable(self, worker, reason):
+        if worker is not self.worker:
+            return
+        self.approximation_note = f"Read every block instead of sampling. {reason}."
+        self.status_label.setText(f"{self.approximation_note} Running query...")
+
+    def tabForTable(self, table_name):
+        for tab in range(self.tab_widget.count()):
+            if self.tab_widget.tabText(tab) == table_name:
+                return tab
+        return -1
+
+    def showProgress(self, table_name, index):
+        if index.sample is not None:
+            self.status_label.setText(f"Sampling {table_name}: {self.estimateText(index.sample.estimate())}")
+            return
+        self.status_label.setText(f"Reading {table_name}: {index.count} tuples in {len(index)} blocks")
+
+    def estimateText(self, estimate):
+        if estimate.exact:
+            return f"exactly {estimate.blocks} blocks, {estimate.tuples} tuples (every block sampled)"
+        sampled = estimate.sampled_blocks / estimate.relation_blocks if estimate.relation_blocks else 0.0
+        tuples_high = "?" if estimate.tuples_high is None else estimate.tuples_high
+        return (f"about {estimate.blocks} blocks ({estimate.blocks_low} to {estimate.blocks_high}), "
+                f"{estimate.tuples} tuples ({estimate.tuples_low} to {tuples_high}), 95% confidence, "
+                f"from {sampled:.1%} of the relation")
+
+    def queryFinished(self, worker, plan, results, layout):
+        self.releaseSpillDirectory(worker)
+        if worker is not self.worker:
+            return
+        stopped_early = any(index.sample is not None and not index.sample.estimate().exact for index in results.values())
+        status = "Approximate result, sampling was stopped before every block was read. " if stopped_early else ""
+        if self.approximation_note:
+            status += f"{self.approximation_note} "
+        if self.skipped_tables:
+            status += f"No blocks for {', '.join(self.skipped_tables)}. {SKIPPED_TABLE_REASON}"
+        self.finishQuery(status.strip())
+        self.plan = plan
+        self.save_session_button.setEnabled(True)
+        self.preview_label.setText("")
+        # The drawing below is timed into the same trace as the worker's phases
+        with activate(worker.trace):
+            with span("block list"):
+                # Redraw the current tab in block order now that every batch is in
+                self.tabChanged(self.tab_widget.currentIndex())
+            self.visualizeQueryPlan(plan, layout)
+        self.showTimings(worker.trace)
+        truncated = [table_name for table_name in results if results[table_name].truncated]
+        if truncated:
+            self.showErrorMessage("Memory Limit Reached",
+                f"Stopped reading blocks for {', '.join(truncated)} after {MAX_CTID_MEMORY_MB} MB of ctids")
+        failed = [f"{table_name}: {results[table_name].error}" for table_name in results if results[table_name].error]
+        if failed:
+            self.showErrorMessage("Some Tables Failed", "\n".join(failed))
+
+    def queryCancelled(self, worker):
+        self.releaseSpillDirectory(worker)
+        if worker is self.worker:
+            self.finishQuery("Query cancelled")
+
+    def queryFailed(self, worker, message):
+        self.releaseSpillDirectory(worker)
+        if worker is self.worker:
+            self.finishQuery("")
+            self.showErrorMessage("Error Executing Query", message)
+
+    def finishQuery(self, status):
+        self.worker = None
+        self.cancel_button.setEnabled(False)
+        self.status_label.setText(status)
 
     def tabChanged(self, index):
         if index >= 0:
             table_name = self.tab_widget.tabText(index)
             if table_name in self.results:
                 result = self.results[table_name]
-                self.generateBlockAccessedButtons(result, table_name)
+                self.showBlocksForTable(result, table_name)
             else:
                 self.tab_widget.setCurrentIndex(0)
 
@@ -203,108 +829,125 @@ class SQLQueryApp(QWidget):
             error_dialog.setText(message)
             error_dialog.exec_()
     
-    def generateBlockAccessedButtons(self, results, table_name):
-        self.clearButtons()
-        self.record_dict = {}
-        for record in results:
-            elements = [int(x) for x in record[0][1:-1].split(',')]
-
-            if elements[0] not in self.record_dict:
-                self.record_dict[elements[0]] = [record]
-            else:
-                self.record_dict[elements[0]].append(record)
-        for block in self.record_dict:
-            self.record_dict[block] = sorted(self.record_dict[block], key=lambda x: int(x[0].split(',')[1][:-1]))
+    def showBlocksForTable(self, index, table_name):
+        self.block_refresh_timer.stop()
+        self.current_table = table_name
+        self.header = self.headers.get(table_name)
+        self.block_list_model.setBlockIndex(index)
+        self.updateBlockCount()
+        self.showBlockHeatmap()
+
+    def refreshBlockList(self):
+        self.block_list_model.refresh()
+        self.updateBlockCount()
+        self.showBlockHeatmap()
+
+    def showBlockHeatmap(self):
+        index = self.block_list_model.block_index
+        if index is None:
+            self.heatmap_label.clear()
+            self.block_summary_label.setText("")
+            return
+        runs = index.runs()
+        relation_blocks = index.relation_blocks or (int(runs.ends[-1]) if len(runs.ends) else 0)
+        # Small relations get one cell per block, the rest of the last row stays blank
+        cells = max(1, min(relation_blocks, HEATMAP_COLUMNS * HEATMAP_ROWS))
+        fractions = runs.heatmap(relation_blocks, cells)
+        if index.sample is not None:
+            # Share of the sampled blocks of each cell, cells with no sampled block stay blank
+            sampled = index.sample.sampled_runs().heatmap(relation_blocks, cells)
+            fractions = np.divide(fractions, sampled, out=np.full(cells, np.nan), where=sampled > 0)
+        fractions = np.pad(fractions, (0, -cells % HEATMAP_COLUMNS), constant_values=np.nan)
+        self.heatmap_label.setPixmap(QPixmap.fromImage(self.heatmapImage(fractions, HEATMAP_COLUMNS)))
+        self.heatmap_label.setToolTip(f"Blocks 0 to {relation_blocks - 1}, left to right and top to bottom")
+
+        if index.sample is not None:
+            self.block_summary_label.setText(f"Approximate: {self.estimateText(index.sample.estimate())}. "
+                                             f"The list shows the {len(runs)} accessed blocks of the sampled windows")
+            return
+        summary = f"Incomplete, {index.error}. " if index.error else ""
+        summary += f"{len(runs)} blocks"
+        if index.relation_blocks:
+            summary += f" of {index.relation_blocks} ({index.fraction_touched():.1%} of the relation)"
+        if runs.run_count():
+            summary += f" in {runs.run_count()} runs, {len(runs) / runs.run_count():.1f} blocks per run"
+        previous = self.previous_runs.get(self.current_table)
+        if previous is not None:
+            summary += (f". Previous query: {len(runs.intersection(previous))} blocks in common, "
+                        f"{len(runs.union(previous))} together")
+        self.block_summary_label.setText(summary)
+
+    def heatmapImage(self, fractions, columns):
+        colors = HEATMAP_EMPTY_COLOR + np.outer(fractions, HEATMAP_FULL_COLOR - HEATMAP_EMPTY_COLOR)
+        colors[np.isnan(fractions)] = HEATMAP_PADDING_COLOR
+        colors = colors.round().astype(np.uint32)
+        pixels = 0xFF000000 | (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+        pixels = np.ascontiguousarray(pixels.reshape(-1, columns))
+        image = QImage(pixels.data, columns, pixels.shape[0], QImage.Format_RGB32)
+        # copy() detaches the image from the numpy buffer
+        return image.copy().scaled(columns * HEATMAP_CELL_SIZE, pixels.shape[0] * HEATMAP_CELL_SIZE)
+
+    def updateBlockCount(self):
+        shown = self.block_list_model.rowCount()
+        total = self.block_list_model.totalBlocks()
+        if shown == total:
+            self.block_count_label.setText(f"{total} blocks")
+        else:
+            self.block_count_label.setText(f"{shown} of {total} blocks")
+
+    def filterBlocks(self):
+        try:
+            self.block_list_model.setFilter(self.block_filter_input.text())
+        except ValueError as e:
+            self.showErrorMessage("Invalid Filter", str(e))
+        self.updateBlockCount()
 
-        header = get_columns_for_table(table_name)
+    def jumpToBlock(self):
+        try:
+            block = int(self.block_jump_input.text())
+        except ValueError:
+            self.showErrorMessage("Invalid Block", "Enter a block number")
+            return
+        row = self.block_list_model.rowForBlock(block)
+        if row >= 0:
+            model_index = self.block_list_model.index(row)
+            self.block_list_view.setCurrentIndex(model_index)
+            self.block_list_view.scrollTo(model_index, QListView.PositionAtTop)
+
+    def blockActivated(self, model_index):
+        block = model_index.data(BlockListModel.BlockRole)
+        if block is not None and self.current_table is not None:
+            self.showRecordsForBlock(self.current_table, block, self.header)
+
+    def showRecordsForBlock(self, table_name, block, header):
+        index = self.results[table_name]
+        if block in index:
+            # A database round trip, or a wait for a free connection, so never on the GUI thread
+            worker = BlockRecordsWorker(table_name, block, index.offsets(block).tolist())
+            worker.signals.finished.connect(partial(self.blockRecordsFetched, block, header))
+            worker.signals.error.connect(partial(self.showErrorMessage, "Error Fetching Records"))
+            self.thread_pool.start(worker)
+
+    def blockRecordsFetched(self, block, header, records):
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f"Records for Block {block}")
+        layout = QVBoxLayout()
+
+        table = QTableView()
+        table.setModel(BlockRecordsModel(records, header, table))
+
+        table.setEditTriggers(QTableView.NoEditTriggers)  # Disable editing
+        table.setShowGrid(True)
+        table.setLineWidth(1)  
+        table.setStyleSheet("color: black;")
+        table.horizontalHeader().setStyleSheet("QHeaderView::section { border: 1px solid black; background-color: lightgrey;}")
+
+        table.verticalHeader().setStyleSheet("QHeaderView::section { border: 1px solid black;background-color: lightgrey; }")
+        layout.addWidget(table)
+        table.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         
-        for key in sorted(self.record_dict.keys()):
-            temp = QPushButton(f"Block {key}")
-            self.layout_blocks.addWidget(temp)
-            temp.clicked.connect(lambda _, block=key: self.showRecordsForBlock(block, header))
-            
-    def showRecordsForBlock(self, block, header):
-  
-        if block in self.record_dict:
-            records = self.record_dict[block]
-
-     
-            dialog = QDialog(self)
-            dialog.setWindowTitle(f"Records for Block {block}")
-            layout = QVBoxLayout()
-
-            table = QTableWidget(len(records), len(records[0]))
-            
-            table.setHorizontalHeaderLabels(header)
-
-            for row, record in enumerate(records):
-                for col, field in enumerate(record):
-                    item = QTableWidgetItem(str(field))
-                    table.setItem(row, col, item)
-
-    
-            table.setEditTriggers(QTableWidget.NoEditTriggers)  # Disable editing
-            table.setShowGrid(True)
-            table.setLineWidth(1)  
-            table.setStyleSheet("color: black;")
-            table.horizontalHeader().setStyleSheet("QHeaderView::section { border: 1px solid black; background-color: lightgrey;}")
-
-            table.verticalHeader().setStyleSheet("QHeaderView::section { border: 1px solid black;background-color: lightgrey; }")
-            layout.addWidget(table)
-            table.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-            
-            dialog.setMinimumWidth(600)
-            dialog.setMinimumHeight(400)
-
-            dialog.setLayout(layout)
-            dialog.exec_()
-                    
-    def clearButtons(self):
-        # Remove existing buttons from the layout
-        while self.layout_blocks.count() > 0:
-            item = self.layout_blocks.itemAt(0)
-            widget = item.widget()
-            if widget is not None:
-                widget.deleteLater()
-            self.layout_blocks.removeItem(item)
-
-db_host = ""
-db_name = ""
-db_user = ""
-db_password = ""
-
-def startWindow():
-    global db_host, db_name, db_user, db_password  # Use the global keyword
-    app = QApplication(sys.argv)
-
-    palette = QPalette()
-    palette.setColor(QPalette.Window, QColor(240, 240, 240))
-    palette.setColor(QPalette.WindowText, QColor(0, 0, 0))
-    app.setPalette(palette)
-
-    connected = False
-    while not connected:
-        window = SQLQueryApp()
-        window.show()
-
-        dialog = ConfigDialog()
-        result = dialog.exec_()
-
-        if result == QDialog.Accepted:
-            db_host, db_name, db_user, db_password = dialog.get_connection_details()
-            try:
-                psycopg2.connect(
-                    host=db_host,
-                    database=db_name,
-                    user=db_user,
-                    password=db_password
-                )
-                connected = True  
-            except Exception as e:
-                QMessageBox.critical(None, "Connection Error", f"Error connecting to the database: {str(e)}")
-
-    sys.exit(app.exec_())
-
-
-   
+        dialog.setMinimumWidth(600)
+        dialog.setMinimumHeight(400)
 
+        dialog.setLayout(layout)
+        dialog.exec_()
@@ -0,0 +1,290 @@
+import numpy as np
+from PyQt5.QtCore import Qt, QAbstractItemModel, QAbstractListModel, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QColor
+
+from blocks import filter_blocks
+from plan_analysis import is_misestimated, time_share
+
+# Backgrounds of the hot spots, hottest first
+HOT_SPOT_COLORS = ("#f4a6a6", "#f8c4a0", "#fbd9a6", "#fde8b8", "#fff4d1")
+MISESTIMATE_COLOR = "#b00000"
+
+
+class BlockListModel(QAbstractListModel):
+    """Rows are produced on demand from the block array, no widget per block."""
+
+    BlockRole = Qt.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.block_index = None
+        self.filter_text = ""
+        self._blocks = np.empty(0, dtype=np.uint64)
+
+    def setBlockIndex(self, index):
+        self.block_index = index
+        self.refresh()
+
+    def setFilter(self, text):
+        # Raises ValueError on a malformed filter and keeps the previous one
+        filter_blocks(np.empty(0, dtype=np.uint64), text)
+        self.filter_text = text
+        self.refresh()
+
+    def refresh(self):
+        self.beginResetModel()
+        if self.block_index is None:
+            self._blocks = np.empty(0, dtype=np.uint64)
+        else:
+            self._blocks = filter_blocks(self.block_index.blocks(), self.filter_text)
+        self.endResetModel()
+
+    def rowForBlock(self, block):
+        # Row of the block, or of the nearest shown block after it
+        row = int(np.searchsorted(self._blocks, block))
+        return min(row, len(self._blocks) - 1)
+
+    def totalBlocks(self):
+        return 0 if self.block_index is None else len(self.block_index)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._blocks)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._blocks):
+            return None
+        block = int(self._blocks[index.row()])
+        if role == Qt.DisplayRole:
+            return f"Block {block}"
+        if role == self.BlockRole:
+            return block
+        return None
+
+
+class BlockRecordsModel(QAbstractTableModel):
+    """Tuples of one block, handed to the view in chunks as it scrolls."""
+
+    CHUNK_SIZE = 100
+
+    def __init__(self, records, header, parent=None):
+        super().__init__(parent)
+        self.records = records
+        self.header = header
+        self._loaded = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.header)
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._loaded < len(self.records)
+
+    def fetchMore(self, parent):
+        count = min(self.CHUNK_SIZE, len(self.records) - self._loaded)
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+        self._loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        record = self.records[index.row()]
+        if index.column() >= len(record):
+            return None
+        return str(record[index.column()])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.header[section] if section < len(self.header) else None
+        return str(section + 1)
+
+
+class PlanTreeModel(QAbstractItemModel):
+    """Plan nodes as rows and their main attributes as columns.
+
+    Indexes point at nodes of the flattened plan, so the view only asks for
+    the rows of nodes it expands and no item objects are built up front.
+    """
+
+    COLUMNS = (
+        ("Node", None), ("Startup Cost", "Startup Cost"), ("Total Cost", "Total Cost"),
+        ("Plan Rows", "Plan Rows"), ("Actual Time (ms)", "Actual Total Time"),
+        ("Actual Rows", "Actual Rows"), ("Loops", "Actual Loops"),
+        ("Shared Hit", "Shared Hit Blocks"), ("Shared Read", "Shared Read Blocks"),
+        ("Self Time (ms)", "Self Time"), ("Self Hit", "Self Hit Blocks"), ("Self Read", "Self Read Blocks"),
+    )
+    BUFFER_KEYS = ("Shared Hit Blocks", "Shared Read Blocks")
+    # Columns taken from the layout's analysis instead of the plan
+    SELF_BUFFER_KEYS = {"Self Hit Blocks": "Shared Hit Blocks", "Self Read Blocks": "Shared Read Blocks"}
+    ROW_KEYS = ("Plan Rows", "Actual Rows")
+    NodeRole = Qt.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.plan_layout = None
+        self._index_nodes = []  # nodes the model's indexes point at
+        self.filter_text = ""
+        self.matches = []
+        self._children = {}
+        self._roots = []
+        self._rows = {}
+
+    def setPlanLayout(self, layout):
+        self.plan_layout = layout
+        self._index_nodes = layout.nodes
+        self.setFilter("")
+
+    def updatePlanLayout(self, layout):
+        # A plan of the same shape only changes values: the view keeps its expanded rows,
+        # selection and scroll position. Returns False when the model had to be reset.
+        if self.plan_layout is None or self.plan_layout.shape != layout.shape:
+            self.setPlanLayout(layout)
+            return False
+        if self.filter_text:
+            # Matches depend on the values, so the filtered tree is rebuilt
+            self.plan_layout = layout
+            self.setFilter(self.filter_text)
+            return True
+        self.layoutAboutToBeChanged.emit()
+        # Indexes keep pointing at the nodes of the first layout, rows are the same
+        self.plan_layout = layout
+        self.layoutChanged.emit()
+        return True
+
+    def setFilter(self, text):
+        # Keeps the matching nodes and the path down to them, using the layout's search text
+        self.beginResetModel()
+        self.filter_text = text.strip().lower()
+        self.matches = []
+        self._children = {}
+        self._roots = []
+        self._rows = {}
+        if self.plan_layout is not None:
+            nodes = self.plan_layout.nodes
+            if not self.filter_text:
+                self._roots = [0]
+            else:
+                self.matches = [node_id for node_id, text in enumerate(self.plan_layout.search_text)
+                                if self.filter_text in text]
+                visible = set()
+                for node_id in self.matches:
+                    while node_id is not None and node_id not in visible:
+                        visible.add(node_id)
+                        node_id = nodes[node_id].parent
+                self._roots = [0] if visible else []
+                for node_id in sorted(visible):
+                    self._children[node_id] = [child for child in nodes[node_id].children if child in visible]
+            # Row of every node under its parent, partitioned plans can have thousands of siblings
+            for node_id in range(len(nodes)) if not self.filter_text else self._children:
+                for row, child in enumerate(self.childIds(node_id)):
+                    self._rows[child] = row
+            for row, node_id in enumerate(self._roots):
+                self._rows[node_id] = row
+        self.endResetModel()
+
+    def childIds(self, node_id):
+        if node_id is None:
+            return self._roots
+        if self.filter_text:
+            return self._children.get(node_id, [])
+        return self.plan_layout.nodes[node_id].children
+
+    def indexForNode(self, node_id):
+        node = self._index_nodes[node_id]
+        return self.createIndex(self._rows[node_id], 0, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if self.plan_layout is None:
+            return QModelIndex()
+        children = self.childIds(parent.internalPointer().id if parent.isValid() else None)
+        if row < 0 or row >= len(children) or column < 0 or column >= len(self.COLUMNS):
+            return QModelIndex()
+        return self.createIndex(row, column, self._index_nodes[children[row]])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is None:
+            return QModelIndex()
+        return self.indexForNode(parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if self.plan_layout is None or parent.column() > 0:
+            return 0
+        return len(self.childIds(parent.internalPointer().id if parent.isValid() else None))
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        return self.rowCount(parent) > 0
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node_id = index.internalPointer().id
+        plan = self.plan_layout.nodes[node_id].plan
+        if role == self.NodeRole:
+            return node_id
+        analysis = self.plan_layout.analysis
+        key = self.COLUMNS[index.column()][1]
+        if role == Qt.ToolTipRole:
+            return "\n".join(self.analysisNotes(node_id) +
+                             [f"{key}: {value}" for key, value in plan.items() if key != "Plans"])
+        if role == Qt.BackgroundRole:
+            if node_id in analysis.hot_spots:
+                return QColor(HOT_SPOT_COLORS[analysis.hot_spots.index(node_id)])
+            return None
+        if role == Qt.ForegroundRole:
+            if key in self.ROW_KEYS and is_misestimated(analysis.nodes[node_id]):
+                return QColor(MISESTIMATE_COLOR)
+            return None
+        if role != Qt.DisplayRole:
+            return None
+        if index.column() == 0:
+            return self.plan_layout.labels[node_id].split("\n", 1)[0]
+        node_stats = analysis.nodes[node_id]
+        if key == "Self Time":
+            if not analysis.analyzed:
+                return None
+            return f"{node_stats.exclusive_ms:.3f} ({time_share(analysis, node_id):.0%})"
+        if key in self.SELF_BUFFER_KEYS:
+            blocks = node_stats.buffers.get(self.SELF_BUFFER_KEYS[key])
+            return None if blocks is None else f"{blocks} ({blocks * 8} kB)"
+        if key not in plan:
+            return None
+        if key in self.BUFFER_KEYS:
+            return f"{plan[key]} ({plan[key] * 8} kB)"
+        return str(plan[key])
+
+    def analysisNotes(self, node_id):
+        analysis = self.plan_layout.analysis
+        node_stats = analysis.nodes[node_id]
+        notes = []
+        if node_id in analysis.hot_spots:
+            measure = "time" if analysis.analyzed else "estimated cost"
+            notes.append(f"Hot spot #{analysis.hot_spots.index(node_id) + 1}: "
+                         f"{time_share(analysis, node_id):.0%} of the {measure} is spent in this node itself")
+        if is_misestimated(node_stats):
+            direction = "under" if node_stats.actual_rows > node_stats.estimated_rows else "over"
+            notes.append(f"Rows {direction}estimated {node_stats.misestimate:.0f}x: "
+                         f"{node_stats.estimated_rows} planned, {node_stats.actual_rows} actual")
+        if node_stats.processes > 1:
+            notes.append(f"Run by {node_stats.processes} processes in parallel")
+        return notes + [""] if notes else []
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or orientation != Qt.Horizontal:
+            return None
+        return self.COLUMNS[section][0]
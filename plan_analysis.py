@@ -0,0 +1,154 @@
+import re
+from collections import namedtuple
+
+# Buffer counters attributed to the node that did the I/O itself
+BUFFER_KEYS = (
+    "Shared Hit Blocks", "Shared Read Blocks", "Shared Dirtied Blocks", "Shared Written Blocks",
+    "Temp Read Blocks", "Temp Written Blocks",
+)
+# Nodes whose children run in parallel worker processes
+GATHER_NODES = ("Gather", "Gather Merge")
+# Expressions of a node that can read the result of an InitPlan
+CONDITION_KEYS = (
+    "Filter", "Index Cond", "Recheck Cond", "Join Filter", "Hash Cond", "Merge Cond", "TID Cond",
+    "One-Time Filter", "Output", "Sort Key", "Group Key",
+)
+# Estimated and actual rows further apart than this factor are flagged
+MISESTIMATE_FACTOR = 10
+# Nodes ranked as hot spots
+HOT_SPOT_COUNT = 5
+
+NodeStats = namedtuple("NodeStats", "id inclusive_ms exclusive_ms exclusive_cost buffers processes "
+                                    "estimated_rows actual_rows misestimate")
+PlanAnalysis = namedtuple("PlanAnalysis", "nodes analyzed total_ms total_cost hot_spots misestimates")
+
+
+def node_wall_ms(plan, processes):
+    # Actual Total Time is per loop, averaged over the processes that ran the node.
+    # Loops of a node under Gather are spread over its processes, which run side by side.
+    loops = plan.get("Actual Loops", 0)
+    return plan.get("Actual Total Time", 0.0) * loops / processes
+
+
+def is_initplan(node):
+    # InitPlans, CTEs among them, hang under the top node of their query level
+    return node.plan.get("Parent Relationship") == "InitPlan"
+
+
+def initplan_runner(nodes, initplan, own_ms, subtree_end):
+    # An InitPlan runs inside the node that first needs it, which may be any node under
+    # its parent: a CTE Scan of the CTE, or a node whose expressions read its $n result,
+    # written (InitPlan n) from PostgreSQL 17 on. That node's time and buffers already
+    # include the InitPlan's. Of several, the one that ran it has the most time of its own.
+    parent = initplan.parent
+    candidates = [node for node in nodes[parent:subtree_end[parent]]
+                  if not initplan.id <= node.id < subtree_end[initplan.id]]
+    name = initplan.plan.get("Subplan Name", "")
+    if name.startswith("CTE "):
+        runners = [node.id for node in candidates
+                   if node.plan["Node Type"] == "CTE Scan" and node.plan.get("CTE Name") == name[4:]]
+    else:
+        label, _, returns = name.partition(" (returns ")
+        references = [re.escape(param) + r"(?!\d)" for param in re.findall(r"\$\d+", returns)]
+        pattern = re.compile("|".join(references + [re.escape(f"({label})")]))
+        runners = [node.id for node in candidates
+                   if any(pattern.search(str(node.plan[key])) for key in CONDITION_KEYS if key in node.plan)]
+    if not runners:
+        return parent
+    return max(runners, key=lambda node_id: own_ms[node_id])
+
+
+def misestimate_factor(estimated, actual):
+    # How many times off the planner was, in either direction; 1 is a perfect estimate
+    return max(estimated, actual) / max(min(estimated, actual), 1)
+
+
+def is_misestimated(node_stats):
+    return node_stats.misestimate is not None and node_stats.misestimate >= MISESTIMATE_FACTOR
+
+
+def analyze_plan(nodes):
+    # Takes the nodes of plan_tree.flatten_plan, root first
+    plan = nodes[0].plan
+    analyzed = "Actual Loops" in plan
+    # Processes running each node: 1, or the launched workers plus the leader under a Gather
+    processes = [1] * len(nodes)
+    for node in nodes[1:]:  # parents before children
+        parent = nodes[node.parent].plan
+        if parent["Node Type"] in GATHER_NODES and "Workers Launched" in parent:
+            processes[node.id] = parent["Workers Launched"] + 1
+        else:
+            processes[node.id] = processes[node.parent]
+
+    inclusive = [node_wall_ms(node.plan, processes[node.id]) for node in nodes]
+    # Nodes in pre-order, so a node's subtree is the ids up to subtree_end
+    subtree_end = [node.id + 1 for node in nodes]
+    for node in reversed(nodes):
+        if node.children:
+            subtree_end[node.id] = subtree_end[node.children[-1]]
+    # The nodes that ran inside each node: its children, but an InitPlan inside its runner
+    ran_inside = [[child for child in node.children if not is_initplan(nodes[child])] for node in nodes]
+    own_ms = [inclusive[node.id] - sum(inclusive[child] for child in ran_inside[node.id]) for node in nodes]
+    for node in nodes:
+        if is_initplan(node):
+            ran_inside[initplan_runner(nodes, node, own_ms, subtree_end)].append(node.id)
+
+    stats = []
+    for node in nodes:
+        children = [nodes[child].plan for child in node.children]
+        inside = [nodes[child].plan for child in ran_inside[node.id]]
+        exclusive_ms = inclusive[node.id] - sum(inclusive[child] for child in ran_inside[node.id])
+        # The planner adds an InitPlan's cost to the node it hangs under
+        exclusive_cost = node.plan.get("Total Cost", 0.0) - sum(child.get("Total Cost", 0.0) for child in children)
+        # Buffer counts already include the I/O of every node that ran inside, and every worker's
+        buffers = {key: max(node.plan[key] - sum(child.get(key, 0) for child in inside), 0)
+                   for key in BUFFER_KEYS if key in node.plan}
+        estimated = node.plan.get("Plan Rows", 0)
+        actual = node.plan.get("Actual Rows")
+        executed = analyzed and node.plan.get("Actual Loops", 0) > 0
+        stats.append(NodeStats(
+            node.id, inclusive[node.id], max(exclusive_ms, 0.0), max(exclusive_cost, 0.0), buffers,
+            processes[node.id], estimated, actual,
+            misestimate_factor(estimated, actual) if executed else None,
+        ))
+
+    key = (lambda node_stats: node_stats.exclusive_ms) if analyzed else (lambda node_stats: node_stats.exclusive_cost)
+    ranked = sorted((node_stats for node_stats in stats if key(node_stats) > 0), key=key, reverse=True)
+    misestimates = [node_stats.id for node_stats in stats if is_misestimated(node_stats)]
+    return PlanAnalysis(stats, analyzed, inclusive[0], plan.get("Total Cost", 0.0),
+                        [node_stats.id for node_stats in ranked[:HOT_SPOT_COUNT]], misestimates)
+
+
+def time_share(analysis, node_id):
+    # Fraction of the whole plan spent in the node itself, by time or by cost without ANALYZE
+    node_stats = analysis.nodes[node_id]
+    if analysis.analyzed:
+        return node_stats.exclusive_ms / analysis.total_ms if analysis.total_ms else 0.0
+    return node_stats.exclusive_cost / analysis.total_cost if analysis.total_cost else 0.0
+
+
+def analysis_report(analysis, nodes):
+    # Hot spots and misestimates as plain data, e.g. for the batch report
+    def describe(node_id):
+        node_stats = analysis.nodes[node_id]
+        plan = nodes[node_id].plan
+        return {
+            "node": node_id,
+            "node_type": plan["Node Type"],
+            "relation": plan.get("Relation Name"),
+            "exclusive_ms": round(node_stats.exclusive_ms, 3),
+            "inclusive_ms": round(node_stats.inclusive_ms, 3),
+            "exclusive_cost": round(node_stats.exclusive_cost, 2),
+            "share": round(time_share(analysis, node_id), 4),
+            "buffers": node_stats.buffers,
+            "processes": node_stats.processes,
+            "estimated_rows": node_stats.estimated_rows,
+            "actual_rows": node_stats.actual_rows,
+            "misestimate": None if node_stats.misestimate is None else round(node_stats.misestimate, 1),
+        }
+    return {
+        "analyzed": analysis.analyzed,
+        "total_ms": round(analysis.total_ms, 3),
+        "hot_spots": [describe(node_id) for node_id in analysis.hot_spots],
+        "misestimates": [describe(node_id) for node_id in analysis.misestimates],
+    }
@@ -0,0 +1,196 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing
+
+from plan_tree import flatten_plan, plan_hash
+from sql_rewriter import query_fingerprint
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".query_plan_history.sqlite3")
+# Runs written per transaction, and the longest a queued run waits for one
+WRITE_BATCH_SIZE = 50
+WRITE_INTERVAL_SECONDS = 1.0
+
+# Node metrics compared between two runs of a query
+DIFF_METRICS = (
+    "Total Cost", "Plan Rows", "Actual Rows", "Actual Loops", "Actual Total Time",
+    "Shared Hit Blocks", "Shared Read Blocks",
+)
+
+PlanRun = namedtuple("PlanRun", "id fingerprint query recorded_at database analyzed plan_hash total_cost "
+                                "execution_ms shared_hit_blocks shared_read_blocks plan tables")
+NodeDiff = namedtuple("NodeDiff", "path node change metrics")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS plan_runs (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    query TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    database TEXT,
+    analyzed INTEGER NOT NULL,
+    plan_hash TEXT NOT NULL,
+    total_cost REAL,
+    execution_ms REAL,
+    shared_hit_blocks INTEGER,
+    shared_read_blocks INTEGER,
+    plan_json TEXT NOT NULL,
+    tables_json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS plan_runs_fingerprint ON plan_runs (fingerprint, recorded_at);
+CREATE INDEX IF NOT EXISTS plan_runs_recorded_at ON plan_runs (recorded_at);
+"""
+
+_insert_columns = ("fingerprint, query, recorded_at, database, analyzed, plan_hash, total_cost, execution_ms, "
+                   "shared_hit_blocks, shared_read_blocks, plan_json, tables_json")
+_columns = "id, " + _insert_columns
+
+
+def table_summaries(results):
+    # What a run accessed in each table, without the ctids themselves
+    summaries = {}
+    for table_name, index in results.items():
+        summaries[table_name] = {
+            "blocks": len(index),
+            "tuples": index.count,
+            "relation_blocks": index.relation_blocks,
+            "fraction_touched": index.fraction_touched(),
+            "runs": index.runs().run_count(),
+            "truncated": index.truncated,
+            "error": index.error,
+        }
+        if index.sample is not None:
+            # blocks and tuples above then only count the sampled windows
+            summaries[table_name]["estimate"] = index.sample.estimate()._asdict()
+    return summaries
+
+
+class PlanHistory:
+    """Every analyzed plan, kept in a local SQLite file.
+
+    record() only queues the run; a writer thread stores queued runs in batches,
+    so recording never waits on the disk."""
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self._queue = queue.Queue()
+        with closing(self._connect()) as conn:
+            conn.executescript(_schema)
+        self._writer = threading.Thread(target=self._write_loop, name="plan-history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def record(self, query, plan, tables=None, database=None, analyzed=True):
+        # tables holds table_summaries() of the run
+        self._queue.put((
+            query_fingerprint(query), query, time.time(), database, int(analyzed), plan_hash(plan),
+            plan.get("Total Cost"), plan.get("Actual Total Time"),
+            plan.get("Shared Hit Blocks"), plan.get("Shared Read Blocks"),
+            json.dumps(plan), json.dumps(tables or {}),
+        ))
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + WRITE_INTERVAL_SECONDS
+                while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+                    try:
+                        batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                rows = [row for row in batch if row is not None]
+                if rows:
+                    with conn:
+                        conn.executemany(
+                            f"INSERT INTO plan_runs ({_insert_columns}) VALUES ({', '.join('?' * 12)})", rows)
+                for _ in batch:
+                    self._queue.task_done()
+                if batch[-1] is None:
+                    return
+        finally:
+            conn.close()
+
+    def flush(self):
+        # Waits until every run recorded so far is on disk
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def runs(self, query=None, limit=100):
+        # Newest first, only the runs of the query's fingerprint when one is given
+        sql = f"SELECT {_columns} FROM plan_runs"
+        parameters = []
+        if query is not None:
+            sql += " WHERE fingerprint = ?"
+            parameters.append(query_fingerprint(query))
+        sql += " ORDER BY recorded_at DESC LIMIT ?"
+        parameters.append(limit)
+        with closing(self._connect()) as conn:
+            return [self._run(row) for row in conn.execute(sql, parameters)]
+
+    def run(self, run_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {_columns} FROM plan_runs WHERE id = ?", (run_id,)).fetchone()
+        return self._run(row) if row else None
+
+    def _run(self, row):
+        *fields, plan_json, tables_json = row
+        return PlanRun(*fields, json.loads(plan_json), json.loads(tables_json))
+
+
+def _node_name(plan):
+    name = plan["Node Type"]
+    if "Relation Name" in plan:
+        name += f" on {plan['Relation Name']}"
+    elif "Index Name" in plan:
+        name += f" using {plan['Index Name']}"
+    return name
+
+
+def diff_plans(old, new):
+    # Pairs nodes by their position under matching parents. A node whose type or
+    # relation changed is a replacement and its subtree isn't paired further.
+    diffs = []
+    stack = [("0", old, new)]
+    while stack:
+        path, old_node, new_node = stack.pop()
+        if new_node is None:
+            diffs.append(NodeDiff(path, _node_name(old_node), "removed", {}))
+            continue
+        if old_node is None:
+            diffs.append(NodeDiff(path, _node_name(new_node), "added", {}))
+            continue
+        if _node_name(old_node) != _node_name(new_node):
+            diffs.append(NodeDiff(path, f"{_node_name(old_node)} -> {_node_name(new_node)}", "replaced", {}))
+            continue
+        metrics = {key: (old_node.get(key), new_node.get(key)) for key in DIFF_METRICS
+                   if key in old_node or key in new_node}
+        changed = any(old_value != new_value for old_value, new_value in metrics.values())
+        diffs.append(NodeDiff(path, _node_name(new_node), "changed" if changed else "same", metrics))
+        old_children = old_node.get("Plans", [])
+        new_children = new_node.get("Plans", [])
+        for i in reversed(range(max(len(old_children), len(new_children)))):
+            stack.append((f"{path}.{i}",
+                          old_children[i] if i < len(old_children) else None,
+                          new_children[i] if i < len(new_children) else None))
+    return diffs
+
+
+def plan_flipped(old, new):
+    # Same query, different plan shape: the node types or relations don't line up
+    def shape(plan):
+        return [(node.depth, _node_name(node.plan)) for node in flatten_plan(plan)]
+    return shape(old) != shape(new)
@@ -0,0 +1,108 @@
+import hashlib
+import json
+from collections import namedtuple
+
+from cache import LRUCache
+from plan_analysis import analyze_plan, time_share
+
+# Layouts kept for plans shown recently
+LAYOUT_CACHE_SIZE = 16
+
+PlanNode = namedtuple("PlanNode", "id parent depth plan children")
+PlanLayout = namedtuple("PlanLayout", "key nodes positions labels search_text width depth analysis shape")
+
+layout_cache = LRUCache(LAYOUT_CACHE_SIZE)
+
+
+def plan_hash(plan, nodes=None):
+    # Hashes node by node, json.dumps of the nested plan would recurse as deep as the plan
+    digest = hashlib.sha1()
+    for node in nodes or flatten_plan(plan):
+        attributes = {key: value for key, value in node.plan.items() if key != "Plans"}
+        digest.update(f"{node.parent}:".encode())
+        digest.update(json.dumps(attributes, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def flatten_plan(plan):
+    # Nodes in pre-order, iterative so very deep plans don't hit the recursion limit
+    nodes = []
+    stack = [(plan, None, 0)]
+    while stack:
+        node_plan, parent, depth = stack.pop()
+        node = PlanNode(len(nodes), parent, depth, node_plan, [])
+        nodes.append(node)
+        if parent is not None:
+            nodes[parent].children.append(node.id)
+        for child in reversed(node_plan.get("Plans", [])):
+            stack.append((child, node.id, depth + 1))
+    return nodes
+
+
+def node_label(plan):
+    title = plan["Node Type"]
+    if "Relation Name" in plan:
+        title += f" on {plan['Relation Name']}"
+        if plan.get("Alias") and plan["Alias"] != plan["Relation Name"]:
+            title += f" {plan['Alias']}"
+    elif "Index Name" in plan:
+        title += f" using {plan['Index Name']}"
+    lines = [title]
+    if "Total Cost" in plan:
+        lines.append(f"cost {plan.get('Startup Cost', 0):.2f}..{plan['Total Cost']:.2f}  rows {plan.get('Plan Rows', 0)}")
+    if "Actual Total Time" in plan:
+        lines.append(f"actual {plan['Actual Total Time']:.3f} ms  rows {plan.get('Actual Rows', 0)}"
+                     f" x{plan.get('Actual Loops', 1)}")
+    elif plan.get("Actual Loops") == 0:
+        lines.append("never executed")
+    return "\n".join(lines)
+
+
+def node_search_text(plan):
+    # Every scalar attribute of the node, lowercased once so searching is a substring scan
+    values = [str(value) for key, value in plan.items() if key != "Plans"]
+    return "\n".join(values).lower()
+
+
+def plan_shape(nodes, labels):
+    # Hash of the tree and of every node's title, without costs, rows or times: two plans
+    # with the same shape can be shown by updating the values of the one already drawn
+    digest = hashlib.sha1()
+    for node in nodes:
+        digest.update(f"{node.parent}:{labels[node.id].split(chr(10), 1)[0]}\n".encode())
+    return digest.hexdigest()
+
+
+def layout_plan(plan, nodes=None):
+    # Tidy tree: leaves take consecutive columns left to right and every parent is
+    # centred over its children. Positions are in column/row units, linear in the node count.
+    nodes = nodes or flatten_plan(plan)
+    x = [0.0] * len(nodes)
+    next_column = 0
+    for node in reversed(nodes):  # children before parents
+        if node.children:
+            x[node.id] = (x[node.children[0]] + x[node.children[-1]]) / 2
+        else:
+            x[node.id] = next_column
+            next_column += 1
+    positions = [(x[node.id], node.depth) for node in nodes]
+    analysis = analyze_plan(nodes)
+    labels = [node_label(node.plan) for node in nodes]
+    shape = plan_shape(nodes, labels)
+    if analysis.analyzed:
+        for node in nodes:
+            labels[node.id] += (f"\nself {analysis.nodes[node.id].exclusive_ms:.3f} ms"
+                                f" ({time_share(analysis, node.id):.0%})")
+    search_text = [node_search_text(node.plan) for node in nodes]
+    depth = max(node.depth for node in nodes) + 1
+    return PlanLayout(None, nodes, positions, labels, search_text, next_column, depth, analysis, shape)
+
+
+def get_plan_layout(plan):
+    nodes = flatten_plan(plan)
+    key = plan_hash(plan, nodes)
+    layout = layout_cache.get(key)
+    if layout is None:
+        layout = layout_plan(plan, nodes)._replace(key=key)
+        layout_cache.put(key, layout)
+    return layout
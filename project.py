@@ -1,3 +1,47 @@
-from interface import startWindow
+import sys
 
-startWindow()
+from PyQt5.QtGui import QColor, QPalette
+from PyQt5.QtWidgets import QApplication, QDialog, QMessageBox
+
+from config_dialog import ConfigDialog
+
+
+def startWindow():
+    app = QApplication(sys.argv)
+
+    palette = QPalette()
+    palette.setColor(QPalette.Window, QColor(240, 240, 240))
+    palette.setColor(QPalette.WindowText, QColor(0, 0, 0))
+    app.setPalette(palette)
+
+    # The dialog only needs Qt, so it's on screen before the main window and the
+    # analysis modules behind it (numpy, psycopg2) are imported
+    dialog = ConfigDialog()
+    dialog.show()
+    app.processEvents()
+    from connection_pool import close_pool, init_pool
+    from explore import MAX_CTID_MEMORY_MB
+    from interface import SQLQueryApp
+    dialog.memory_limit_input.setValue(MAX_CTID_MEMORY_MB)
+    window = SQLQueryApp()
+    window.show()
+    dialog.raise_()
+
+    connected = False
+    while not connected:
+        if dialog.exec_() == QDialog.Accepted:
+            db_host, db_name, db_user, db_password = dialog.get_connection_details()
+            try:
+                # The pool is shared by every explore function for the rest of the session
+                init_pool(db_host, db_name, db_user, db_password)
+                window.memory_limit_mb = dialog.get_memory_limit_mb()
+                connected = True
+            except Exception as e:
+                QMessageBox.critical(None, "Connection Error", f"Error connecting to the database: {str(e)}")
+
+    app.aboutToQuit.connect(close_pool)
+    sys.exit(app.exec_())
+
+
+if __name__ == "__main__":
+    startWindow()
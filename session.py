@@ -0,0 +1,52 @@
+import json
+import os
+import time
+from collections import namedtuple
+
+from blocks import BlockIndex
+
+SESSION_FILE = "session.json"
+SESSION_VERSION = 1
+
+Session = namedtuple("Session", "query plan results headers saved_at")
+
+
+def save_session(path, query, plan, results, headers):
+    # One directory per session: each table's index as memory-mappable arrays, and the
+    # query, plan and column names in session.json, written last so a session whose
+    # save was interrupted never opens
+    os.makedirs(path, exist_ok=True)
+    tables = []
+    for position, (table_name, index) in enumerate(results.items()):
+        directory = f"table-{position}"
+        index.save(os.path.join(path, directory))
+        tables.append({"name": table_name, "directory": directory, "header": headers.get(table_name)})
+    session = {
+        "version": SESSION_VERSION,
+        "saved_at": time.time(),
+        "query": query,
+        "plan": plan,
+        "tables": tables,
+    }
+    temporary = os.path.join(path, SESSION_FILE + ".tmp")
+    with open(temporary, "w") as session_file:
+        json.dump(session, session_file, default=str)
+    os.replace(temporary, os.path.join(path, SESSION_FILE))
+
+
+def load_session(path):
+    # Nothing is read from the database, the block keys stay on disk until they're used
+    try:
+        with open(os.path.join(path, SESSION_FILE)) as session_file:
+            session = json.load(session_file)
+    except FileNotFoundError:
+        raise RuntimeError(f"{path} is not a saved session")
+    if session.get("version") != SESSION_VERSION:
+        raise RuntimeError(f"Unsupported session version {session.get('version')}")
+    results = {}
+    headers = {}
+    for table in session["tables"]:
+        results[table["name"]] = BlockIndex.open(os.path.join(path, table["directory"]))
+        if table["header"] is not None:
+            headers[table["name"]] = table["header"]
+    return Session(session["query"], session["plan"], results, headers, session["saved_at"])
@@ -0,0 +1,552 @@
+import hashlib
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# One alternation, so the query is tokenized in a single left-to-right scan
+# Backslashes only escape inside E'' strings, as with standard_conforming_strings on
+_token_pattern = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>[Ee]'(?:[^'\\]|''|\\.)*(?:'|\Z)|(?:[BbXxNn]|[Uu]&)?'(?:[^']|'')*(?:'|\Z))
+  | (?P<dollar>\$(?P<tag>[A-Za-z_][A-Za-z0-9_]*)?\$.*?(?:\$(?P=tag)\$|\Z))
+  | (?P<param>\$\d+)
+  | (?P<quoted>"(?:[^"]|"")*(?:"|\Z))
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_\u0080-￿][A-Za-z0-9_$\u0080-￿]*)
+  | (?P<op>::|<=|>=|<>|!=|\|\||[-+*/%^<>=~!@#&|`?.,;:\[\]()])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+Token = namedtuple("Token", "kind text start end upper")
+
+# Columns and relations the rewriter adds, user queries must not use these names
+RESERVED_PREFIX = "qp_"
+
+AGGREGATE_FUNCTIONS = frozenset("""
+    count sum avg min max array_agg string_agg bool_and bool_or every bit_and bit_or
+    json_agg jsonb_agg json_object_agg jsonb_object_agg xmlagg stddev stddev_pop stddev_samp
+    variance var_pop var_samp corr covar_pop covar_samp regr_avgx regr_avgy regr_count
+    regr_intercept regr_r2 regr_slope regr_sxx regr_sxy regr_syy mode percentile_cont
+    percentile_disc rank dense_rank percent_rank cume_dist
+""".split())
+
+# Keywords that end a FROM item, so they can never be a table alias
+_not_alias = frozenset("""
+    WHERE GROUP HAVING WINDOW ORDER LIMIT OFFSET FETCH FOR UNION INTERSECT EXCEPT ON USING
+    JOIN INNER LEFT RIGHT FULL OUTER CROSS NATURAL LATERAL TABLESAMPLE WITH RETURNING INTO
+""".split())
+_join_words = frozenset("JOIN INNER LEFT RIGHT FULL OUTER CROSS NATURAL".split())
+_set_operations = frozenset(("UNION", "INTERSECT", "EXCEPT"))
+_query_starts = frozenset(("SELECT", "WITH", "VALUES", "TABLE"))
+
+
+def tokenize(query):
+    tokens = []
+    for match in _token_pattern.finditer(query):
+        kind = match.lastgroup
+        if kind == "tag":
+            kind = "dollar"
+        if kind in ("space", "comment"):
+            continue
+        text = match.group()
+        tokens.append(Token(kind, text, match.start(), match.end(),
+                            text.upper() if kind == "word" else text))
+    return tokens
+
+
+def split_statements(text):
+    # Splits a script on the semicolons that aren't inside strings or comments
+    statements = []
+    start = 0
+    for token in tokenize(text):
+        if token.text == ";":
+            statements.append(text[start:token.start])
+            start = token.end
+    statements.append(text[start:])
+    return [statement.strip() for statement in statements if tokenize(statement)]
+
+
+def query_fingerprint(query):
+    # Same for queries that only differ in literals, whitespace, comments or keyword case
+    parts = []
+    for token in tokenize(query):
+        if token.kind in ("string", "dollar", "number", "param"):
+            parts.append("?")
+        elif token.text != ";":
+            parts.append(normalize_identifier(token.text) if token.kind == "word" else token.text)
+    return hashlib.sha1(" ".join(parts).encode()).hexdigest()[:16]
+
+
+def normalize_identifier(text):
+    # Unquoted identifiers fold to lower case, quoted ones are kept as written
+    return text if text.startswith('"') else text.lower()
+
+
+TableRef = namedtuple("TableRef", "name key ref alias_columns_end")
+SubqueryRef = namedtuple("SubqueryRef", "query alias alias_columns_end")
+
+
+class Select:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.distinct = False
+        self.list_end = end  # token index the select list stops at
+        self.from_items = []
+        self.group_by_end = None  # token index the GROUP BY list stops at
+        self.group_by_insert = end  # where a new GROUP BY clause would go
+        self.aggregated = False
+
+
+class Query:
+    def __init__(self):
+        self.ctes = {}  # name -> Cte
+        self.recursive = False
+        self.branches = []  # Select or Query, one per set operation branch
+        self.operators = []
+
+
+Cte = namedtuple("Cte", "name query columns_end")
+
+
+class _Parser:
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.match = self._match_parens()
+        # Queries inside expressions, only their tables are reported
+        self.nested_queries = []
+
+    def _match_parens(self):
+        match = {}
+        stack = []
+        for i, token in enumerate(self.tokens):
+            if token.text == "(":
+                stack.append(i)
+            elif token.text == ")" and stack:
+                match[stack.pop()] = i
+        return match
+
+    def _skip(self, i):
+        # Next index at the same nesting depth
+        if self.tokens[i].text == "(":
+            return self.match.get(i, len(self.tokens) - 1) + 1
+        return i + 1
+
+    def _upper(self, i, end):
+        return self.tokens[i].upper if i < end else None
+
+    def _is_query_start(self, i, end):
+        return i < end and self.tokens[i].upper in _query_starts
+
+    def parse_query(self, start, end):
+        query = Query()
+        i = start
+        if self._upper(i, end) == "WITH":
+            i += 1
+            if self._upper(i, end) == "RECURSIVE":
+                query.recursive = True
+                i += 1
+            while i < end:
+                name = normalize_identifier(self.tokens[i].text)
+                i += 1
+                columns_end = None
+                if i < end and self.tokens[i].text == "(":
+                    columns_end = self.match.get(i)
+                    i = self._skip(i)
+                if self._upper(i, end) == "AS":
+                    i += 1
+                while self._upper(i, end) in ("NOT", "MATERIALIZED"):
+                    i += 1
+                if i >= end or self.tokens[i].text != "(":
+                    break
+                close = self.match.get(i, end - 1)
+                body = self.parse_query(i + 1, close)
+                query.ctes[name] = Cte(name, body, columns_end)
+                i = close + 1
+                if i < end and self.tokens[i].text == ",":
+                    i += 1
+                    continue
+                break
+
+        # Split into set operation branches at this depth
+        branch_start = i
+        while i < end:
+            upper = self.tokens[i].upper
+            if upper in _set_operations:
+                query.branches.append(self._parse_branch(branch_start, i))
+                operator = upper
+                i += 1
+                if self._upper(i, end) in ("ALL", "DISTINCT"):
+                    operator += " " + self.tokens[i].upper
+                    i += 1
+                query.operators.append(operator)
+                branch_start = i
+            else:
+                i = self._skip(i)
+        query.branches.append(self._parse_branch(branch_start, end))
+        return query
+
+    def _parse_branch(self, start, end):
+        if start < end and self.tokens[start].text == "(":
+            close = self.match.get(start, end - 1)
+            # A parenthesized branch, possibly followed by the ORDER BY/LIMIT of the whole set operation
+            return self.parse_query(start + 1, close)
+        if self._upper(start, end) == "SELECT":
+            return self.parse_select(start, end)
+        # VALUES or TABLE, nothing to instrument
+        self._scan_nested(start, end)
+        return None
+
+    def parse_select(self, start, end):
+        select = Select(start, end)
+        i = start + 1
+        if self._upper(i, end) == "DISTINCT":
+            select.distinct = True
+        clause_starts = []
+        previous = None
+        while i < end:
+            token = self.tokens[i]
+            upper = token.upper
+            if token.kind == "word":
+                if upper == "FROM" and previous != "DISTINCT" and select.list_end == end:
+                    select.list_end = i
+                    clause_starts.append(("FROM", i))
+                elif upper == "GROUP" and previous != "WITHIN" and self._upper(i + 1, end) == "BY":
+                    clause_starts.append(("GROUP", i))
+                elif upper in ("WHERE", "HAVING", "WINDOW", "LIMIT", "OFFSET", "FETCH", "FOR"):
+                    clause_starts.append((upper, i))
+                elif upper == "ORDER" and self._upper(i + 1, end) == "BY":
+                    clause_starts.append(("ORDER", i))
+            previous = upper
+            i = self._skip(i)
+        if select.list_end == end:
+            select.list_end = clause_starts[0][1] if clause_starts else end
+
+        bounds = clause_starts + [(None, end)]
+        for (name, clause_start), (_, clause_end) in zip(bounds, bounds[1:]):
+            if name == "FROM":
+                self._parse_from(select, clause_start + 1, clause_end)
+            elif name == "GROUP":
+                select.group_by_end = clause_end
+                select.aggregated = True
+            else:
+                self._scan_nested(clause_start, clause_end)
+            if name in ("HAVING", "WINDOW", "ORDER", "LIMIT", "OFFSET", "FETCH", "FOR") \
+                    and select.group_by_insert == end:
+                select.group_by_insert = clause_start
+
+        if self._has_aggregate(start + 1, select.list_end):
+            select.aggregated = True
+        for name, clause_start in clause_starts:
+            if name == "HAVING":
+                select.aggregated = True
+        self._scan_nested(start + 1, select.list_end)
+        return select
+
+    def _has_aggregate(self, start, end):
+        i = start
+        while i < end:
+            token = self.tokens[i]
+            if token.text == "(" and self._is_query_start(i + 1, end):
+                # Aggregates of a scalar subquery belong to the subquery
+                i = self._skip(i)
+                continue
+            if token.kind == "word" and token.text.lower() in AGGREGATE_FUNCTIONS \
+                    and i + 1 < end and self.tokens[i + 1].text == "(":
+                after = self._skip(i + 1)
+                if self._upper(after, end) == "FILTER" and after + 1 < end:
+                    after = self._skip(after + 1)
+                if self._upper(after, end) != "OVER":
+                    return True
+            i += 1
+        return False
+
+    def _scan_nested(self, start, end):
+        # Queries inside expressions can't pass ctids out, record their tables anyway
+        i = start
+        while i < end:
+            token = self.tokens[i]
+            if token.text == "(" and i in self.match:
+                close = self.match[i]
+                if self._is_query_start(i + 1, close):
+                    self.nested_queries.append(self.parse_query(i + 1, close))
+                else:
+                    self._scan_nested(i + 1, close)
+                i = close + 1
+            else:
+                i += 1
+
+    def _parse_alias(self, i, end):
+        alias = None
+        alias_columns_end = None
+        if self._upper(i, end) == "AS":
+            i += 1
+        if i < end and self.tokens[i].kind in ("word", "quoted") and self.tokens[i].upper not in _not_alias:
+            alias = self.tokens[i].text
+            i += 1
+            if i < end and self.tokens[i].text == "(":
+                alias_columns_end = self.match.get(i)
+                i = self._skip(i)
+        return alias, alias_columns_end, i
+
+    def _parse_from(self, select, start, end):
+        i = start
+        while i < end:
+            token = self.tokens[i]
+            upper = token.upper
+            if token.text == "," or upper in _join_words or upper in ("LATERAL", "ONLY"):
+                i += 1
+            elif upper in ("ON", "USING"):
+                # Skip the join condition up to the next item
+                i += 1
+                while i < end and self.tokens[i].text != "," and self.tokens[i].upper not in _join_words:
+                    if self.tokens[i].text == "(":
+                        close = self.match.get(i, end - 1)
+                        self._scan_nested(i, close + 1)
+                        i = close + 1
+                    else:
+                        i += 1
+            elif token.text == "(":
+                close = self.match.get(i, end - 1)
+                if self._is_query_start(i + 1, close):
+                    query = self.parse_query(i + 1, close)
+                    alias, alias_columns_end, i = self._parse_alias(close + 1, end)
+                    select.from_items.append(SubqueryRef(query, alias, alias_columns_end))
+                else:
+                    # Parenthesized join
+                    self._parse_from(select, i + 1, close)
+                    alias, alias_columns_end, i = self._parse_alias(close + 1, end)
+            elif token.kind in ("word", "quoted"):
+                name_end = i + 1
+                while name_end + 1 < end and self.tokens[name_end].text == "." \
+                        and self.tokens[name_end + 1].kind in ("word", "quoted"):
+                    name_end += 2
+                if name_end < end and self.tokens[name_end].text == "(":
+                    # Function in FROM, like generate_series(...)
+                    self._scan_nested(name_end, self.match.get(name_end, end - 1) + 1)
+                    i = self._skip(name_end)
+                    if self._upper(i, end) == "WITH" and self._upper(i + 1, end) == "ORDINALITY":
+                        i += 2
+                    alias, alias_columns_end, i = self._parse_alias(i, end)
+                    continue
+                name = self.query[token.start:self.tokens[name_end - 1].end]
+                key = ".".join(normalize_identifier(self.tokens[j].text) for j in range(i, name_end, 2))
+                i = name_end
+                if i < end and self.tokens[i].text == "*":
+                    i += 1
+                alias, alias_columns_end, i = self._parse_alias(i, end)
+                select.from_items.append(TableRef(name, key, alias or name, alias_columns_end))
+                if self._upper(i, end) == "TABLESAMPLE":
+                    i += 1
+                    while i < end and self.tokens[i].text != "," and self.tokens[i].upper not in _not_alias - {"TABLESAMPLE"}:
+                        i = self._skip(i)
+            else:
+                i += 1
+
+
+RewriteResult = namedtuple("RewriteResult", "instrumented_query table_columns table_names skipped_tables plan_preserving")
+
+
+class _Rewriter:
+    def __init__(self, parser, exclude=frozenset()):
+        self.parser = parser
+        # Relations without a ctid, views and foreign tables, read as they are
+        self.exclude = exclude
+        self.tokens = parser.tokens
+        self.edits = []
+        self.counter = 0
+        self.plan_preserving = True
+        self.instrumented_ctes = {}
+
+    def _new_column(self):
+        name = f"{RESERVED_PREFIX}ctid_{self.counter}"
+        self.counter += 1
+        return name
+
+    def _insert_before(self, token_index, text):
+        position = self.tokens[token_index].start if token_index < len(self.tokens) else len(self.parser.query)
+        self.edits.append((position, len(self.edits), text))
+
+    def _insert_after(self, token_index, text):
+        self.edits.append((self.tokens[token_index].end, len(self.edits), text))
+
+    def _append_select_list(self, select, expressions):
+        # Appended after the user's columns so positional ORDER BY/GROUP BY references still hold
+        self._insert_after(select.list_end - 1, "".join(f", {expression} AS {name}" for expression, name in expressions))
+
+    def _leaves(self, query, ctes, leaves):
+        # Flattens nested set operations into their SELECT branches and the CTEs each one sees
+        ctes = dict(ctes)
+        for name, cte in query.ctes.items():
+            ctes[name] = (cte, query.recursive)
+        if any(operator.split()[-1] != "ALL" for operator in query.operators):
+            self.plan_preserving = False
+        for branch in query.branches:
+            if isinstance(branch, Query):
+                self._leaves(branch, ctes, leaves)
+            else:
+                leaves.append((branch, ctes))
+
+    def instrument_query(self, query, ctes):
+        # Returns [(table key, output column)] for the ctid columns the query now outputs
+        leaves = []
+        self._leaves(query, ctes, leaves)
+        if any(select is None for select, _ in leaves):
+            # A VALUES branch can't grow extra columns to line up with the others
+            return []
+
+        leaf_expressions = [self._select_expressions(select, leaf_ctes) for select, leaf_ctes in leaves]
+
+        # Branches share one column per table occurrence, so the width doesn't grow with the branch count
+        table_slots = {}
+        for expressions in leaf_expressions:
+            counts = {}
+            for table, _ in expressions:
+                counts[table] = counts.get(table, 0) + 1
+            for table, count in counts.items():
+                table_slots[table] = max(table_slots.get(table, 0), count)
+        outputs = [(table, self._new_column()) for table, count in table_slots.items() for _ in range(count)]
+        if not outputs:
+            return []
+
+        # Every branch outputs every column, NULL where it doesn't read that table
+        for (select, _), expressions in zip(leaves, leaf_expressions):
+            own = {}
+            for table, expression in expressions:
+                own.setdefault(table, []).append(expression)
+            appended = []
+            for table, name in outputs:
+                occurrences = own.get(table)
+                appended.append((occurrences.pop(0) if occurrences else "NULL::tid", name))
+            self._append_select_list(select, appended)
+        return outputs
+
+    def _select_expressions(self, select, ctes):
+        if select.distinct:
+            self.plan_preserving = False
+        expressions = []
+        for item in select.from_items:
+            if isinstance(item, TableRef):
+                # CTE references are unqualified
+                if item.key in ctes:
+                    cte, recursive = ctes[item.key]
+                    if recursive:
+                        continue
+                    for table, column in self._instrument_cte(cte, ctes):
+                        expressions.append((table, f"{item.ref}.{column}"))
+                elif item.key not in self.exclude:
+                    expressions.append((item.key, f"{item.ref}.ctid"))
+            elif item.alias is not None:
+                inner = self.instrument_query(item.query, ctes)
+                if inner and item.alias_columns_end is not None:
+                    self._insert_before(item.alias_columns_end, "".join(f", {column}" for _, column in inner))
+                for table, column in inner:
+                    expressions.append((table, f"{item.alias}.{column}"))
+
+        if expressions and select.aggregated:
+            # Group by the ctids so each base tuple still shows up as its own row
+            self.plan_preserving = False
+            columns = ", ".join(expression for _, expression in expressions)
+            if select.group_by_end is not None:
+                self._insert_after(select.group_by_end - 1, ", " + columns)
+            else:
+                self._insert_before(select.group_by_insert, f" GROUP BY {columns} ")
+        return expressions
+
+    def _instrument_cte(self, cte, ctes):
+        if cte.name not in self.instrumented_ctes:
+            # Mark first so a CTE that refers to itself doesn't recurse forever
+            self.instrumented_ctes[cte.name] = []
+            outputs = self.instrument_query(cte.query, ctes)
+            if outputs and cte.columns_end is not None:
+                self._insert_before(cte.columns_end, "".join(f", {column}" for _, column in outputs))
+            self.instrumented_ctes[cte.name] = outputs
+        return self.instrumented_ctes[cte.name]
+
+    def apply(self):
+        query = self.parser.query
+        pieces = []
+        position = 0
+        for edit_position, _, text in sorted(self.edits):
+            pieces.append(query[position:edit_position])
+            pieces.append(text)
+            position = edit_position
+        pieces.append(query[position:])
+        return "".join(pieces)
+
+
+def _collect_tables(query, ctes, tables):
+    ctes = set(ctes) | set(query.ctes)
+    for cte in query.ctes.values():
+        _collect_tables(cte.query, ctes, tables)
+    for branch in query.branches:
+        if isinstance(branch, Query):
+            _collect_tables(branch, ctes, tables)
+        elif isinstance(branch, Select):
+            for item in branch.from_items:
+                if isinstance(item, TableRef):
+                    if item.key not in ctes:
+                        tables.add(item.key)
+                else:
+                    _collect_tables(item.query, ctes, tables)
+
+
+def _strip_statement(query):
+    # Drops trailing semicolons and comments so the query can be wrapped in parentheses
+    tokens = tokenize(query)
+    while tokens and tokens[-1].text == ";":
+        tokens.pop()
+    return query[:tokens[-1].end].strip() if tokens else ""
+
+
+# Statements that change data, rejected inside a query too (data-modifying CTEs)
+_modifying_words = frozenset(("INSERT", "UPDATE", "DELETE", "MERGE"))
+
+
+def check_select(query):
+    # The one gate in front of everything that sends user text to the database:
+    # a single SELECT statement, nothing after it and no data-modifying CTE
+    tokens = tokenize(_strip_statement(query))
+    if any(token.text == ";" for token in tokens):
+        raise RuntimeError("Only a single SQL statement can be analyzed")
+    if not tokens or tokens[0].upper not in ("SELECT", "WITH", "("):
+        raise RuntimeError("Only SELECT queries can be analyzed")
+    for previous, token in zip(tokens, tokens[1:]):
+        if previous.text == "(" and token.upper in _modifying_words:
+            raise RuntimeError(f"Only SELECT queries can be analyzed, the query contains {token.upper}")
+
+
+@lru_cache(maxsize=256)
+def rewrite_query(query, exclude=frozenset()):
+    # Parses the query once and instruments it with one ctid column per base table
+    # occurrence, memoized per query text. Tables named in exclude are left alone.
+    query = _strip_statement(query)
+    parser = _Parser(query)
+    for token in parser.tokens:
+        if token.kind in ("word", "quoted") and token.text.strip('"').lower().startswith(RESERVED_PREFIX):
+            raise RuntimeError(f"\"{token.text}\" uses the reserved prefix \"{RESERVED_PREFIX}\", please rename it")
+    check_select(query)
+
+    parsed = parser.parse_query(0, len(parser.tokens))
+    rewriter = _Rewriter(parser, exclude)
+    outputs = rewriter.instrument_query(parsed, {})
+
+    table_columns = {}
+    for table, column in outputs:
+        table_columns.setdefault(table, []).append(column)
+
+    referenced = set()
+    _collect_tables(parsed, (), referenced)
+    for nested in parser.nested_queries:
+        _collect_tables(nested, parsed.ctes, referenced)
+    skipped = sorted(referenced - set(table_columns))
+
+    return RewriteResult(
+        instrumented_query=rewriter.apply(),
+        table_columns=tuple((table, tuple(columns)) for table, columns in sorted(table_columns.items())),
+        table_names=tuple(sorted(referenced)),
+        skipped_tables=tuple(skipped),
+        plan_preserving=rewriter.plan_preserving,
+    )
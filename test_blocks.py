@@ -0,0 +1,151 @@
+import numpy as np
+
+from blocks import OFFSET_BITS, BlockIndex, BlockRuns, sorted_unique
+
+
+def random_keys(count, relation_blocks, seed=0):
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, relation_blocks, count, dtype=np.uint64)
+    offsets = rng.integers(1, 200, count, dtype=np.uint64)
+    return (blocks << OFFSET_BITS) | offsets
+
+
+def test_runs_union_matches_the_set_union():
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        left = sorted_unique(rng.integers(0, 300, rng.integers(0, 200)))
+        right = sorted_unique(rng.integers(0, 300, rng.integers(0, 200)))
+        union = BlockRuns.from_blocks(left).union(BlockRuns.from_blocks(right))
+        expected = BlockRuns.from_blocks(np.union1d(left, right))
+        assert union.starts.tolist() == expected.starts.tolist()
+        assert union.ends.tolist() == expected.ends.tolist()
+
+
+def test_runs_contains_and_blocks():
+    runs = BlockRuns.from_blocks(np.array([0, 1, 2, 7, 9, 10]))
+    assert runs.contains([0, 2, 3, 7, 8, 10, 11]).tolist() == [True, True, False, True, False, True, False]
+    assert runs.blocks().tolist() == [0, 1, 2, 7, 9, 10]
+    assert BlockRuns().blocks().tolist() == []
+
+
+def test_sequential_blocks_are_one_run():
+    index = BlockIndex()
+    blocks = np.arange(100000, dtype=np.uint64)
+    for start in range(0, len(blocks), 7000):
+        index.add_keys((blocks[start:start + 7000] << OFFSET_BITS) | np.uint64(1))
+    assert index.runs().run_count() == 1
+    assert len(index) == 100000
+    assert index.memory_bytes() < 100000 * 8 + 1024
+
+
+def test_index_reports_each_new_block_once():
+    keys = random_keys(20000, 3000)
+    index = BlockIndex()
+    seen = []
+    for start in range(0, len(keys), 1500):
+        seen.append(index.add_keys(keys[start:start + 1500]))
+    index.finish()
+    seen = np.concatenate(seen)
+    expected = sorted_unique(keys >> OFFSET_BITS)
+    assert len(seen) == len(expected)
+    assert sorted(seen.tolist()) == expected.tolist()
+    assert index.blocks().tolist() == expected.tolist()
+    assert len(index) == len(expected)
+
+
+def test_offsets_of_each_block():
+    keys = random_keys(5000, 400)
+    index = BlockIndex()
+    index.add_keys(keys[:2500])
+    index.add_keys(keys[2500:])
+    index.finish()
+    unique = sorted_unique(keys)
+    for block in (0, 17, 399, 400):
+        expected = unique[(unique >> OFFSET_BITS) == block] & np.uint64((1 << OFFSET_BITS) - 1)
+        assert index.offsets(block).tolist() == expected.tolist()
+        assert (block in index) == bool(len(expected))
+    assert index.count == len(unique)
+
+
+def test_offsets_include_runs_spilled_while_streaming(tmp_path):
+    keys = random_keys(30000, 500)
+    index = BlockIndex(memory_limit_bytes=64 * 1024, spill_dir=str(tmp_path))
+    for start in range(0, len(keys), 3000):
+        index.add_keys(keys[start:start + 3000])
+    assert index._spilled
+    unique = sorted_unique(keys)
+    for block in (0, 250, 499):
+        expected = unique[(unique >> OFFSET_BITS) == block] & np.uint64((1 << OFFSET_BITS) - 1)
+        assert index.offsets(block).tolist() == expected.tolist()
+
+
+def offsets_by_block(index, blocks):
+    return {int(block): index.offsets(block).tolist() for block in blocks}
+
+
+def spilled_index(keys, spill_dir, batch=2000):
+    # A few KB of memory, so nearly every batch spills a run of its own
+    index = BlockIndex(memory_limit_bytes=16 * 1024, spill_dir=str(spill_dir))
+    for start in range(0, len(keys), batch):
+        index.add_keys(keys[start:start + batch])
+    return index
+
+
+def reference_index(keys):
+    index = BlockIndex()
+    index.add_keys(keys)
+    index.finish()
+    return index
+
+
+def test_merged_spilled_runs_match_an_index_in_memory(tmp_path, monkeypatch):
+    # Small merge pieces, so the k-way merge takes many steps across block boundaries
+    monkeypatch.setattr("blocks.MERGE_PIECE_KEYS", 300)
+    keys = random_keys(60000, 2000, seed=3)
+    index = spilled_index(keys, tmp_path)
+    assert len(index._spilled) > 10
+    index.finish()
+    reference = reference_index(keys)
+    assert isinstance(index.keys(), np.memmap)
+    assert np.array_equal(index.keys(), reference.keys())
+    assert index.count == reference.count
+    assert index.blocks().tolist() == reference.blocks().tolist()
+    assert index.runs().starts.tolist() == reference.runs().starts.tolist()
+    blocks = reference.blocks()
+    assert offsets_by_block(index, blocks[::37]) == offsets_by_block(reference, blocks[::37])
+    # The spilled runs are gone once merged
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["keys.u64"]
+
+
+def test_merge_keeps_ctids_repeated_across_runs_once(tmp_path):
+    keys = random_keys(20000, 300, seed=4)
+    index = spilled_index(np.concatenate((keys, keys[::-1])), tmp_path)
+    index.finish()
+    assert np.array_equal(index.keys(), sorted_unique(keys))
+
+
+def test_saved_index_opens_with_the_same_blocks_and_offsets(tmp_path):
+    keys = random_keys(30000, 1500, seed=5)
+    reference = reference_index(keys)
+    index = spilled_index(keys, tmp_path / "spill")
+    index.truncated = True
+    index.error = "Reading the blocks of orders took over 120 s"
+    index.save(str(tmp_path / "saved"))
+    opened = BlockIndex.open(str(tmp_path / "saved"))
+    assert opened.count == reference.count
+    assert (opened.truncated, opened.error) == (True, index.error)
+    assert np.array_equal(opened.keys(), reference.keys())
+    assert opened.runs().ends.tolist() == reference.runs().ends.tolist()
+    blocks = reference.blocks()
+    assert offsets_by_block(opened, blocks[::23]) == offsets_by_block(reference, blocks[::23])
+    # Saving an opened index again keeps its memory-mapped keys in place
+    opened.save(str(tmp_path / "saved"))
+    assert np.array_equal(BlockIndex.open(str(tmp_path / "saved")).keys(), reference.keys())
+
+
+def test_saved_empty_index(tmp_path):
+    index = BlockIndex(relation_blocks=10)
+    index.save(str(tmp_path))
+    opened = BlockIndex.open(str(tmp_path))
+    assert (len(opened), opened.count, opened.relation_blocks) == (0, 0, 10)
+    assert opened.offsets(3).tolist() == []
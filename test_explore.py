@@ -0,0 +1,16 @@
+from explore import normalize_query
+
+
+def test_layout_and_keyword_case_share_a_key():
+    assert normalize_query("SELECT  *\n FROM Nation -- all of them\n;") == normalize_query("select * from nation")
+
+
+def test_literals_keep_their_case_and_spaces():
+    assert normalize_query("select * from t where a = $$Foo$$") != normalize_query("select * from t where a = $$foo$$")
+    assert normalize_query("select * from t where a = $x$A  B$x$") != normalize_query("select * from t where a = $x$a b$x$")
+    assert normalize_query("select 'A  B'") != normalize_query("select 'a b'")
+    assert normalize_query("select E'It\\'s'") != normalize_query("select e'it\\'s'")
+
+
+def test_quoted_names_keep_their_case():
+    assert normalize_query('select "Name" from t') != normalize_query('select "name" from t')
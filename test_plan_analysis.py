@@ -0,0 +1,150 @@
+import pytest
+
+from plan_analysis import analyze_plan
+from plan_tree import flatten_plan
+
+
+def analyze(plan):
+    nodes = flatten_plan(plan)
+    for node in nodes:
+        # Row counts every EXPLAIN ANALYZE node has, the tests are about time and buffers
+        node.plan.setdefault("Plan Rows", 1)
+        node.plan.setdefault("Actual Rows", 1)
+    return analyze_plan(nodes).nodes
+
+
+def test_nested_loop_inner_time_counts_every_loop():
+    plan = {
+        "Node Type": "Nested Loop", "Actual Total Time": 10.0, "Actual Loops": 1, "Shared Hit Blocks": 300,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Actual Total Time": 2.0,
+             "Actual Loops": 1, "Shared Hit Blocks": 100},
+            {"Node Type": "Index Scan", "Parent Relationship": "Inner", "Actual Total Time": 0.05,
+             "Actual Loops": 100, "Shared Hit Blocks": 200},
+        ],
+    }
+    loop, outer, inner = analyze(plan)
+    assert inner.inclusive_ms == pytest.approx(5.0)
+    assert loop.exclusive_ms == pytest.approx(3.0)
+    assert loop.buffers == {"Shared Hit Blocks": 0}
+    assert inner.buffers == {"Shared Hit Blocks": 200}
+
+
+def test_gather_children_run_in_every_process():
+    plan = {
+        "Node Type": "Gather", "Workers Launched": 2, "Actual Total Time": 100.0, "Actual Loops": 1,
+        "Shared Hit Blocks": 900, "Shared Read Blocks": 60,
+        "Plans": [
+            {"Node Type": "Hash Join", "Parent Relationship": "Outer", "Actual Total Time": 90.0,
+             "Actual Loops": 3, "Shared Hit Blocks": 900, "Shared Read Blocks": 60,
+             "Plans": [
+                 {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Actual Total Time": 60.0,
+                  "Actual Loops": 3, "Shared Hit Blocks": 600, "Shared Read Blocks": 60},
+                 {"Node Type": "Hash", "Parent Relationship": "Inner", "Actual Total Time": 15.0,
+                  "Actual Loops": 3, "Shared Hit Blocks": 300},
+             ]},
+        ],
+    }
+    gather, join, scan, hash_node = analyze(plan)
+    assert [node.processes for node in (gather, join, scan, hash_node)] == [1, 3, 3, 3]
+    assert join.inclusive_ms == pytest.approx(90.0)
+    assert gather.exclusive_ms == pytest.approx(10.0)
+    assert join.exclusive_ms == pytest.approx(15.0)
+    assert gather.buffers == {"Shared Hit Blocks": 0, "Shared Read Blocks": 0}
+    assert scan.buffers == {"Shared Hit Blocks": 600, "Shared Read Blocks": 60}
+
+
+def test_initplan_is_taken_off_the_node_that_reads_its_result():
+    # EXPLAIN ANALYZE of a join filtered by (select avg(...)), as PostgreSQL 16 reports it
+    plan = {
+        "Node Type": "Hash Join", "Actual Total Time": 22.848, "Actual Loops": 1, "Shared Hit Blocks": 1174,
+        "Hash Cond": "(o.o_custkey = c.c_custkey)",
+        "Plans": [
+            {"Node Type": "Aggregate", "Parent Relationship": "InitPlan", "Subplan Name": "InitPlan 1 (returns $0)",
+             "Actual Total Time": 9.506, "Actual Loops": 1, "Shared Hit Blocks": 569,
+             "Plans": [
+                 {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Relation Name": "orders",
+                  "Actual Total Time": 5.03, "Actual Loops": 1, "Shared Hit Blocks": 569},
+             ]},
+            {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Relation Name": "orders",
+             "Filter": "(o_totalprice > $0)", "Actual Total Time": 14.822, "Actual Loops": 1,
+             "Shared Hit Blocks": 1138},
+            {"Node Type": "Hash", "Parent Relationship": "Inner", "Actual Total Time": 0.769, "Actual Loops": 1,
+             "Shared Hit Blocks": 36,
+             "Plans": [
+                 {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Relation Name": "customer",
+                  "Actual Total Time": 0.304, "Actual Loops": 1, "Shared Hit Blocks": 36},
+             ]},
+        ],
+    }
+    join, aggregate, _, filtered, _, _ = analyze(plan)
+    # Not clamped at 0: the InitPlan's time is inside the filtered scan, not beside it
+    assert join.exclusive_ms == pytest.approx(22.848 - 14.822 - 0.769)
+    assert filtered.exclusive_ms == pytest.approx(14.822 - 9.506)
+    assert aggregate.exclusive_ms == pytest.approx(9.506 - 5.03)
+    assert join.buffers == {"Shared Hit Blocks": 0}
+    assert filtered.buffers == {"Shared Hit Blocks": 569}
+
+
+def test_initplan_reference_of_postgres_17():
+    plan = {
+        "Node Type": "Nested Loop", "Actual Total Time": 10.0, "Actual Loops": 1,
+        "Plans": [
+            {"Node Type": "Result", "Parent Relationship": "InitPlan", "Subplan Name": "InitPlan 1",
+             "Actual Total Time": 4.0, "Actual Loops": 1},
+            {"Node Type": "Seq Scan", "Parent Relationship": "Outer", "Actual Total Time": 7.0, "Actual Loops": 1,
+             "Filter": "(a > (InitPlan 1).col1)"},
+            {"Node Type": "Seq Scan", "Parent Relationship": "Inner", "Actual Total Time": 1.0, "Actual Loops": 1},
+        ],
+    }
+    loop, _, filtered, _ = analyze(plan)
+    assert loop.exclusive_ms == pytest.approx(2.0)
+    assert filtered.exclusive_ms == pytest.approx(3.0)
+
+
+def test_cte_is_taken_off_the_cte_scan_that_ran_it():
+    # A materialized CTE scanned twice, the first scan fills it and the second reads it back
+    plan = {
+        "Node Type": "Merge Join", "Actual Total Time": 54.918, "Actual Loops": 1, "Shared Hit Blocks": 569,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Parent Relationship": "InitPlan", "Subplan Name": "CTE x",
+             "Relation Name": "orders", "Actual Total Time": 5.526, "Actual Loops": 1, "Shared Hit Blocks": 569},
+            {"Node Type": "Sort", "Parent Relationship": "Outer", "Actual Total Time": 24.651, "Actual Loops": 1,
+             "Shared Hit Blocks": 569,
+             "Plans": [
+                 {"Node Type": "CTE Scan", "Parent Relationship": "Outer", "CTE Name": "x",
+                  "Actual Total Time": 13.491, "Actual Loops": 1, "Shared Hit Blocks": 569},
+             ]},
+            {"Node Type": "Materialize", "Parent Relationship": "Inner", "Actual Total Time": 18.703,
+             "Actual Loops": 1, "Shared Hit Blocks": 0,
+             "Plans": [
+                 {"Node Type": "Sort", "Parent Relationship": "Outer", "Actual Total Time": 14.387,
+                  "Actual Loops": 1, "Shared Hit Blocks": 0,
+                  "Plans": [
+                      {"Node Type": "CTE Scan", "Parent Relationship": "Outer", "CTE Name": "x",
+                       "Actual Total Time": 3.379, "Actual Loops": 1, "Shared Hit Blocks": 0},
+                  ]},
+             ]},
+        ],
+    }
+    join, cte, _, first_scan, _, _, second_scan = analyze(plan)
+    assert join.exclusive_ms == pytest.approx(54.918 - 24.651 - 18.703)
+    assert first_scan.exclusive_ms == pytest.approx(13.491 - 5.526)
+    assert second_scan.exclusive_ms == pytest.approx(3.379)
+    assert cte.exclusive_ms == pytest.approx(5.526)
+    assert join.buffers == {"Shared Hit Blocks": 0}
+    assert first_scan.buffers == {"Shared Hit Blocks": 0}
+    assert cte.buffers == {"Shared Hit Blocks": 569}
+
+
+def test_cte_under_its_only_scan():
+    plan = {
+        "Node Type": "CTE Scan", "CTE Name": "x", "Actual Total Time": 0.022, "Actual Loops": 1,
+        "Plans": [
+            {"Node Type": "Seq Scan", "Parent Relationship": "InitPlan", "Subplan Name": "CTE x",
+             "Actual Total Time": 0.018, "Actual Loops": 1},
+        ],
+    }
+    scan, cte = analyze(plan)
+    assert scan.exclusive_ms == pytest.approx(0.004)
+    assert cte.exclusive_ms == pytest.approx(0.018)
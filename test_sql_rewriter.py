@@ -0,0 +1,114 @@
+import pytest
+
+from sql_rewriter import check_select, rewrite_query
+
+
+def columns(result):
+    return dict(result.table_columns)
+
+
+def test_aliases_get_one_ctid_column_per_occurrence():
+    result = rewrite_query("select * from customer as c1, customer c2 where c1.c_custkey = c2.c_custkey")
+    assert result.instrumented_query == (
+        "select *, c1.ctid AS qp_ctid_0, c2.ctid AS qp_ctid_1 from customer as c1, customer c2 "
+        "where c1.c_custkey = c2.c_custkey")
+    assert columns(result) == {"customer": ("qp_ctid_0", "qp_ctid_1")}
+    assert result.plan_preserving
+
+
+def test_join_aliases():
+    result = rewrite_query("select c.c_name from customer c join orders o on o.o_custkey = c.c_custkey")
+    assert "c.ctid AS qp_ctid_0, o.ctid AS qp_ctid_1 from" in result.instrumented_query
+    assert columns(result) == {"customer": ("qp_ctid_0",), "orders": ("qp_ctid_1",)}
+
+
+def test_cte_ctids_pass_through_to_the_outer_query():
+    result = rewrite_query("with recent as (select * from orders where o_totalprice > 10) "
+                           "select * from recent r join customer c on c.c_custkey = r.o_custkey")
+    assert "select *, orders.ctid AS qp_ctid_0 from orders" in result.instrumented_query
+    assert "r.qp_ctid_0 AS qp_ctid_1, c.ctid AS qp_ctid_2" in result.instrumented_query
+    assert columns(result) == {"orders": ("qp_ctid_1",), "customer": ("qp_ctid_2",)}
+    # The CTE itself is not a table
+    assert result.table_names == ("customer", "orders")
+
+
+def test_set_operation_branches_pad_the_other_tables_with_null():
+    result = rewrite_query("select n_name from nation union select c_name from customer")
+    assert result.instrumented_query == (
+        "select n_name, nation.ctid AS qp_ctid_0, NULL::tid AS qp_ctid_1 from nation "
+        "union select c_name, NULL::tid AS qp_ctid_0, customer.ctid AS qp_ctid_1 from customer")
+    # UNION deduplicates rows, which the ctids would change
+    assert not result.plan_preserving
+
+
+def test_aggregates_group_by_ctid():
+    result = rewrite_query("select c_nationkey, count(*) from customer group by c_nationkey")
+    assert result.instrumented_query.endswith("from customer group by c_nationkey, customer.ctid")
+    assert not result.plan_preserving
+
+
+def test_filter_and_within_group_are_aggregates():
+    result = rewrite_query("select count(*) filter (where o_totalprice > 10), "
+                           "percentile_cont(0.5) within group (order by o_totalprice) from orders")
+    assert "GROUP BY orders.ctid" in result.instrumented_query
+    assert not result.plan_preserving
+
+
+def test_window_functions_are_not_aggregates():
+    result = rewrite_query("select o_orderkey, rank() over (order by o_totalprice) from orders")
+    assert "GROUP BY" not in result.instrumented_query.upper()
+    assert columns(result) == {"orders": ("qp_ctid_0",)}
+    assert result.plan_preserving
+
+
+def test_subquery_tables_are_skipped():
+    result = rewrite_query("select o_orderpriority, count(*) from orders where exists "
+                           "(select 1 from lineitem l where l.l_orderkey = o_orderkey) group by o_orderpriority")
+    assert columns(result) == {"orders": ("qp_ctid_0",)}
+    assert result.table_names == ("lineitem", "orders")
+    assert result.skipped_tables == ("lineitem",)
+
+
+def test_excluded_tables_are_skipped():
+    result = rewrite_query("select * from nation_view v join nation n using (n_nationkey)",
+                           frozenset(("nation_view",)))
+    assert columns(result) == {"nation": ("qp_ctid_0",)}
+    assert result.skipped_tables == ("nation_view",)
+
+
+@pytest.mark.parametrize("query", [
+    "select 1; delete from orders",
+    "delete from orders",
+    "with gone as (delete from orders returning *) select * from gone",
+    "explain select 1",
+])
+def test_only_a_single_select_is_accepted(query):
+    with pytest.raises(RuntimeError):
+        check_select(query)
+    with pytest.raises(RuntimeError):
+        rewrite_query(query)
+
+
+def test_trailing_semicolon_and_comment_are_accepted():
+    check_select("select * from nation; -- done")
+    assert rewrite_query("select * from nation;").instrumented_query == (
+        "select *, nation.ctid AS qp_ctid_0 from nation")
+
+
+def test_reserved_prefix_is_rejected():
+    with pytest.raises(RuntimeError, match="reserved prefix"):
+        rewrite_query("select qp_ctid_0 from nation")
+
+
+@pytest.mark.parametrize("query", [
+    r"select '\'; delete from orders; --'",
+    r"select n_name from nation where n_name = '\'; commit; delete from orders; --'",
+])
+def test_backslash_does_not_escape_a_standard_string(query):
+    with pytest.raises(RuntimeError, match="single SQL statement"):
+        check_select(query)
+
+
+def test_backslash_escapes_inside_an_escape_string():
+    check_select(r"select E'it\'s; fine' from nation")
+    check_select(r"select e'\\', 'a''b' from nation")
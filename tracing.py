@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Spans waiting on the database, everything else is time spent in the tool itself
+DATABASE = "database"
+CLIENT = "client"
+
+_active = threading.local()
+
+
+class Span:
+    """One timed phase, with counters such as rows and bytes attached as attributes."""
+
+    def __init__(self, name, category, attributes):
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+
+class Trace:
+    """Spans recorded while one query is analyzed, from any thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category=CLIENT, **attributes):
+        span = Span(name, category, attributes)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            with self._lock:
+                self.spans.append(span)
+
+    def breakdown(self):
+        # Spans with the same name summed, in the order the phases first ran
+        phases = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        for span in spans:
+            phase = phases.setdefault(span.name, {
+                "phase": span.name, "category": span.category, "calls": 0, "wall_ms": 0.0,
+            })
+            phase["calls"] += 1
+            phase["wall_ms"] += span.duration_ms()
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)):
+                    phase[key] = phase.get(key, 0) + value
+        return list(phases.values())
+
+    def totals(self):
+        with self._lock:
+            spans = list(self.spans)
+        end = max((span.end for span in spans), default=self.start)
+        total = (end - self.start) * 1000
+        database = sum(span.duration_ms() for span in spans if span.category == DATABASE)
+        return {"total_ms": total, "database_ms": database, "client_ms": max(total - database, 0.0)}
+
+    def to_chrome_trace(self):
+        # Complete ("X") events in microseconds, loadable in chrome://tracing or Perfetto
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": round((span.start - self.start) * 1e6, 3),
+            "dur": round(span.duration_ms() * 1000, 3),
+            "pid": os.getpid(),
+            "tid": span.thread_id,
+            "args": span.attributes,
+        } for span in spans]
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"trace": self.name}}
+
+    def save(self, path):
+        with open(path, "w") as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file, default=str)
+
+
+class _NoSpan:
+    # Stands in for a span when nothing is being traced
+    def add(self, **counters):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+@contextmanager
+def activate(trace):
+    # Spans opened on this thread go to the trace until the block exits
+    previous = getattr(_active, "trace", None)
+    _active.trace = trace
+    try:
+        yield trace
+    finally:
+        _active.trace = previous
+
+
+def current_trace():
+    return getattr(_active, "trace", None)
+
+
+@contextmanager
+def span(name, category=CLIENT, **attributes):
+    trace = current_trace()
+    if trace is None:
+        yield _no_span
+        return
+    with trace.span(name, category, **attributes) as current:
+        yield current
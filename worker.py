@@ -0,0 +1,171 @@
+import tempfile
+
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+from explore import *
+from plan_history import table_summaries
+from plan_tree import get_plan_layout
+from tracing import Trace, activate, span
+
+
+class QueryWorkerSignals(QObject):
+    # QRunnable can't emit signals itself, so they live on a QObject
+    tableStarted = pyqtSignal(str, object, list)
+    blocksReceived = pyqtSignal(str, object, object)
+    tableFinished = pyqtSignal(str, object)
+    tablesSkipped = pyqtSignal(list)
+    approximationUnavailable = pyqtSignal(str)
+    finished = pyqtSignal(object, object, object)
+    cancelled = pyqtSignal()
+    error = pyqtSignal(str)
+
+
+class QueryWorker(QRunnable):
+    """Runs the whole analysis of one query off the GUI thread."""
+
+    def __init__(self, query, estimate_only=False, history=None, approximate=False, spill=False,
+                 memory_limit_mb=MAX_CTID_MEMORY_MB):
+        super().__init__()
+        self.query = query
+        self.estimate_only = estimate_only
+        # Sampled blocks, refined until cancel() stops it or the result is exact
+        self.approximate = approximate
+        # Tables over the memory limit spill to disk instead of being cut short. The
+        # directory is only made for an exact read, and is the caller's to remove once
+        # a finished, cancelled or error signal says nothing writes to it any more.
+        self.spill = spill
+        self.spill_dir = None
+        self.memory_limit_mb = memory_limit_mb  # None for no limit
+        self.history = history  # PlanHistory finished runs are recorded in, if any
+        self.cancel_token = CancelToken()
+        self.signals = QueryWorkerSignals()
+        self.headers = {}
+        # Phases of this query, the GUI adds its own drawing spans when the results arrive
+        self.trace = Trace(query)
+
+    def run(self):
+        with activate(self.trace):
+            self.analyze()
+
+    def analyze(self):
+        try:
+            if self.estimate_only:
+                # Planner estimates only, nothing is executed so there are no blocks
+                plan = get_execution_plan(self.query, analyze=False, cancel_token=self.cancel_token)
+                self.recordHistory(plan, {}, analyzed=False)
+                self.signals.finished.emit(plan, {}, self.layoutPlan(plan))
+                return
+            if self.approximate:
+                try:
+                    # Cancelling only stops the refinement, the estimate so far is the result
+                    plan, results = approximate_query(self.query, on_progress=self.reportProgress,
+                                                      cancel_token=self.cancel_token)
+                except WindowScanUnavailableError as e:
+                    # Sampling would be slower than reading every ctid, so the query runs exactly
+                    self.approximate = False
+                    self.signals.approximationUnavailable.emit(str(e))
+                else:
+                    for table_name, index in results.items():
+                        self.reportTableDone(table_name, index)
+                    self.reportSkipped()
+                    self.recordHistory(plan, results, analyzed=False)
+                    self.signals.finished.emit(plan, results, self.layoutPlan(plan))
+                    return
+            if self.spill:
+                self.spill_dir = tempfile.mkdtemp(prefix="query-blocks-")
+            plan, results = analyze_query(self.query, on_progress=self.reportProgress,
+                                          cancel_token=self.cancel_token, on_table_done=self.reportTableDone,
+                                          memory_limit_mb=self.memory_limit_mb, spill_dir=self.spill_dir)
+            self.cancel_token.check()
+            self.reportSkipped()
+            self.recordHistory(plan, results, analyzed=True)
+            # Laid out here so big plans don't stall the GUI thread
+            self.signals.finished.emit(plan, results, self.layoutPlan(plan))
+        except QueryCancelledError:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.error.emit(str(e))
+
+    def layoutPlan(self, plan):
+        with span("plan layout"):
+            return get_plan_layout(plan)
+
+    def recordHistory(self, plan, results, analyzed):
+        if self.history is None:
+            return
+        with span("plan history"):
+            pool = get_pool()
+            self.history.record(self.query, plan, table_summaries(results), f"{pool.host}/{pool.database}",
+                                analyzed=analyzed)
+
+    def reportProgress(self, table_name, index, new_blocks):
+        if table_name not in self.headers:
+            # Column names are looked up here so switching tabs never waits on the database
+            self.headers[table_name] = get_columns_for_table(table_name)
+            self.signals.tableStarted.emit(table_name, index, self.headers[table_name])
+        else:
+            self.signals.blocksReceived.emit(table_name, index, new_blocks)
+
+    def reportTableDone(self, table_name, index):
+        # Tables with no matching tuples never sent a batch, their tab starts here
+        if table_name not in self.headers:
+            self.reportProgress(table_name, index, [])
+        self.signals.tableFinished.emit(table_name, index)
+
+    def reportSkipped(self):
+        skipped = get_skipped_tables(self.query)
+        if skipped:
+            self.signals.tablesSkipped.emit(skipped)
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+
+class BlockRecordsWorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+
+
+class BlockRecordsWorker(QRunnable):
+    """Fetches the tuples of one block off the GUI thread."""
+
+    def __init__(self, table_name, block, offsets):
+        super().__init__()
+        self.table_name = table_name
+        self.block = block
+        self.offsets = offsets
+        self.signals = BlockRecordsWorkerSignals()
+
+    def run(self):
+        try:
+            records = fetch_block_records(self.table_name, self.block, self.offsets)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.finished.emit(records)
+
+
+class PlanHistoryWorkerSignals(QObject):
+    finished = pyqtSignal(list)
+    error = pyqtSignal(str)
+
+
+class PlanHistoryWorker(QRunnable):
+    """Reads the earlier runs of one query off the GUI thread."""
+
+    def __init__(self, history, query, limit):
+        super().__init__()
+        self.history = history
+        self.query = query
+        self.limit = limit
+        self.signals = PlanHistoryWorkerSignals()
+
+    def run(self):
+        try:
+            # Runs still queued for the writer are included, which can take a write interval
+            self.history.flush()
+            runs = self.history.runs(self.query, limit=self.limit)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+            return
+        self.signals.finished.emit(runs)